@@ -4,43 +4,76 @@
 
 import argparse
 import importlib
-import p3sub.commands
 import sys
 import ubos.logging
-import ubos.utils
+
+# All available subcommands, with their help text. Listed here so only the
+# subcommand that is actually run needs to be imported.
+COMMANDS = {
+    'bench' : 'Run a local publisher/subscriber load-testing benchmark.',
+    'pub'   : 'Run a p3sub publisher.',
+    'relay' : 'Relay a p3sub feed to more subscribers.',
+    'sub'   : 'Run a p3sub subscriber.'
+}
+
 
 def run():
     """
     Main entry point: looks for available subcommands and
     executes the correct one.
     """
-    cmdNames = ubos.utils.findSubmodules(p3sub.commands)
+    # First find out which subcommand to run, then parse again with its options
+    ( parser, cmdParsers ) = createParser()
+    for cmdName, cmdHelp in COMMANDS.items():
+        cmdParsers.add_parser( cmdName, help=cmdHelp, add_help=False )
 
-    parser = argparse.ArgumentParser( description='P3Sub (Push-Pull-Publish-Subscribe)')
-    parser.add_argument('-v', '--verbose', action='count',       default=0,  help='Display extra output. May be repeated for even more output.')
-    parser.add_argument('--logConfig',                                       help='Use an alternate log configuration file for this command.')
-    parser.add_argument('--debug',         action='store_const', const=True, help='Suspend execution at certain points for debugging' )
-    cmdParsers = parser.add_subparsers( dest='command', required=True )
+    args,remaining = parser.parse_known_args(sys.argv[1:])
+    cmdName = args.command
+    cmd     = importlib.import_module('p3sub.commands.' + cmdName)
 
-    cmds = {}
-    for cmdName in cmdNames:
-        mod = importlib.import_module('p3sub.commands.' + cmdName)
-        mod.addSubParser( cmdParsers, cmdName )
-        cmds[cmdName] = mod
+    ( parser, cmdParsers ) = createParser()
+    for otherCmdName, otherCmdHelp in COMMANDS.items():
+        if otherCmdName == cmdName:
+            cmd.addSubParser( cmdParsers, cmdName )
+        else:
+            cmdParsers.add_parser( otherCmdName, help=otherCmdHelp )
 
     args,remaining = parser.parse_known_args(sys.argv[1:])
-    cmdName = args.command
 
-    ubos.logging.initialize('p3sub', cmdName, args.verbose, args.logConfig, args.debug)
+    ubos.logging.initialize('p3sub', cmdName, args.verbose, args.logConfig, args.debug,
+            queueSize = args.logQueueSize,
+            whenFull  = 'block' if args.logQueueBlock else 'drop' )
+
+    if args.logSpans:
+        ubos.logging.enableSpans( args.logSpansEvery )
 
-    if cmdName in cmdNames:
-        try :
-            ret = cmds[cmdName].run( args, remaining )
-            exit( ret )
+    if args.profileDirectory:
+        import p3sub.profiler
+        p3sub.profiler.configureProfiler( args.profileDirectory )
 
-        except Exception as e:
-            ubos.logging.fatal( str(type(e)), '--', e )
+    try :
+        ret = cmd.run( args, remaining )
+        exit( ret )
 
-    else:
-        ubos.logging.fatal('Sub-command not found:', cmdName, '. Add --help for help.' )
+    except Exception as e:
+        ubos.logging.fatal( str(type(e)), '--', e )
+
+
+def createParser():
+    """
+    Create the top-level argument parser, without any subcommands yet.
+
+    return: tuple of the parser, and the object to add subcommand parsers to
+    """
+    parser = argparse.ArgumentParser( description='P3Sub (Push-Pull-Publish-Subscribe)')
+    parser.add_argument('-v', '--verbose', action='count',       default=0,  help='Display extra output. May be repeated for even more output.')
+    parser.add_argument('--logConfig',                                       help='Use an alternate log configuration file for this command.')
+    parser.add_argument('--debug',         action='store_const', const=True, help='Suspend execution at certain points for debugging' )
+    parser.add_argument('--logQueueSize',  type=int,             default=0,  help='Emit log messages from a background thread, queueing up to this many.' )
+    parser.add_argument('--logQueueBlock', action='store_const', const=True, help='With --logQueueSize, wait instead of dropping log messages when the queue is full.' )
+    parser.add_argument('--logSpans',      action='store_const', const=True, help='Time the hot paths, and log the aggregated timings at info level on exit.' )
+    parser.add_argument('--logSpansEvery', type=float,           default=0,  help='With --logSpans, also log the aggregated timings every this many seconds.' )
+    parser.add_argument('--profileDirectory',                                help='Where to write profiling results; send SIGUSR2 to start and stop profiling.' )
+    cmdParsers = parser.add_subparsers( dest='command', required=True )
 
+    return ( parser, cmdParsers )
@@ -0,0 +1,567 @@
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from datetime import datetime
+from email.message import Message
+from math import ceil
+from os import listdir, makedirs, rename, utime
+from os.path import isdir
+from p3sub.defs import *
+from p3sub.publisher import Publisher
+from p3sub.subscriber import PassiveSubscriber
+from p3sub.utils import *
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from threading import Condition, Thread
+from urllib.parse import urlencode, urlparse
+from urllib.request import urlopen, Request
+import os
+import p3sub
+import re
+import signal
+import subprocess
+import sys
+import time
+
+# Modules that should not be imported merely to start up the command-line
+STARTUP_HEAVY_MODULES = [ 'http.server', 'msgspec', 'p3sub.publisher', 'p3sub.relay', 'p3sub.subscriber', 'systemd.journal', 'urllib.request', 'watchdog' ]
+
+
+class Benchmark :
+    """
+    Runs a Publisher and a number of local PassiveSubscribers in this
+    process, injects feed elements into the feed directory at a given rate,
+    and measures how long it takes until they have been delivered to all
+    subscribers. No network other than the loopback interface is needed.
+    """
+    def __init__( self, workDir, numSubscribers, numElements, elementSize, rate, basePort, seed, timeout, direct=False, watcher='auto' ) :
+        self.theWorkDir        = workDir
+        self.theFeedDir        = workDir + '/feed'
+        self.theStagingDir     = self.theFeedDir + '/.staging' # not watched, as watchers are non-recursive
+        self.theNumSubscribers = numSubscribers
+        self.theNumElements    = numElements
+        self.theElementSize    = elementSize
+        self.theRate           = rate
+        self.theBasePort       = basePort
+        self.theRandom         = Random( seed )
+        self.theTimeout        = timeout
+        self.theDirect         = direct # publish through Publisher.publish instead of the feed directory
+        self.thePublisher      = None
+        self.theWatcher        = watcher
+
+        self.thePublished      = {} # ts string -> time.monotonic() when published
+        self.theDelivered      = [] # ( ts string, time.monotonic() when received )
+        self.theDeliveredCond  = Condition()
+        self.theLastMtimeNs    = 0
+
+
+    def run( self ) :
+        """
+        Run the benchmark.
+
+        return: dict with the results
+        """
+        makedirs( self.theStagingDir, exist_ok=True )
+
+        # Subscribers find the subscribe Link header by GETting the feed's current
+        # element, which fails while the feed is empty. The seed is not counted
+        self.publishElement( 'element-seed.dat' )
+        self.thePublished = {}
+
+        publisher = Publisher( urlparse( f'http://localhost:{ self.theBasePort }/feed' ), self.theFeedDir, watcher=self.theWatcher )
+        self.thePublisher = publisher
+        threads   = [ Thread( target=publisher.run ) ]
+
+        subscribers = []
+        for i in range( 0, self.theNumSubscribers ) :
+            receivedDir = f'{ self.theWorkDir }/received-{ i }'
+            makedirs( receivedDir, exist_ok=True )
+
+            sub = BenchmarkSubscriber(
+                    urlparse( f'http://localhost:{ self.theBasePort + 1 + i }/' ),
+                    receivedDir,
+                    self )
+            subscribers.append( sub )
+            threads.append( Thread( target=sub.run ) )
+
+        for t in threads :
+            t.start()
+
+        self.waitForServers( [ publisher ] + subscribers )
+
+        for sub in subscribers :
+            self.subscribe( sub, publisher )
+
+        usageBefore = getrusage( RUSAGE_SELF )
+        startTime   = time.monotonic()
+
+        interval = 1.0 / self.theRate if self.theRate > 0 else 0.0
+        for i in range( 0, self.theNumElements ) :
+            nextTime = startTime + i * interval
+            delay    = nextTime - time.monotonic()
+            if delay > 0 :
+                time.sleep( delay )
+            if self.theDirect :
+                self.publishElementDirectly()
+            else :
+                self.publishElement( 'element-%08d.dat' % i )
+
+        expected = self.theNumElements * self.theNumSubscribers
+        with self.theDeliveredCond :
+            self.theDeliveredCond.wait_for( lambda : len( self.theDelivered ) >= expected, self.theTimeout )
+            delivered = list( self.theDelivered )
+
+        endTime    = time.monotonic()
+        usageAfter = getrusage( RUSAGE_SELF )
+
+        for sub in subscribers :
+            sub.stopListen()
+        publisher.stop()
+        for t in threads :
+            t.join()
+
+        latencies = sorted( received - self.thePublished[ts] for ( ts, received ) in delivered if ts in self.thePublished )
+        if delivered :
+            duration = max( received for ( ts, received ) in delivered ) - startTime
+        else :
+            duration = endTime - startTime
+
+        return {
+            'subscribers'        : self.theNumSubscribers,
+            'elements'           : self.theNumElements,
+            'elementSize'        : self.theElementSize,
+            'rate'               : self.theRate,
+            'direct'             : self.theDirect,
+            'watcher'            : self.theWatcher,
+            'expected'           : expected,
+            'delivered'          : len( delivered ),
+            'duration'           : duration,
+            'throughput'         : len( delivered ) / duration if duration > 0 else 0.0,
+            'latencyP50'         : percentile( latencies, 50 ),
+            'latencyP90'         : percentile( latencies, 90 ),
+            'latencyP99'         : percentile( latencies, 99 ),
+            'latencyMax'         : latencies[-1] if latencies else None,
+            'cpuUser'            : usageAfter.ru_utime - usageBefore.ru_utime,
+            'cpuSystem'          : usageAfter.ru_stime - usageBefore.ru_stime,
+            'peakRssKb'          : usageAfter.ru_maxrss
+        }
+
+
+    def publishElement( self, name ) :
+        """
+        Atomically place a new element into the feed directory, with an
+        mtime that is strictly later than that of any element before.
+
+        name: file name of the element in the feed directory
+        """
+        staged = f'{ self.theStagingDir }/{ name }'
+        with open( staged, 'wb' ) as f :
+            f.write( self.theRandom.randbytes( self.theElementSize ))
+
+        # the feed is ordered by mtime, at microsecond resolution
+        newMtimeNs = max( nowNs(), self.theLastMtimeNs + 1000 )
+        self.theLastMtimeNs = newMtimeNs
+        utime( staged, ns=( newMtimeNs, newMtimeNs ))
+
+        final = f'{ self.theFeedDir }/{ name }'
+        ts    = nsToString( mtimeNs( staged ))
+
+        self.thePublished[ts] = time.monotonic()
+        rename( staged, final )
+
+
+    def publishElementDirectly( self ) :
+        """
+        Publish a new element through the publisher's API.
+        """
+        content   = self.theRandom.randbytes( self.theElementSize )
+        published = time.monotonic()
+        ts        = self.thePublisher.publish( content )
+
+        self.thePublished[ts] = published
+
+
+    def elementReceived( self, ts ) :
+        """
+        Invoked by the subscribers when an element has been received.
+
+        ts: the timestamp of the element, as string
+        """
+        received = time.monotonic()
+        with self.theDeliveredCond :
+            self.theDelivered.append( ( ts, received ))
+            self.theDeliveredCond.notify_all()
+
+
+    def waitForServers( self, servers ) :
+        """
+        Wait until all publishers and subscribers have bound their ports.
+        """
+        deadline = time.monotonic() + self.theTimeout
+        for server in servers :
+            while server.theWebServer is None :
+                if time.monotonic() > deadline :
+                    raise Exception( 'Publisher or subscriber failed to start' )
+                time.sleep( 0.01 )
+
+
+    def subscribe( self, sub, publisher ) :
+        """
+        Subscribe a BenchmarkSubscriber to the publisher, as of now.
+        """
+        data = {
+            P3SUB_PAR_SUBID    : sub.theSubId,
+            P3SUB_PAR_CALLBACK : f'http://localhost:{ sub.theWsPort }{ sub.theWsPath }',
+            P3SUB_PAR_TS       : nsToString( nowNs() )
+        }
+        response = urlopen( Request(
+                f'http://localhost:{ self.theBasePort }{ publisher.theSubscribePath }',
+                data=bytes( urlencode( data ), 'utf-8' ),
+                method='POST' ))
+        if response.status != 200 :
+            raise Exception( f'Subscription failed, HTTP status { response.status }' )
+
+
+class RelayBenchmark( Benchmark ) :
+    """
+    Measures how aggregate delivery throughput scales with the number of
+    relays. Runs an origin publisher, the relays and their subscribers as
+    separate p3sub processes, so they do not share an interpreter lock, and
+    repeats with 1 up to the given number of relays, each serving the same
+    number of subscribers. Elements are placed into the origin's feed
+    directory; the subscribers' received directories are counted to detect
+    delivery.
+    """
+    def __init__( self, workDir, numSubscribers, numElements, elementSize, rate, basePort, seed, timeout, numRelays, childArgs=[] ) :
+        """
+        numSubscribers: number of subscribers of each relay
+        numRelays: the maximum number of relays
+        childArgs: global p3sub options for the child processes, e.g. --logConfig
+        """
+        super().__init__( workDir, numSubscribers, numElements, elementSize, rate, basePort, seed, timeout )
+
+        self.theNumRelays = numRelays
+        self.theChildArgs = childArgs
+        self.theEnv       = dict( os.environ, PYTHONPATH=os.pathsep.join( sys.path ), PYTHONUNBUFFERED='1' )
+
+
+    def run( self ) :
+        """
+        Run the benchmark.
+
+        return: dict with the results
+        """
+        results = {
+            'subscribersPerRelay' : self.theNumSubscribers,
+            'elements'            : self.theNumElements,
+            'elementSize'         : self.theElementSize,
+            'rate'                : self.theRate,
+            'cpus'                : os.cpu_count(),
+            'expected'            : 0,
+            'delivered'           : 0
+        }
+        for numRelays in range( 1, self.theNumRelays + 1 ) :
+            ( expected, delivered, duration ) = self.runWithRelays( numRelays )
+
+            results['expected']                         += expected
+            results['delivered']                        += delivered
+            results[ f'relays{ numRelays }Delivered' ]  = delivered
+            results[ f'relays{ numRelays }Throughput' ] = delivered / duration if duration > 0 else 0.0
+
+        results['scaling'] = results[ f'relays{ self.theNumRelays }Throughput' ] / results['relays1Throughput'] if results['relays1Throughput'] else None
+        return results
+
+
+    def runWithRelays( self, numRelays ) :
+        """
+        Run the benchmark once, with this many relays.
+
+        return: tuple of the number of expected and of delivered elements, and the duration in seconds
+        """
+        runDir              = f'{ self.theWorkDir }/relays-{ numRelays }'
+        self.theFeedDir     = runDir + '/feed'
+        self.theStagingDir  = self.theFeedDir + '/.staging'
+        self.theLastMtimeNs = 0
+        makedirs( self.theStagingDir )
+
+        # subscribers GET the feed's current element to find the subscribe Link header,
+        # which fails while the feed is empty
+        self.publishElement( 'element-seed.dat' )
+
+        port         = self.theBasePort
+        originUri    = f'http://localhost:{ port }/feed'
+        receivedDirs = []
+        processes    = [] # tuples as returned by startChild
+        try :
+            processes.append( self.startChild( runDir, 'origin', 'Serving P3Sub feed',
+                    [ 'pub', '--listen', originUri, '--feed-directory', self.theFeedDir ] ))
+            self.waitForChildren( processes )
+
+            relayUris = []
+            for r in range( 0, numRelays ) :
+                relayUri = f'http://localhost:{ port + 1 }/feed'
+                processes.append( self.startChild( runDir, f'relay-{ r }', 'Serving P3Sub subscriber endpoint',
+                        [ 'relay', '--listen', relayUri, '--callback', f'http://localhost:{ port + 2 }/',
+                          '--feed-directory', f'{ runDir }/relay-{ r }', originUri ] ))
+                relayUris.append( relayUri )
+                port += 2
+            self.waitForChildren( processes )
+
+            for r in range( 0, numRelays ) :
+                for i in range( 0, self.theNumSubscribers ) :
+                    port       += 1
+                    receivedDir = f'{ runDir }/received-{ r }-{ i }'
+                    processes.append( self.startChild( runDir, f'sub-{ r }-{ i }', 'Serving P3Sub subscriber endpoint',
+                            [ 'sub', '--listen', f'http://localhost:{ port }/', '--received-directory', receivedDir, relayUris[r] ] ))
+                    receivedDirs.append( receivedDir )
+            self.waitForChildren( processes )
+
+            startTime = time.monotonic()
+            interval  = 1.0 / self.theRate if self.theRate > 0 else 0.0
+            for i in range( 0, self.theNumElements ) :
+                delay = startTime + i * interval - time.monotonic()
+                if delay > 0 :
+                    time.sleep( delay )
+                self.publishElement( 'element-%08d.dat' % i )
+
+            expected = self.theNumElements * len( receivedDirs )
+            deadline = startTime + self.theTimeout
+            while True :
+                delivered = sum( len( listdir( d )) for d in receivedDirs if isdir( d ))
+                if delivered >= expected or time.monotonic() > deadline :
+                    break
+                time.sleep( 0.01 )
+            duration = time.monotonic() - startTime
+
+        finally :
+            # subscribers first, so they can unsubscribe
+            for ( process, readyMessage, logFile ) in reversed( processes ) :
+                process.send_signal( signal.SIGINT )
+                try :
+                    process.wait( 10 )
+                except subprocess.TimeoutExpired :
+                    process.kill()
+                    process.wait()
+
+        return ( expected, delivered, duration )
+
+
+    def startChild( self, runDir, name, readyMessage, args ) :
+        """
+        Start a p3sub child process, writing its output into a log file.
+
+        return: tuple of the process, the message it prints once ready, and the log file
+        """
+        logFile = f'{ runDir }/{ name }.log'
+        with open( logFile, 'wb' ) as log :
+            process = subprocess.Popen(
+                    [ sys.executable, '-c', 'import p3sub; p3sub.run()' ] + self.theChildArgs + args,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    env=self.theEnv )
+        return ( process, readyMessage, logFile )
+
+
+    def waitForChildren( self, processes ) :
+        """
+        Wait until all child processes have printed their ready message.
+        """
+        deadline = time.monotonic() + self.theTimeout
+        for ( process, readyMessage, logFile ) in processes :
+            while True :
+                with open( logFile ) as f :
+                    if readyMessage in f.read() :
+                        break
+                if process.poll() is not None or time.monotonic() > deadline :
+                    raise Exception( f'Child process failed to start, see { logFile }' )
+                time.sleep( 0.01 )
+
+
+class BenchmarkSubscriber( PassiveSubscriber ) :
+    """
+    A PassiveSubscriber that reports received elements back to the Benchmark.
+    """
+    def __init__( self, listenUri, receivedDir, benchmark ) :
+        super().__init__( listenUri, receivedDir, None )
+
+        self.theSubId     = self.generateSubId()
+        self.theBenchmark = benchmark
+
+
+    def putRequestReceived( self, handler, query ) :
+        err = super().putRequestReceived( handler, query )
+        if not err :
+            self.theBenchmark.elementReceived( query[P3SUB_PAR_TS] )
+        return err
+
+
+def percentile( sortedValues, p ) :
+    """
+    Nearest-rank percentile.
+
+    sortedValues: the values, sorted
+    p: the percentile, 0..100
+    return: the value, or None if there are no values
+    """
+    if not sortedValues :
+        return None
+    rank = max( 0, min( len( sortedValues ), ceil( p * len( sortedValues ) / 100.0 )) - 1 )
+    return sortedValues[rank]
+
+
+def runMicroBenchmarks( iterations, seed ) :
+    """
+    Time the hot-path helpers in p3sub.utils against the straightforward
+    implementations they replaced, after checking that both produce the
+    same results.
+
+    iterations: how many distinct inputs to use
+    seed: seed for generating the inputs
+    return: dict with the results, in microseconds per operation
+    """
+    rnd     = Random( seed )
+    results = {}
+
+    # Timestamps: round-trip random values across the full supported range
+    tsNs = [ rnd.randrange( 0, 253402300799999999 ) * 1000 for i in range( 0, iterations ) ] # up to 9999-12-31
+    tsStrings = []
+    for ns in tsNs :
+        s = nsToString( ns )
+        if s != referenceTsToString( nsToTs( ns )) :
+            raise Exception( f'nsToString mismatch for { ns }: { s }' )
+        if stringToNs( s ) != ns or referenceStringToTs( s ) != nsToTs( ns ) :
+            raise Exception( f'stringToNs mismatch for { s }' )
+        tsStrings.append( s )
+
+    results['tsFormatReference'] = timePerOp( lambda : [ referenceTsToString( nsToTs( ns )) for ns in tsNs ], iterations )
+    results['tsFormat']          = timePerOp( lambda : [ nsToString.__wrapped__( ns ) for ns in tsNs ], iterations )
+    results['tsFormatCached']    = timePerOp( lambda : [ nsToString( ns ) for ns in tsNs[0:100] * ( iterations // 100 ) ], iterations // 100 * 100 )
+    results['tsParseReference']  = timePerOp( lambda : [ referenceStringToTs( s ) for s in tsStrings ], iterations )
+    results['tsParse']           = timePerOp( lambda : [ stringToNs.__wrapped__( s ) for s in tsStrings ], iterations )
+    results['tsParseCached']     = timePerOp( lambda : [ stringToNs( s ) for s in tsStrings[0:100] * ( iterations // 100 ) ], iterations // 100 * 100 )
+
+    # Link headers: what a publisher sends with every pushed element
+    linkMessages = []
+    for s in tsStrings :
+        msg = Message()
+        msg['link'] = f'</feed/unsub>; rel="{ P3SUB_REL_UNSUBSCRIBE }", </feed?{ P3SUB_PAR_TS }={ s }>; rel="{ P3SUB_REL_PREV }"'
+        if dict( linkHeaderPars( msg )) != referenceLinkHeaderPars( msg ) :
+            raise Exception( f'linkHeaderPars mismatch for { msg["link"] }' )
+        linkMessages.append( msg )
+
+    # The same, but with a comma inside a quoted string, which needs the full grammar
+    slowMessages = []
+    for s in tsStrings :
+        msg = Message()
+        msg['link'] = f'</feed/unsub>; rel="{ P3SUB_REL_UNSUBSCRIBE }"; title="a, b", </feed?{ P3SUB_PAR_TS }={ s }>; rel="{ P3SUB_REL_PREV }"'
+        if dict( linkHeaderPars( msg )) != { P3SUB_REL_UNSUBSCRIBE : '/feed/unsub', P3SUB_REL_PREV : f'/feed?{ P3SUB_PAR_TS }={ s }' } :
+            raise Exception( f'linkHeaderPars mismatch for { msg["link"] }' )
+        slowMessages.append( msg )
+
+    # Every element has a different timestamp, so every header is different
+    results['linkParseReference'] = timePerOp( lambda : [ referenceLinkHeaderPars( msg ) for msg in linkMessages ], iterations )
+    results['linkParse']          = timePerOp( lambda : [ linkHeaderPars( msg ) for msg in linkMessages ], iterations )
+    results['linkParseSlowly']    = timePerOp( lambda : [ linkHeaderPars( msg ) for msg in slowMessages ], iterations )
+
+    return results
+
+
+def runStartupBenchmark( budgetMs ) :
+    """
+    Measure how long it takes to import what's needed to start the p3sub
+    command-line, using python -X importtime, for each subcommand's --help.
+
+    budgetMs: the maximum acceptable import time, in milliseconds
+    return: dict with the results, in milliseconds, and whether all were within budget
+    """
+    results = {}
+    ok      = True
+
+    for cmdName in [ None ] + list( p3sub.COMMANDS ) :
+        ( returnCode, importMs, wallMs, heavy ) = measureStartup( cmdName )
+
+        name = cmdName or 'p3sub'
+        results[name + 'ImportMs']      = importMs
+        results[name + 'WallMs']        = wallMs
+        results[name + 'HeavyImports']  = ' '.join( sorted( heavy )) if heavy else None
+
+        if returnCode != 0 or importMs > budgetMs or heavy :
+            ok = False
+
+    results['budgetMs']     = budgetMs
+    results['withinBudget'] = ok
+    return results
+
+
+def measureStartup( cmdName ) :
+    """
+    Run the p3sub command-line with --help in a new interpreter, using
+    python -X importtime.
+
+    cmdName: the subcommand, or None for the top-level help
+    return: tuple of the return code, the import time and the wall-clock time
+            in milliseconds, and the set of STARTUP_HEAVY_MODULES that were imported
+    """
+    env  = dict( os.environ, PYTHONPATH=os.pathsep.join( sys.path ))
+    argv = [ 'p3sub' ] + ( [ cmdName ] if cmdName else [] ) + [ '--help' ]
+    # The marker separates the interpreter's own imports from those caused by p3sub
+    cmd  = [ sys.executable, '-X', 'importtime', '-c', f'import sys; sys.stderr.write( "p3sub-start\\n" ); sys.argv={ argv }; import p3sub; p3sub.run()' ]
+
+    start = time.perf_counter()
+    proc  = subprocess.run( cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env )
+    wall  = ( time.perf_counter() - start ) * 1000.0
+
+    importUs = 0
+    heavy    = set()
+    stderr   = proc.stderr.decode()
+    for line in stderr[ max( 0, stderr.find( 'p3sub-start\n' )) : ].splitlines() :
+        # import time: self [us] | cumulative | imported package
+        m = re.match( r'import time:\s+\d+\s+\|\s+(\d+)\s+\|( +)(\S+)$', line )
+        if m is None :
+            continue
+        if len( m.group( 2 )) == 1 : # top-level import
+            importUs += int( m.group( 1 ))
+        for heavyModule in STARTUP_HEAVY_MODULES :
+            if m.group( 3 ) == heavyModule or m.group( 3 ).startswith( heavyModule + '.' ) :
+                heavy.add( heavyModule )
+
+    return ( proc.returncode, importUs / 1000.0, wall, heavy )
+
+
+def timePerOp( f, ops ) :
+    """
+    Run f, and return the elapsed time in microseconds per operation.
+    """
+    start = time.perf_counter()
+    f()
+    return ( time.perf_counter() - start ) * 1000000.0 / ops if ops else None
+
+
+def referenceStringToTs( s ) :
+    return datetime.strptime( s, '%Y-%m-%dT%H:%M:%S.%f%z' )
+
+
+def referenceTsToString( ts ) :
+    return ts.strftime( '%Y-%m-%dT%H:%M:%S.%fZ' )
+
+
+def referenceLinkHeaderPars( header ) :
+    ret = {}
+    for v in header.get_all( 'link' ) :
+        for v2 in v.split( ',' ) :
+            semi = v2.find( ';' )
+            if semi < 0 :
+                continue
+
+            url = v2[0:semi].strip()
+            par = v2[semi+1:].strip()
+            if url.startswith( '<' ) :
+                url = url[1:]
+            if url.endswith( '>' ) :
+                url = url[0:-1]
+
+            m = re.fullmatch( 'rel="([^"]+)"', par )
+            if m :
+                ret[m.group(1)] = url
+    return ret
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+#
+# Run a local load-testing benchmark
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from p3sub.watchers import WATCHERS
+
+
+def run( args, remainder ) :
+    """
+    Run this command.
+    """
+    # only import what's needed to run, not for --help
+    from p3sub.benchmark import Benchmark, RelayBenchmark, runMicroBenchmarks, runStartupBenchmark
+    from tempfile import TemporaryDirectory
+    import ubos.utils
+
+    if args.startup :
+        results = runStartupBenchmark( args.budget )
+
+    elif args.micro :
+        results = runMicroBenchmarks( args.elements, args.seed )
+
+    elif args.relays :
+        childArgs = [ '--logConfig', args.logConfig ] if args.logConfig else []
+        with TemporaryDirectory( prefix='p3sub-bench-' ) as workDir :
+            bench   = RelayBenchmark( workDir, args.subscribers, args.elements, args.size, args.rate, args.port, args.seed, args.timeout, args.relays, childArgs )
+            results = bench.run()
+
+    else :
+        with TemporaryDirectory( prefix='p3sub-bench-' ) as workDir :
+            bench   = Benchmark( workDir, args.subscribers, args.elements, args.size, args.rate, args.port, args.seed, args.timeout, args.direct, args.watcher )
+            results = bench.run()
+
+    if args.json :
+        ubos.utils.writeJsonToStdout( results )
+    else :
+        print( ubos.utils.dictAsColumns( results, lambda v : 'n/a' if v is None else ( '%.6f' % v if isinstance( v, float ) else str( v ))), end='' )
+
+    if args.startup :
+        return 0 if results['withinBudget'] else 1
+    if not args.micro and results['delivered'] < results['expected'] :
+        return 1
+    return 0
+
+
+def addSubParser( parentParser, cmdName ) :
+    """
+    Enable this command to add its own command-line options
+    parentParser: the parent argparse parser
+    cmdName: name of this command
+    """
+    parser = parentParser.add_parser( cmdName,           help='Run a local publisher/subscriber load-testing benchmark.' )
+    parser.add_argument('--subscribers', default=4,      type=int,   help='Number of local subscribers.' )
+    parser.add_argument('--elements',    default=100,    type=int,   help='Number of feed elements to publish.' )
+    parser.add_argument('--size',        default=1024,   type=int,   help='Size of each feed element, in bytes.' )
+    parser.add_argument('--rate',        default=50.0,   type=float, help='Elements published per second; 0 for as fast as possible.' )
+    parser.add_argument('--port',        default=18945,  type=int,   help='Port of the publisher; subscribers use the ports following it.' )
+    parser.add_argument('--seed',        default=0,      type=int,   help='Seed for generating element content.' )
+    parser.add_argument('--timeout',     default=60.0,   type=float, help='Maximum number of seconds to wait for delivery.' )
+    parser.add_argument('--direct',      action='store_const', const=True, help='Publish through the publisher\'s API instead of the feed directory.' )
+    parser.add_argument('--watcher',     default='auto', choices=WATCHERS, help='How the publisher detects changes to the feed directory.' )
+    parser.add_argument('--relays',      default=0,      type=int,   help='Instead, run publisher, relays and subscribers as separate processes, with 1 up to this many relays of --subscribers subscribers each.' )
+    parser.add_argument('--micro',       action='store_const', const=True, help='Instead, run micro-benchmarks of hot-path helpers, with --elements iterations.' )
+    parser.add_argument('--startup',     action='store_const', const=True, help='Instead, check how long the command-line takes to start up.' )
+    parser.add_argument('--budget',      default=50.0,   type=float, help='With --startup, fail if importing takes longer than this many milliseconds.' )
+    parser.add_argument('--json',        action='store_const', const=True, help='Emit results as JSON.' )
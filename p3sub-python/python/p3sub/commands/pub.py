@@ -8,7 +8,7 @@
 from argparse import ArgumentTypeError
 from os import makedirs
 from os.path import isdir
-from p3sub.publisher import Publisher
+from p3sub.watchers import WATCHERS
 from urllib.parse import urlparse
 
 
@@ -16,11 +16,19 @@ def run( args, remainder ) :
     """
     Run this command.
     """
+    from p3sub.publisher import Publisher # only import what's needed to run, not for --help
 
     if not isdir( args.feed_directory ) :
         makedirs( args.feed_directory )
 
-    sub = Publisher( args.listen, args.feed_directory )
+    publishToken = None
+    if args.publish_token_file :
+        with open( args.publish_token_file ) as f :
+            publishToken = f.read().strip()
+        if not publishToken :
+            raise ArgumentTypeError( f"Empty publish token file: { args.publish_token_file }" )
+
+    sub = Publisher( args.listen, args.feed_directory, publishToken, args.watcher )
     sub.run()
 
 
@@ -34,6 +42,9 @@ def addSubParser( parentParser, cmdName ) :
     parser.add_argument('--listen',           default=urlparse( "http://localhost:8945/feed" ), type=httpUrlOnly,
                                                               help='HTTP URL at which to serve the feed.' )
     parser.add_argument('--feed-directory',   default="feed", help='Directory that holds the feed content' )
+    parser.add_argument('--watcher',          default='auto', choices=WATCHERS,
+                                                              help='How to detect changes to the feed directory.' )
+    parser.add_argument('--publish-token-file',               help='Accept new elements POSTed or PUT to the feed URL plus /pub, if authorized with the bearer token in this file' )
 
 
 
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+#
+# Run a relay
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from os import makedirs
+from os.path import isdir
+from p3sub.commands.pub import httpUrlOnly
+from p3sub.commands.sub import httpUrl, validTs
+from p3sub.watchers import WATCHERS
+from urllib.parse import urlparse
+
+
+def run( args, remainder ) :
+    """
+    Run this command.
+    """
+    from p3sub.relay import Relay # only import what's needed to run, not for --help
+
+    if not isdir( args.feed_directory ) :
+        makedirs( args.feed_directory )
+
+    relay = Relay( args.listen, args.callback, args.feed_directory, args.feeduri, args.from_ts, args.watcher )
+
+    err = relay.run()
+    if err :
+        print( f"ERROR: {err}" )
+        return 1
+    return 0
+
+
+def addSubParser( parentParser, cmdName ) :
+    """
+    Enable this command to add its own command-line options
+    parentParser: the parent argparse parser
+    cmdName: name of this command
+    """
+    parser = parentParser.add_parser( cmdName,                help='Relay a p3sub feed to more subscribers.' )
+    parser.add_argument('--listen',           default=urlparse( "http://localhost:8947/feed" ), type=httpUrlOnly,
+                                                              help='HTTP URL at which to serve the relayed feed.' )
+    parser.add_argument('--callback',         default=urlparse( "http://localhost:8948/" ), type=httpUrlOnly,
+                                                              help='HTTP URL at which to receive elements from the upstream feed.' )
+    parser.add_argument('--feed-directory',   default="relay", help='Directory that holds the relayed feed content' )
+    parser.add_argument('--watcher',          default='auto', choices=WATCHERS,
+                                                              help='How to detect changes to the feed directory.' )
+    parser.add_argument('--from-ts',          type=validTs,   help='Relay elements after this timestamp; defaults to continuing where the relay left off' )
+    parser.add_argument('feeduri',            type=httpUrl,   help='URI of the upstream feed.' )
@@ -9,7 +9,6 @@ from argparse import ArgumentTypeError
 from os import makedirs
 from os.path import isdir
 from p3sub.utils import *
-from p3sub.subscriber import SubscribingSubscriber, PassiveSubscriber
 from urllib.parse import urlparse
 
 
@@ -17,6 +16,8 @@ def run( args, remainder ) :
     """
     Run this command.
     """
+    from p3sub.subscriber import SubscribingSubscriber, PassiveSubscriber # only import what's needed to run, not for --help
+
     if args.subscriptionid :
         if args.feeduri :
             raise ArgumentTypeError( "Specify feeduri or subscriptionid, not both" )
@@ -5,6 +5,7 @@
 P3SUB_PAR_TS       = 'p3sub-ts'
 P3SUB_PAR_SUBID    = 'p3sub-subid'
 P3SUB_PAR_CALLBACK = 'p3sub-callback'
+P3SUB_PAR_NAME     = 'p3sub-name'
 
 P3SUB_REL_CANONICAL = 'canonical'
 P3SUB_REL_NEXT      = 'next'
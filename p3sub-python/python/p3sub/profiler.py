@@ -0,0 +1,137 @@
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from collections import Counter
+from os.path import basename
+from tempfile import gettempdir
+import os
+import signal
+import sys
+import threading
+import time
+
+
+PROFILER_SIGNAL = signal.SIGUSR2
+
+_profileDirectory = None # None: the system's temp directory
+_profiler         = None # the SamplingProfiler while profiling is on
+
+
+class SamplingProfiler :
+    """
+    Periodically samples the stacks of all threads of this process, and
+    tracks memory allocations with tracemalloc, until stopped. Unlike cProfile,
+    this sees all threads, including those that were started earlier.
+    """
+    def __init__( self, interval=0.005 ) :
+        """
+        interval: seconds between samples
+        """
+        self.theInterval = interval
+        self.theStacks   = Counter() # collapsed stack -> number of samples
+        self.theStop     = threading.Event()
+        self.theThread   = threading.Thread( target=self.sample, name='p3sub-profiler', daemon=True )
+
+
+    def start( self ) :
+        import tracemalloc # only when needed
+
+        tracemalloc.start( 16 )
+        self.theThread.start()
+
+
+    def stop( self, directory ) :
+        """
+        Stop profiling, and write the results.
+
+        directory: the directory to write the results into
+        return: tuple of the names of the written collapsed-stacks and tracemalloc snapshot files
+        """
+        import tracemalloc
+
+        self.theStop.set()
+        self.theThread.join()
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        prefix = f'{ directory }/p3sub-{ os.getpid() }-{ time.strftime( "%Y%m%d-%H%M%S" ) }'
+
+        # Format understood by flamegraph.pl, speedscope and the like
+        stacksFile = prefix + '.collapsed'
+        with open( stacksFile, 'w' ) as f :
+            for stack, count in sorted( self.theStacks.items() ) :
+                f.write( f'{ stack } { count }\n' )
+
+        # Load with tracemalloc.Snapshot.load()
+        snapshotFile = prefix + '.tracemalloc'
+        snapshot.dump( snapshotFile )
+
+        return ( stacksFile, snapshotFile )
+
+
+    def sample( self ) :
+        me = threading.get_ident()
+        while not self.theStop.wait( self.theInterval ) :
+            names = { t.ident : t.name for t in threading.enumerate() }
+            for ident, frame in sys._current_frames().items() :
+                if ident == me :
+                    continue
+
+                stack = []
+                while frame is not None :
+                    code = frame.f_code
+                    stack.append( f'{ code.co_name }@{ basename( code.co_filename ) }:{ code.co_firstlineno }' )
+                    frame = frame.f_back
+
+                stack.append( names.get( ident, str( ident )).replace( ' ', '_' ))
+                stack.reverse()
+                self.theStacks[ ';'.join( stack ) ] += 1
+
+
+def configureProfiler( directory ) :
+    """
+    Configure where to write profiling results.
+
+    directory: the directory, or None for the system's temp directory
+    """
+    global _profileDirectory
+
+    _profileDirectory = directory
+
+
+def installProfilerToggle() :
+    """
+    Let PROFILER_SIGNAL start and stop profiling of this process. Until the
+    signal is received, this costs nothing. Only possible from the main thread,
+    e.g. not when running inside the benchmark.
+
+    return: True if installed
+    """
+    if threading.current_thread() is not threading.main_thread() :
+        return False
+
+    signal.signal( PROFILER_SIGNAL, lambda signum, frame : toggleProfiler() )
+    return True
+
+
+def toggleProfiler() :
+    """
+    Start profiling if it is off; stop it and write the results if it is on.
+
+    return: tuple of the names of the written files, or None if profiling was started
+    """
+    global _profiler
+
+    if _profiler is None :
+        _profiler = SamplingProfiler()
+        _profiler.start()
+        print( f'INFO: Profiling process { os.getpid() } -- send signal { PROFILER_SIGNAL.name } again to stop' )
+        return None
+
+    directory = _profileDirectory or gettempdir()
+    ret       = _profiler.stop( directory )
+    _profiler = None
+    print( f'INFO: Profiling stopped, results written to { ret[0] } and { ret[1] }' )
+    return ret
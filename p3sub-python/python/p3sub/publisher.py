@@ -2,90 +2,151 @@
 # Copyright (C) Johannes Ernst. All rights reserved. License: see package.
 #
 
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
-from datetime import timezone
 from functools import partial
+from hmac import compare_digest
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from os import listdir
-from os.path import isfile, getmtime
+from io import BytesIO
+from os import getpid, link, listdir, makedirs, unlink, utime
+from os.path import dirname, isfile, normpath
 from p3sub.defs import *
+from p3sub.profiler import installProfilerToggle
 from p3sub.utils import *
-from threading import Event, Lock, Thread
+from p3sub.watchers import createWatcher
+from threading import Event, get_ident, Lock, RLock, Thread
+import ubos.logging
 from urllib.parse import urlparse, urlunparse
 from urllib.request import urlopen, Request
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
 
+MAX_PUBLISH_LENGTH = 64 * 1024 * 1024 # larger elements POSTed or PUT to the publish path are rejected without reading them
 
-class Publisher :
-    def __init__( self, listenUri, feedDirectory ) :
-        self.theFeedDirectory = PublisherFeedDirectory( feedDirectory )
 
+class Publisher :
+    def __init__( self, listenUri, feedDirectory, publishToken=None, watcher='auto', maxPublishLength=MAX_PUBLISH_LENGTH ) :
+        """
+        listenUri: the URL at which to serve the feed
+        feedDirectory: the directory that holds the feed elements
+        publishToken: if given, elements may also be published by POSTing or
+                      PUTting them to the publish path, with this bearer token
+        watcher: how to watch the feed directory for changes, see p3sub.watchers.WATCHERS
+        maxPublishLength: maximum size in bytes of an element POSTed or PUT to the publish path
+        """
         ( self.theWsHost, self.theWsPort ) = listenUri.netloc.split( ':', 2 )
-        self.theWsPort          = int( self.theWsPort )
-        self.theFeedPath        = listenUri.path
-        self.theSubscribePath   = self.theFeedPath + '/sub'
-        self.theUnsubscribePath = self.theFeedPath + '/unsub'
-        self.theSubscriptions   = {} # subId -> { uri, lastTsEnqueued }
-
-        self.theFeedAndSubscriptionsLock = Lock() # avoid concurrent modifications
+        self.theWsPort           = int( self.theWsPort )
+        self.theFeedPath         = listenUri.path
+        self.theSubscribePath    = self.theFeedPath + '/sub'
+        self.theUnsubscribePath  = self.theFeedPath + '/unsub'
+        self.thePublishPath      = self.theFeedPath + '/pub'
+        self.thePublishToken     = publishToken
+        self.theMaxPublishLength = maxPublishLength
+        self.theWatcherKind      = watcher
+        self.theSubscriptions    = PublisherSubscriptions()
+
+        self.theFeedDirectory = PublisherFeedDirectory( feedDirectory, self.theFeedPath, self.theSubscribePath, self.theUnsubscribePath )
+
+        self.theRoutes = RouteTable()
+        self.theRoutes.add( 'GET',  self.theFeedPath,        self.feedRequestReceived )
+        self.theRoutes.add( 'POST', self.theSubscribePath,   self.subscribeRequestReceived )
+        self.theRoutes.add( 'POST', self.theUnsubscribePath, self.unsubscribeRequestReceived )
+        if publishToken :
+            self.theRoutes.add( 'POST', self.thePublishPath, self.publishRequestReceived )
+            self.theRoutes.add( 'PUT',  self.thePublishPath, self.publishRequestReceived )
+
+        self.theSender    = None
+        self.theWebServer = None
+        self.theWatcher   = None
 
 
     def run( self ) :
         """
         Run the publisher command.
         """
+        installProfilerToggle()
+
+        self.start()
+        self.serve()
 
+
+    def start( self ) :
+        """
+        Start sending, listening and watching the feed directory, but do not
+        serve requests yet. Runs in the calling thread, so failures, e.g.
+        because the port is in use, are raised to the caller; whatever was
+        started already is stopped again.
+        """
         # thread that sends messages out
         self.theSender = PublisherSender( self )
         self.theSender.start()
 
-        # run a web server
-        ws = PublisherWebServer( ( self.theWsHost, self.theWsPort ), self )
-
-        # observe the feed directory
-        observer = Observer()
-        observer.schedule( ObserverEventHandler( self.theFeedDirectory, self ), self.theFeedDirectory.getDirectory(), recursive=False)
-        observer.start()
+        try :
+            # run a web server
+            self.theWebServer = PublisherWebServer( ( self.theWsHost, self.theWsPort ), self )
+
+            # observe the feed directory
+            self.theWatcher = createWatcher( self.theWatcherKind, self )
+            self.theWatcher.start()
+
+        except :
+            if self.theWebServer is not None :
+                self.theWebServer.server_close()
+                self.theWebServer = None
+            self.theWatcher = None
+            self.theSender.stop()
+            self.theSender.join()
+            self.theSender = None
+            raise
 
         print( f"INFO: Serving P3Sub feed at http://{ self.theWsHost }:{self.theWsPort}{ self.theFeedPath } -- ^C to stop" )
 
+
+    def serve( self ) :
+        """
+        Serve requests until interrupted, or stopped from another thread,
+        then clean up. Requires start() to have succeeded.
+        """
         try:
-            ws.serve_forever()
+            self.theWebServer.serve_forever()
         except KeyboardInterrupt:
             pass
 
-        observer.stop()
+        self.theWatcher.stop()
         self.theSender.stop()
-        ws.server_close()
-        observer.join()
+        self.theWebServer.server_close()
         self.theSender.join()
 
 
-    def feedRequestReceived( self, handler ) :
-        ( path, query ) = decodeRequestPath( handler.path )
+    def stop( self ) :
+        """
+        Stop a publisher that is running in another thread. Returns once
+        the web server has stopped serving; run() then cleans up.
+        """
+        self.theWebServer.shutdown()
+
+
+    @ubos.logging.timed( 'p3sub.publisher.feedRequestReceived' )
+    def feedRequestReceived( self, handler, query ) :
         if P3SUB_PAR_TS in query :
-            ts = stringToTs( query[P3SUB_PAR_TS] )
+            ts = stringToNs( query[P3SUB_PAR_TS] )
         else :
             ts = None
 
+        feed = self.theFeedDirectory.snapshot()
         if ts :
-            elWithBeforeAfter = self.theFeedDirectory.elementAtWithBeforeAfter( ts )
+            elWithBeforeAfter = feed.elementAtWithBeforeAfter( ts )
         else :
-            elWithBeforeAfter = self.theFeedDirectory.currentElementWithBeforeAfter()
+            elWithBeforeAfter = feed.currentElementWithBeforeAfter()
 
         if elWithBeforeAfter is None:
             return "No such element.\n"
 
         else :
+            links = feed.linksFor( elWithBeforeAfter[1] )
+
             handler.send_response( 200 )
             handler.send_header( "Content-type", "text/plain" )
-            handler.send_header( "link", f'<{ self.theFeedPath }?{ P3SUB_PAR_TS }={ tsToString( elWithBeforeAfter[1].mtime ) }>; rel="{ P3SUB_REL_CANONICAL }"' );
-            handler.send_header( "link", f'<{ self.theSubscribePath }>; rel="{ P3SUB_REL_SUBSCRIBE }"' );
-            if elWithBeforeAfter[0] is not None :
-                handler.send_header( "link", f'<{ self.theFeedPath }?{ P3SUB_PAR_TS }={ tsToString( elWithBeforeAfter[0].mtime ) }>; rel="{ P3SUB_REL_PREV }"' );
-            if elWithBeforeAfter[2] is not None :
-                handler.send_header( "link", f'<{ self.theFeedPath }?{ P3SUB_PAR_TS }={ tsToString( elWithBeforeAfter[2].mtime ) }>; rel="{ P3SUB_REL_NEXT }"' );
+            for link in links.feedLinks :
+                handler.send_header( "link", link )
             handler.end_headers()
             with open( elWithBeforeAfter[1].name, 'rb' ) as f :
                 for fBlock in iter( partial( f.read, 1024 ), b'' ) :
@@ -93,43 +154,39 @@ class Publisher :
         return None
 
 
-    def subscribeRequestReceived( self, handler ) :
+    def subscribeRequestReceived( self, handler, query ) :
         postData = formFields( handler )
+        if postData is None :
+            return 'POSTed data for subscribe request is too long'
 
-        if P3SUB_PAR_SUBID not in postData :
+        subId = postData.getAll( P3SUB_PAR_SUBID )
+        if not subId :
             return f'No { P3SUB_PAR_SUBID } in POSTed data for subscribe request'
-        subId = postData[P3SUB_PAR_SUBID]
-        if type( subId ) is list :
-            if len( subId ) > 1 :
-                return f'Too many { P3SUB_PAR_SUBID } in POSTed data for subscribe request'
-            subId = subId[0]
+        if len( subId ) > 1 :
+            return f'Too many { P3SUB_PAR_SUBID } in POSTed data for subscribe request'
+        subId = subId[0]
         if len( subId ) < 32 :
             return f'Parameter { P3SUB_PAR_SUBID } must have a value of at least 32 characters'
 
-        if P3SUB_PAR_CALLBACK not in postData :
+        callback = postData.getAll( P3SUB_PAR_CALLBACK )
+        if not callback :
             return f'No { P3SUB_PAR_CALLBACK } in POSTed data for subscribe request'
-        callback = postData[P3SUB_PAR_CALLBACK]
-        if type( callback ) is list :
-            if len( callback ) > 1 :
-                return f'Too many { P3SUB_PAR_CALLBACK } in POSTed data for subscribe request'
-            callback = callback[0]
+        if len( callback ) > 1 :
+            return f'Too many { P3SUB_PAR_CALLBACK } in POSTed data for subscribe request'
+        callback    = callback[0]
         callbackUri = urlparse( callback )
         if not callbackUri.scheme:
             return f'Not a valid callback URI: { urlunparse( callback ) }'
 
-        if P3SUB_PAR_TS in postData:
-            fromTs = postData[P3SUB_PAR_TS]
-            if type( fromTs ) is list :
-                if len( fromTs ) > 1 :
-                    return f'Too many { P3SUB_PAR_TS } in POSTed data for subscribe request'
-                fromTs = fromTs[0]
-            fromTs = stringToTs( fromTs )
+        fromTs = postData.getAll( P3SUB_PAR_TS )
+        if fromTs :
+            if len( fromTs ) > 1 :
+                return f'Too many { P3SUB_PAR_TS } in POSTed data for subscribe request'
+            fromTs = stringToNs( fromTs[0] )
         else :
-            fromTs = datetime.now( timezone.utc )
+            fromTs = nowNs()
 
-        self.theFeedAndSubscriptionsLock.acquire()
-        self.theSubscriptions[ subId ] = PublisherSubscription( callbackUri, fromTs )
-        self.theFeedAndSubscriptionsLock.release()
+        self.theSubscriptions.put( subId, PublisherSubscription( callbackUri, fromTs ))
 
         self.theSender.triggerPotentialSend()
 
@@ -142,21 +199,19 @@ class Publisher :
         return None
 
 
-    def unsubscribeRequestReceived( self, handler ) :
+    def unsubscribeRequestReceived( self, handler, query ) :
         postData = formFields( handler )
-        if P3SUB_PAR_SUBID not in postData :
-            return f'No { P3SUB_PAR_SUBID } in POSTed data for unsubscribe request'
-        subId = postData[P3SUB_PAR_SUBID]
-        if type( subId ) is list :
-            if len( subId ) > 1 :
-                return f'Too many { P3SUB_PAR_SUBID } in POSTed data for subscribe request'
-            subId = subId[0]
+        if postData is None :
+            return 'POSTed data for unsubscribe request is too long'
 
-        if subId in self.theSubscriptions :
-            self.theFeedAndSubscriptionsLock.acquire()
-            del self.theSubscriptions[ subId ]
-            self.theFeedAndSubscriptionsLock.release()
+        subId = postData.getAll( P3SUB_PAR_SUBID )
+        if not subId :
+            return f'No { P3SUB_PAR_SUBID } in POSTed data for unsubscribe request'
+        if len( subId ) > 1 :
+            return f'Too many { P3SUB_PAR_SUBID } in POSTed data for subscribe request'
+        subId = subId[0]
 
+        if self.theSubscriptions.remove( subId ) :
             handler.send_response( 200 )
             handler.send_header( "Content-type", "text/plain" )
             handler.send_header( "link", f'<{ self.theSubscribePath }>; rel="{ P3SUB_REL_SUBSCRIBE }"' );
@@ -168,79 +223,187 @@ class Publisher :
             return f"No subscription found with { P3SUB_PAR_SUBID }={ subId }.\n"
 
 
-    def getRequestReceived( self, handler ) :
-        ( path, query ) = decodeRequestPath( handler.path )
-        if path == self.theFeedPath :
-            ret = self.feedRequestReceived( handler )
-        else :
-            ret = 1
-        return ret
+    def publishRequestReceived( self, handler, query ) :
+        auth = handler.headers.get( 'authorization', '' )
+        if not auth.startswith( 'Bearer ' ) or not compare_digest( auth[7:].strip().encode(), self.thePublishToken.encode() ) :
+            handler.send_response( 401 )
+            handler.send_header( "Content-type", "text/plain" )
+            handler.send_header( "WWW-Authenticate", "Bearer" )
+            handler.end_headers()
+            handler.wfile.write( bytes( "Not authorized to publish.\n", "utf-8" ))
+            return None
 
+        try :
+            length = int( handler.headers['content-length'] )
+        except ( TypeError, ValueError ) :
+            return 'Content-Length required to publish'
 
-    def postRequestReceived( self, handler ) :
-        ( path, query ) = decodeRequestPath( handler.path )
-        if path == self.theSubscribePath :
-            ret = self.subscribeRequestReceived( handler )
-        elif path == self.theUnsubscribePath :
-            ret = self.unsubscribeRequestReceived( handler )
-        else :
-            ret = 1
-        return ret
+        if length > self.theMaxPublishLength :
+            handler.send_response( 413 )
+            handler.send_header( "Content-type", "text/plain" )
+            handler.end_headers()
+            handler.wfile.write( bytes( f"Element too large, at most { self.theMaxPublishLength } bytes.\n", "utf-8" ))
+            return None
 
+        try :
+            tsString = self.publishStream( handler.rfile, length, query.get( P3SUB_PAR_NAME ))
+        except ValueError as e :
+            return str( e )
+
+        handler.send_response( 200 )
+        handler.send_header( "Content-type", "text/plain" )
+        handler.send_header( "link", f'<{ self.theFeedPath }?{ P3SUB_PAR_TS }={ tsString }>; rel="{ P3SUB_REL_CANONICAL }"' )
+        handler.end_headers()
+        handler.wfile.write( bytes( "Published.\n", "utf-8" ))
+        return None
+
+
+    def publish( self, content, name=None, timestampNs=None ) :
+        """
+        Publish a new element: store it in the feed directory, add it to the
+        index and start delivering it to the subscribers right away, without
+        waiting for the feed directory to be rescanned. Requires start() to
+        have been called. Existing elements are never replaced.
+
+        content: the content of the element, as bytes
+        name: name of the file in the feed directory; defaults to the element's timestamp
+        timestampNs: the element's timestamp, e.g. when mirroring another feed;
+                     defaults to now, but later than that of any element before
+        return: the element's timestamp, as string
+        """
+        return self.publishStream( BytesIO( content ), len( content ), name, timestampNs )
 
-    def processQueue( self ) :
-        self.theFeedAndSubscriptionsLock.acquire()
 
-        updatedSubscriptions = {}
-        for subId in self.theSubscriptions :
-            subData = self.theSubscriptions[ subId ]
+    def publishStream( self, stream, length, name=None, timestampNs=None ) :
+        """
+        Like publish, but read the content from a stream.
+
+        stream: the stream to read the content from
+        length: the number of bytes to read from the stream
+        name: name of the file in the feed directory; defaults to the element's timestamp
+        timestampNs: the element's timestamp, e.g. when mirroring another feed;
+                     defaults to now, but later than that of any element before
+        return: the element's timestamp, as string
+        """
+        if self.theSender is None :
+            raise Exception( 'Cannot publish before the publisher has been started' )
+        if name is not None and ( not name or '/' in name or name.startswith( '.' )) :
+            raise ValueError( f'Invalid name for a feed element: { name }' )
+        if length < 0 :
+            raise ValueError( f'Invalid length for a feed element: { length }' )
+
+        feedDirectory = self.theFeedDirectory.getDirectory()
+        stagingDir    = feedDirectory + '/.p3sub-staging' # not watched, as watchers are non-recursive
+        makedirs( stagingDir, exist_ok=True )
+
+        staged = f'{ stagingDir }/{ getpid() }-{ get_ident() }.tmp' # one at a time per thread
+        try :
+            with open( staged, 'wb' ) as f :
+                while length > 0 :
+                    buf = stream.read( min( length, 65536 ))
+                    if not buf :
+                        raise ValueError( 'Content ended prematurely' )
+                    f.write( buf )
+                    length -= len( buf )
+
+            self.theFeedDirectory.theLock.acquire()
+            try :
+                if timestampNs is None :
+                    # the feed is ordered by mtime at microsecond resolution, so make sure this one is later
+                    newMtimeNs = max( nowNs(), self.theFeedDirectory.snapshot().lastMtimeNs() + 1000 )
+                else :
+                    newMtimeNs = timestampNs // 1000 * 1000
+                utime( staged, ns=( newMtimeNs, newMtimeNs ))
 
-            ( previous, toSends ) = self.theFeedDirectory.elementsAfterWithBefore( subData.lastSuccessfulTs )
+                final = f'{ feedDirectory }/{ name or nsToString( newMtimeNs ) + ".dat" }'
+                try :
+                    link( staged, final ) # unlike rename, does not replace an element subscribers may have received already
+                except FileExistsError :
+                    raise ValueError( f'Feed element exists already: { final }' )
+
+                self.theFeedDirectory.elementAdded( final )
+            finally :
+                self.theFeedDirectory.theLock.release()
+
+        finally :
+            try :
+                unlink( staged )
+            except FileNotFoundError :
+                pass # could not even be created
+
+        self.theSender.triggerPotentialSend()
+        return nsToString( newMtimeNs )
+
+
+    def requestReceived( self, method, handler ) :
+        return self.theRoutes.dispatch( method, handler )
+
+
+    @ubos.logging.timed( 'p3sub.publisher.processQueue' )
+    def processQueue( self ) :
+        # No locks are held while delivering; changes to the feed or the
+        # subscriptions in the meantime trigger another round
+        feed = self.theFeedDirectory.snapshot()
+
+        for ( subId, subData ) in self.theSubscriptions.snapshot().items() :
+            ( previous, toSends ) = feed.elementsAfterWithBefore( subData.lastSuccessfulTs )
             uri                   = subData.callbackUri
 
             if toSends :
+                # same for all elements sent to this subscriber in this round
+                uriString   = urlunparse( uri ) + '?'
+                subIdString = f'&{ P3SUB_PAR_SUBID }={ subId }'
+                lastSentTs  = None
+
                 for i in range( 0, len( toSends )) :
                     toSend = toSends[i]
 
-                    if self.sendOne( subId, uri, previous.mtime, toSend ) == 0 :
-                        updatedSubscriptions[ subId ] = PublisherSubscription( uri, toSend.mtime )
-                        previous = toSend
+                    try :
+                        status = self.sendOne( uriString, subIdString, feed, toSend )
+                    except OSError : # also URLError and HTTPError; must not end the sender thread
+                        status = 1
+
+                    if status == 0 :
+                        lastSentTs = toSend.mtimeNs
                     else :
                         print( f'INFO: Cannot reach {uri}, skipping this subscriber this round' )
                         break
 
-        for subId in updatedSubscriptions :
-            subData = updatedSubscriptions[ subId ]
-            self.theSubscriptions[ subId ] = subData
+                if lastSentTs is not None :
+                    self.theSubscriptions.advance( subId, subData, lastSentTs )
 
-        self.theFeedAndSubscriptionsLock.release()
 
+    @ubos.logging.timed( 'p3sub.publisher.sendOne' )
+    def sendOne( self, uriString, subIdString, feed, current ) :
+        """
+        Send one element to one subscriber.
 
-    def sendOne( self, subId, uri, before, current ) :
-
+        uriString: the subscriber's callback URI, followed by ?
+        subIdString: the subscription id query parameter, preceded by &
+        feed: the PublisherFeedSnapshot that contains the element
+        current: the element to send
+        return: 0 if successful
+        """
         buf = None
-        with open( current.name, 'rb' ) as f:
-            buf = f.read()
+        try :
+            with open( current.name, 'rb' ) as f:
+                buf = f.read()
+        except FileNotFoundError :
+            return 0 # removed since the snapshot was taken, so nothing to deliver
 
         if buf is None:
             print( f"ERROR: could not read file { current.name }" )
             return 1
 
-        # Need to pack into one line, API can't do better
-        linkHeader = f'<{ self.theUnsubscribePath }>; rel="{ P3SUB_REL_UNSUBSCRIBE }"'
-        if before :
-            linkHeader += f', <{ self.theFeedPath }?{ P3SUB_PAR_TS }={ tsToString( before ) }>; rel="{ P3SUB_REL_PREV }"'
+        links = feed.linksFor( current )
 
         headers = {
             'content-type'   : 'application/octet-stream',
             'content-length' : len( buf ),
-            'link'           : linkHeader
+            'link'           : links.pushLink
         }
-        uriString = urlunparse( uri )
-        uriString += f'?{ P3SUB_PAR_TS }={ tsToString( current.mtime ) }'
-        uriString += f'&{ P3SUB_PAR_SUBID }={ subId }'
 
-        response = urlopen( Request( uriString, headers=headers, data=buf, method='PUT' ) )
+        response = urlopen( Request( uriString + links.tsQuery + subIdString, headers=headers, data=buf, method='PUT' ) )
         if response.status == 200 :
             return 0
         else :
@@ -248,9 +411,76 @@ class Publisher :
 
 
 class PublisherSubscription( namedtuple( 'PublisherSubscription', [ 'callbackUri', 'lastSuccessfulTs' ] )) :
+    """
+    lastSuccessfulTs is in nanoseconds since the epoch, like the mtimes in the feed index.
+    """
     pass
 
 
+class PublisherSubscriptions :
+    """
+    The table of subscriptions, independent of the feed index. Like the
+    index, it is published as an immutable dict that writers replace while
+    holding theLock, so the sender can iterate over it without locking.
+    """
+    def __init__( self ) :
+        self.theSubscriptions = {} # subId -> PublisherSubscription; never modified once published
+        self.theLock          = Lock()
+
+
+    def snapshot( self ) :
+        """
+        return: the current dict of subId to PublisherSubscription, which must not be modified
+        """
+        return self.theSubscriptions
+
+
+    def put( self, subId, subscription ) :
+        self.theLock.acquire()
+        try :
+            subscriptions          = dict( self.theSubscriptions )
+            subscriptions[ subId ] = subscription
+            self.theSubscriptions  = subscriptions
+        finally :
+            self.theLock.release()
+
+
+    def remove( self, subId ) :
+        """
+        return: True if there was a subscription with this subId
+        """
+        self.theLock.acquire()
+        try :
+            if subId not in self.theSubscriptions :
+                return False
+
+            subscriptions = dict( self.theSubscriptions )
+            del subscriptions[ subId ]
+            self.theSubscriptions = subscriptions
+            return True
+        finally :
+            self.theLock.release()
+
+
+    def advance( self, subId, subscription, lastSuccessfulTs ) :
+        """
+        Record delivery up to lastSuccessfulTs, unless the subscription has
+        been removed or replaced since it was read.
+
+        subId: the subscription id
+        subscription: the PublisherSubscription as it was read before delivery
+        lastSuccessfulTs: mtime of the last element delivered
+        """
+        self.theLock.acquire()
+        try :
+            if self.theSubscriptions.get( subId ) is subscription :
+                subscriptions          = dict( self.theSubscriptions )
+                subscriptions[ subId ] = PublisherSubscription( subscription.callbackUri, lastSuccessfulTs )
+                self.theSubscriptions  = subscriptions
+        finally :
+            self.theLock.release()
+
+
 class PublisherWebServer( HTTPServer ) :
     """
     The default HTTPServer instantiates request handlers entirely without
@@ -266,7 +496,7 @@ class PublisherWebServer( HTTPServer ) :
 class PublisherRequestHandler( BaseHTTPRequestHandler ) :
     def do_GET( self ):
         try :
-            self.complete( self.server.thePublisher.getRequestReceived( self ))
+            self.complete( self.server.thePublisher.requestReceived( 'GET', self ))
         except BaseException as ex:
             self.complete( 'An internal error occurred: ' + str( ex ))
             raise
@@ -274,7 +504,15 @@ class PublisherRequestHandler( BaseHTTPRequestHandler ) :
 
     def do_POST( self ):
         try :
-            self.complete( self.server.thePublisher.postRequestReceived( self ))
+            self.complete( self.server.thePublisher.requestReceived( 'POST', self ))
+        except BaseException as ex:
+            self.complete( 'An internal error occurred: ' + str( ex ))
+            raise
+
+
+    def do_PUT( self ):
+        try :
+            self.complete( self.server.thePublisher.requestReceived( 'PUT', self ))
         except BaseException as ex:
             self.complete( 'An internal error occurred: ' + str( ex ))
             raise
@@ -290,103 +528,283 @@ class PublisherRequestHandler( BaseHTTPRequestHandler ) :
 
 
 class PublisherFeedDirectory :
-    def __init__( self, directory ) :
-        self.theDirectory          = directory;
-        self.theElementsInSequence = None
+    """
+    The index of the feed elements in the feed directory, in sequence of
+    their mtimes. For each element, the index also holds the encoded
+    timestamp and the Link headers to send with it, so these do not need to
+    be formatted on every request and every delivery.
+
+    The index is published as immutable PublisherFeedSnapshots. Writers hold
+    theLock, build a new snapshot and swap it in; readers take the current
+    snapshot without locking, and see a consistent index for as long as they
+    hold on to it.
+    """
+    def __init__( self, directory, feedPath, subscribePath, unsubscribePath ) :
+        self.theDirectory = normpath( directory ) # so paths match those reported by the watchers
+        self.theSnapshot  = None    # None: build when needed
+        self.theLock      = RLock() # serializes writers; a publisher holds it across deciding on an mtime and adding the element
+
+        # constant parts of the Link headers
+        self.theSubscribeLink   = f'<{ subscribePath }>; rel="{ P3SUB_REL_SUBSCRIBE }"'
+        self.theUnsubscribeLink = f'<{ unsubscribePath }>; rel="{ P3SUB_REL_UNSUBSCRIBE }"'
+        self.theFeedLinkPrefix  = f'<{ feedPath }?{ P3SUB_PAR_TS }='
 
 
     def getDirectory( self ) :
         return self.theDirectory
 
 
+    def snapshot( self ) :
+        """
+        Obtain the current index, building it first if needed.
+
+        return: the PublisherFeedSnapshot
+        """
+        snapshot = self.theSnapshot
+        if snapshot is None :
+            self.theLock.acquire()
+            try :
+                if self.theSnapshot is None :
+                    self.theSnapshot = self.scan()
+                snapshot = self.theSnapshot
+            finally :
+                self.theLock.release()
+
+        return snapshot
+
+
+    @ubos.logging.timed( 'p3sub.publisher.scan' )
+    def scan( self ) :
+        """
+        Build the index from the content of the feed directory.
+
+        return: the PublisherFeedSnapshot
+        """
+        files              = listdir( self.theDirectory )
+        elementsInSequence = []
+
+        for f in files :
+            realF = self.theDirectory + '/' + f
+            if not isfile( realF ) :
+                continue
+
+            elementsInSequence.append( self.createElement( realF ))
+
+        elementsInSequence = sorted( elementsInSequence, key = lambda e : e.mtimeNs )
+
+        linksByName = {}
+        for i in range( 0, len( elementsInSequence )) :
+            linksByName[ elementsInSequence[i].name ] = self.createLinks( elementsInSequence, i )
+
+        return PublisherFeedSnapshot( tuple( elementsInSequence ), linksByName )
+
+
+    def purgeElementsInSequence( self ) :
+        """
+        Forget the index, so it is rebuilt from the feed directory when
+        needed next, e.g. because changes may have been missed.
+        """
+        # like all writers, so a concurrent update cannot swap an outdated index back in
+        self.theLock.acquire()
+        try :
+            self.theSnapshot = None
+        finally :
+            self.theLock.release()
+
+
+    def elementAdded( self, realF ) :
+        """
+        A file has been added to the feed directory, or has been rewritten.
+
+        realF: path of the file
+        """
+        self.elementsChanged( [ realF ], [] )
+
+
+    def elementRemoved( self, realF ) :
+        """
+        A file has been removed from the feed directory.
+
+        realF: path of the file
+        """
+        self.elementsChanged( [], [ realF ] )
+
+
+    def elementsChanged( self, added, removed ) :
+        """
+        A batch of files has been added to, rewritten in, or removed from the
+        feed directory. If we have an index, update a copy of it
+        incrementally, including the Link headers of the neighbors of the
+        changed elements, and swap it in once the whole batch is applied.
+
+        added: paths of the files that were added or rewritten
+        removed: paths of the files that were removed
+        """
+        self.theLock.acquire()
+        try :
+            snapshot = self.theSnapshot
+            if snapshot is None :
+                return # will be picked up when the index is rebuilt
+
+            elementsInSequence = list( snapshot.elementsInSequence )
+            linksByName        = dict( snapshot.linksByName )
+
+            for realF in removed :
+                self.removeFrom( elementsInSequence, linksByName, realF )
+
+            for realF in added :
+                present = isfile( realF )
+                if present :
+                    try :
+                        self.addTo( elementsInSequence, linksByName, realF )
+                    except FileNotFoundError :
+                        present = False # removed again right after it was checked
+                if not present :
+                    self.purgeElementsInSequence()
+                    return
+
+            self.theSnapshot = PublisherFeedSnapshot( tuple( elementsInSequence ), linksByName )
+
+        finally :
+            self.theLock.release()
+
+
+    def addTo( self, elementsInSequence, linksByName, realF ) :
+        """
+        Add an element to a copy of the index that is being updated.
+        """
+        el = self.createElement( realF )
+        if realF in linksByName :
+            i = bisect_left( elementsInSequence, el.mtimeNs, key = lambda e : e.mtimeNs )
+            if i < len( elementsInSequence ) and elementsInSequence[i] == el :
+                return # already indexed, e.g. published through us and now reported by the watcher
+
+            self.removeFrom( elementsInSequence, linksByName, realF )
+
+        i = bisect_right( elementsInSequence, el.mtimeNs, key = lambda e : e.mtimeNs )
+        elementsInSequence.insert( i, el )
+        self.updateLinksAround( elementsInSequence, linksByName, i )
+
+
+    def removeFrom( self, elementsInSequence, linksByName, realF ) :
+        """
+        Remove an element from a copy of the index that is being updated.
+        """
+        if realF not in linksByName :
+            return
+
+        for i in range( 0, len( elementsInSequence )) :
+            if elementsInSequence[i].name == realF :
+                del elementsInSequence[i]
+                del linksByName[realF]
+                self.updateLinksAround( elementsInSequence, linksByName, i )
+                break
+
+
+    def createElement( self, realF ) :
+        elMtimeNs = mtimeNs( realF )
+        return PublisherFeedDirectoryElement( name=realF, mtimeNs=elMtimeNs, tsString=nsToString( elMtimeNs ))
+
+
+    def createLinks( self, elementsInSequence, i ) :
+        """
+        Compute the Link headers for the element at position i.
+        """
+        el        = elementsInSequence[i]
+        feedLinks = [
+            self.theFeedLinkPrefix + el.tsString + f'>; rel="{ P3SUB_REL_CANONICAL }"',
+            self.theSubscribeLink
+        ]
+        # Need to pack into one line for pushing, API can't do better
+        pushLink = self.theUnsubscribeLink
+
+        if i > 0 :
+            prevLink   = self.theFeedLinkPrefix + elementsInSequence[i-1].tsString + f'>; rel="{ P3SUB_REL_PREV }"'
+            feedLinks.append( prevLink )
+            pushLink  += ', ' + prevLink
+
+        if i < len( elementsInSequence ) - 1 :
+            feedLinks.append( self.theFeedLinkPrefix + elementsInSequence[i+1].tsString + f'>; rel="{ P3SUB_REL_NEXT }"' )
+
+        return PublisherFeedElementLinks( feedLinks=feedLinks, pushLink=pushLink, tsQuery=f'{ P3SUB_PAR_TS }={ el.tsString }' )
+
+
+    def updateLinksAround( self, elementsInSequence, linksByName, i ) :
+        """
+        Recompute the Link headers of the elements whose neighbors changed
+        because an element was inserted at, or removed from, position i.
+        """
+        for j in range( max( 0, i-1 ), min( len( elementsInSequence ), i+2 )) :
+            linksByName[ elementsInSequence[j].name ] = self.createLinks( elementsInSequence, j )
+
+
+class PublisherFeedSnapshot( namedtuple( 'PublisherFeedSnapshot', [ 'elementsInSequence', 'linksByName' ] )) :
+    """
+    An immutable state of the feed index. elementsInSequence is a tuple of
+    PublisherFeedDirectoryElements in sequence of their mtimes; linksByName
+    maps element names to their PublisherFeedElementLinks, and must not be
+    modified.
+    """
     def currentElementWithBeforeAfter( self ) :
-        self.ensureElementsInSequence()
-        if len( self.theElementsInSequence ) > 1 :
-            return ( self.theElementsInSequence[-2], self.theElementsInSequence[-1], None )
+        if len( self.elementsInSequence ) > 1 :
+            return ( self.elementsInSequence[-2], self.elementsInSequence[-1], None )
 
-        elif( len( self.theElementsInSequence ) > 0 ) :
-            return ( None, self.theElementsInSequence[-1], None )
+        elif( len( self.elementsInSequence ) > 0 ) :
+            return ( None, self.elementsInSequence[-1], None )
 
         else :
             return None
 
 
     def elementAtWithBeforeAfter( self, ts ) :
-        self.ensureElementsInSequence()
-        # We need to search, as ts may not be exact
-        length = len( self.theElementsInSequence )
-        for i in range( length-1, -1, -1 ) :
-            el = self.theElementsInSequence[i]
-            if el.mtime <= ts :
-                if i>0 :
-                    if i<length-1 :
-                        return ( self.theElementsInSequence[i-1], el, self.theElementsInSequence[i+1] )
-                    else :
-                        return ( self.theElementsInSequence[i-1], el, None )
-                else :
-                    if i<length-1 :
-                        return ( None, el, self.theElementsInSequence[i+1] )
-                    else :
-                        return ( None, el, None )
+        # ts may not be exact: find the last element at or before it
+        i = bisect_right( self.elementsInSequence, ts, key = lambda e : e.mtimeNs ) - 1
+        if i < 0 :
+            return None
 
-        return None
+        before = self.elementsInSequence[i-1] if i > 0 else None
+        after  = self.elementsInSequence[i+1] if i < len( self.elementsInSequence ) - 1 else None
+        return ( before, self.elementsInSequence[i], after )
 
 
     def elementsAfterWithBefore( self, ts ) :
-        self.ensureElementsInSequence()
-        for i in range( 0, len( self.theElementsInSequence )) :
-            el = self.theElementsInSequence[i]
-            if el.mtime <= ts :
-                continue
-
-            if i>0 :
-                return ( self.theElementsInSequence[i-1], self.theElementsInSequence[i:] )
-            else :
-                return ( None, self.theElementsInSequence[i:] )
-        return ( None, None )
-
+        i = bisect_right( self.elementsInSequence, ts, key = lambda e : e.mtimeNs )
+        if i >= len( self.elementsInSequence ) :
+            return ( None, None )
 
-    def ensureElementsInSequence( self ) :
-        if self.theElementsInSequence is None :
-            files              = listdir( self.theDirectory )
-            elementsInSequence = []
+        return ( self.elementsInSequence[i-1] if i > 0 else None, self.elementsInSequence[i:] )
 
-            for f in files :
-                realF = self.theDirectory + '/' + f
-                if not isfile( realF ) :
-                    continue
 
-                elementsInSequence.append( PublisherFeedDirectoryElement( name=realF, mtime=datetime.fromtimestamp( getmtime( realF ), timezone.utc )))
+    def lastMtimeNs( self ) :
+        """
+        Determine the mtime of the most recent element.
 
-            elementsInSequence = sorted( elementsInSequence, key = lambda e : e.mtime )
-            self.theElementsInSequence = elementsInSequence
+        return: the mtime in nanoseconds, or 0 if there are no elements
+        """
+        return self.elementsInSequence[-1].mtimeNs if self.elementsInSequence else 0
 
-        return self.theElementsInSequence
 
+    def linksFor( self, el ) :
+        """
+        Obtain the precomputed Link headers for an element in this snapshot.
 
-    def purgeElementsInSequence( self ) :
-        self.theElementsInSequence = None
+        el: the PublisherFeedDirectoryElement
+        return: the PublisherFeedElementLinks
+        """
+        return self.linksByName[ el.name ]
 
 
-class PublisherFeedDirectoryElement( namedtuple( 'PublisherFeedDirectoryElement', [ 'name', 'mtime' ])) :
+class PublisherFeedDirectoryElement( namedtuple( 'PublisherFeedDirectoryElement', [ 'name', 'mtimeNs', 'tsString' ])) :
     def __str__( self ) :
-        return f"PublisherFeedDirectoryElement( name={ self.name }, mtime={ self.mtime } )"
-
-
-class ObserverEventHandler( FileSystemEventHandler ) :
-    def __init__( self, feedDirectory, publisher ) :
-        super().__init__()
-        self.theFeedDirectory = feedDirectory
-        self.thePublisher     = publisher
-
+        return f"PublisherFeedDirectoryElement( name={ self.name }, mtime={ self.tsString } )"
 
-    def on_any_event( self, event ) :
-        # We take the easy way out
-        self.thePublisher.theFeedAndSubscriptionsLock.acquire()
-        self.theFeedDirectory.purgeElementsInSequence()
-        self.thePublisher.theFeedAndSubscriptionsLock.release()
 
-        self.thePublisher.theSender.triggerPotentialSend()
+class PublisherFeedElementLinks( namedtuple( 'PublisherFeedElementLinks', [ 'feedLinks', 'pushLink', 'tsQuery' ])) :
+    """
+    The Link headers to send when serving an element (feedLinks), or pushing
+    it to a subscriber (pushLink), plus the timestamp query parameter.
+    """
+    pass
 
 
 class PublisherSender( Thread ) :
@@ -406,8 +824,9 @@ class PublisherSender( Thread ) :
         self.theActive = True
         while self.theActive :
             self.theEvent.wait()
-            self.thePublisher.processQueue()
+            # clear first, so triggers arriving during processing are not lost
             self.theEvent.clear()
+            self.thePublisher.processQueue()
 
 
     def stop( self ) :
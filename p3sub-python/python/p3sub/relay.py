@@ -0,0 +1,115 @@
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from p3sub.defs import *
+from p3sub.publisher import Publisher
+from p3sub.subscriber import SubscribingSubscriber, SubscriberPipeline
+from p3sub.utils import *
+from threading import Thread
+from urllib.parse import parse_qs, urlparse, urlunparse
+from urllib.request import urlopen
+
+
+class Relay :
+    """
+    Subscribes to an upstream feed, and re-publishes the elements it
+    receives as a publisher in its own right, with its own subscribers.
+    Elements keep their timestamps, so their prev and next links refer to
+    the same elements upstream and at the relay. Relays can subscribe to
+    other relays, to fan a feed out to more subscribers than a single
+    publisher can serve.
+    """
+    def __init__( self, listenUri, callbackUri, feedDirectory, upstreamFeedUri, fromTs=None, watcher='auto' ) :
+        """
+        listenUri: the URL at which to serve the relayed feed
+        callbackUri: the URL at which to receive elements from upstream
+        feedDirectory: the directory that holds the relayed feed elements
+        upstreamFeedUri: the URL of the feed to relay
+        fromTs: relay elements after this timestamp; defaults to after the
+                last element already relayed, or upstream's current element
+        watcher: how to watch the feed directory for changes, see p3sub.watchers.WATCHERS
+        """
+        self.theUpstreamFeedUri = upstreamFeedUri
+        self.thePublisher       = Publisher( listenUri, feedDirectory, watcher=watcher )
+        self.theSubscriber      = SubscribingSubscriber(
+                callbackUri,
+                None,
+                upstreamFeedUri,
+                False,
+                fromTs,
+                SubscriberPipeline( [ RepublishStage( self.thePublisher ) ], workers=0 )) # stored before acknowledged
+
+
+    def run( self ) :
+        """
+        Run the relay command.
+        """
+        # in this thread, so it is reported if the publisher cannot start
+        self.thePublisher.start()
+
+        publisherThread = Thread( target=self.thePublisher.serve, name='p3sub-relay-publisher' )
+        publisherThread.start()
+
+        try :
+            err = None
+            if self.theSubscriber.theFromTs is None :
+                err = self.determineFromTs()
+            if not err :
+                err = self.theSubscriber.run()
+
+        finally :
+            self.thePublisher.stop()
+            publisherThread.join()
+
+        return err
+
+
+    def determineFromTs( self ) :
+        """
+        Continue after the last element relayed so far. If there is none,
+        start by relaying upstream's current element, so the relayed feed
+        has a current element that subscribers can start from.
+
+        return: None if successful, otherwise error message
+        """
+        lastMtimeNs = self.thePublisher.theFeedDirectory.snapshot().lastMtimeNs()
+        if lastMtimeNs :
+            self.theSubscriber.theFromTs = nsToTs( lastMtimeNs )
+            return None
+
+        response = urlopen( urlunparse( self.theUpstreamFeedUri ))
+        if response.status != 200 :
+            return f"Wrong status. Expected 200, was { response.status }"
+
+        linkRels = linkHeaderPars( response.headers )
+        if P3SUB_REL_CANONICAL not in linkRels :
+            return f"No { P3SUB_REL_CANONICAL } Link header: { urlunparse( self.theUpstreamFeedUri ) }"
+
+        ts = parse_qs( urlparse( linkRels[P3SUB_REL_CANONICAL] ).query ).get( P3SUB_PAR_TS )
+        if not ts :
+            return f"No { P3SUB_PAR_TS } in { P3SUB_REL_CANONICAL } Link header: { linkRels[P3SUB_REL_CANONICAL] }"
+
+        ts = stringToNs( ts[0] )
+        self.thePublisher.publish( response.read(), timestampNs=ts )
+        self.theSubscriber.theFromTs = nsToTs( ts )
+        return None
+
+
+class RepublishStage :
+    """
+    Pipeline stage that publishes each element through a Publisher, with the
+    element's original timestamp. Elements that have been published already
+    are skipped: upstream sends an element again if it did not receive our
+    acknowledgement.
+    """
+    def __init__( self, publisher ) :
+        self.thePublisher = publisher
+
+
+    def __call__( self, element ) :
+        mtimeNs = element.ts // 1000 * 1000
+        found   = self.thePublisher.theFeedDirectory.snapshot().elementAtWithBeforeAfter( mtimeNs )
+        if found is None or found[1].mtimeNs != mtimeNs :
+            self.thePublisher.publish( element.content, timestampNs=element.ts )
+        return element
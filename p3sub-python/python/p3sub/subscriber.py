@@ -3,10 +3,15 @@
 #
 
 
+from collections import namedtuple
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from p3sub.defs import *
+from p3sub.profiler import installProfilerToggle
 from p3sub.utils import *
+from queue import Queue
 from random import randrange
+from threading import Thread
+import ubos.logging
 from urllib.parse import urlencode, urljoin, urlparse, urlunparse
 from urllib.request import urlopen, Request
 
@@ -15,53 +20,77 @@ class BaseSubscriber :
     Abstract superclass for the two types of Subscribers we know.
     """
 
-    def __init__( self, listenUri, feeduri, receivedDir, subId ) :
+    def __init__( self, listenUri, feeduri, receivedDir, subId, pipeline=None ) :
+        """
+        pipeline: the SubscriberPipeline to pass received elements to. If not
+                  given, received elements are stored in receivedDir before
+                  they are acknowledged.
+        """
+        if pipeline is None :
+            pipeline = SubscriberPipeline( [ StoreStage( receivedDir ) ], workers=0 )
+
         self.theFeedUri     = feeduri
         self.theListenUri   = listenUri
         self.theReceivedDir = receivedDir
         self.theSubId       = subId
         self.theUnsubUri    = None # updated every time we receive it
+        self.theWebServer   = None
+        self.thePipeline    = pipeline
 
         ( self.theWsHost, self.theWsPort ) = listenUri.netloc.split( ':', 2 )
         self.theWsPort      = int( self.theWsPort )
         self.theWsPath      = listenUri.path
 
+        self.theRoutes = RouteTable()
+        self.theRoutes.add( 'PUT', self.theWsPath, self.putRequestReceived )
+
 
     def runListen( self ) :
         """
         Enter HTTP listening processing until interrupt
         """
+        installProfilerToggle()
 
-        ws = SubscriberWebServer( ( self.theWsHost, self.theWsPort ), self )
+        self.theWebServer = SubscriberWebServer( ( self.theWsHost, self.theWsPort ), self )
 
         print( f"INFO: Serving P3Sub subscriber endpoint at http://{ self.theWsHost }:{self.theWsPort}{ self.theWsPath } -- ^C to stop" )
 
         try:
-            ws.serve_forever()
+            self.theWebServer.serve_forever()
         except KeyboardInterrupt:
             pass
 
-        ws.server_close()
+        self.theWebServer.server_close()
+        self.thePipeline.close()
 
         return 0
 
 
-    def putRequestReceived( self, handler ) :
+    def stopListen( self ) :
+        """
+        Stop HTTP listening processing that is running in another thread.
+        """
+        self.theWebServer.shutdown()
+
+
+    def requestReceived( self, method, handler ) :
+        ret = self.theRoutes.dispatch( method, handler )
+        return ret
+
+
+    @ubos.logging.timed( 'p3sub.subscriber.putRequestReceived' )
+    def putRequestReceived( self, handler, query ) :
         """
         A PUT request has been received
 
-        @return: true if acceptable
+        @return: None if acceptable, otherwise error message
         """
-        ( path, query ) = decodeRequestPath( handler.path )
         linkRels = linkHeaderPars( handler.headers )
 
-        if path != self.theWsPath :
-            return f"PUT sent to wrong path: { path } vs { self.theWsPath }"
-
         if P3SUB_PAR_TS not in query :
             return f"No { P3SUB_PAR_TS } in URL query"
 
-        ts = stringToTs( query[P3SUB_PAR_TS] )
+        ts = stringToNs( query[P3SUB_PAR_TS] )
 
         if P3SUB_PAR_SUBID not in query :
             return f"No { P3SUB_PAR_SUBID } in URL query"
@@ -81,10 +110,14 @@ class BaseSubscriber :
         self.theUnsubUri = relativeToAbsoluteUrl( self.theFeedUri, urlparse( linkRels[P3SUB_REL_UNSUBSCRIBE] ))
 
         contentLength = int( handler.headers['content-length'] )
+        content       = handler.rfile.read( contentLength )
 
-        with open( f"{self.theReceivedDir}/{ts.strftime( '%Y-%m-%dT%H:%M:%S.%fZ.dat' )}", 'wb' ) as writeTo :
-            buf = handler.rfile.read( contentLength )
-            writeTo.write( buf )
+        try :
+            self.thePipeline.submit( ReceivedElement( ts, content, linkRels, self.theSubId ))
+        except Exception as e :
+            # not acknowledged, so the publisher sends it again
+            ubos.logging.error( 'Processing element', query[P3SUB_PAR_TS], 'failed:', e )
+            return f"Cannot process element { query[P3SUB_PAR_TS] }: { e }"
 
         return None
 
@@ -101,8 +134,8 @@ class SubscribingSubscriber( BaseSubscriber ):
     """
     This version subscribes first and unsubscribes upon quit
     """
-    def __init__( self, listenUri, receivedDir, feeduri, diff, fromTs ) :
-        super().__init__( listenUri, feeduri, receivedDir, None )
+    def __init__( self, listenUri, receivedDir, feeduri, diff, fromTs, pipeline=None ) :
+        super().__init__( listenUri, feeduri, receivedDir, None, pipeline )
 
         self.theDiff   = diff;
         self.theFromTs = fromTs;
@@ -186,8 +219,8 @@ class PassiveSubscriber( BaseSubscriber ) :
     """
     This version does not subscribe or unsubscribe but merely listens
     """
-    def __init__( self, listenUri, receivedDir, subId ) :
-        super().__init__( listenUri, None, receivedDir, subId )
+    def __init__( self, listenUri, receivedDir, subId, pipeline=None ) :
+        super().__init__( listenUri, None, receivedDir, subId, pipeline )
 
 
     def run( self ) :
@@ -197,6 +230,110 @@ class PassiveSubscriber( BaseSubscriber ) :
         return self.runListen()
 
 
+class ReceivedElement( namedtuple( 'ReceivedElement', [ 'ts', 'content', 'linkRels', 'subId' ] )) :
+    """
+    A feed element pushed to a subscriber. ts is in nanoseconds since the
+    epoch, content is the bytes as received, and linkRels the Link header
+    relations that came with it.
+    """
+    pass
+
+
+class SubscriberPipeline :
+    """
+    Passes received elements through a chain of stages. A stage is a callable
+    that takes a ReceivedElement and returns the ReceivedElement to pass to
+    the next stage -- the same, or a transformed one -- or None to stop
+    processing this element.
+
+    If workers is 0, the stages run before the element is acknowledged, and
+    if a stage raises an exception, the element is not acknowledged, so the
+    publisher sends it again. Otherwise, the stages run on a pool of worker
+    threads, so elements are acknowledged to the publisher without waiting
+    for them to be processed, and failures can only be logged. At most
+    maxPending elements wait to be processed; after that, receiving blocks
+    until there is space again.
+    """
+    def __init__( self, stages, workers=1, maxPending=1024, ordered=True ) :
+        """
+        stages: the stages, in the sequence in which to run them
+        workers: number of worker threads; 0 to run the stages before acknowledging each element.
+                 More than 1 requires ordered=False
+        maxPending: maximum number of elements waiting to be processed
+        ordered: if True, process elements one at a time, in the sequence received;
+                 otherwise run the workers in parallel, in no particular sequence
+        """
+        if ordered and workers > 1 :
+            raise ValueError( f'Ordered processing requires at most 1 worker, not { workers }' )
+
+        self.theStages  = stages
+        self.theQueue   = Queue( maxPending )
+        self.theWorkers = []
+
+        if workers > 0 :
+            for i in range( 0, workers ) :
+                t = Thread( target=self.work, name=f'p3sub-pipeline-{ i }', daemon=True )
+                t.start()
+                self.theWorkers.append( t )
+
+
+    def submit( self, element ) :
+        """
+        Pass an element into the pipeline. Without workers, exceptions
+        raised by the stages are passed on to the caller.
+
+        element: the ReceivedElement
+        """
+        if self.theWorkers :
+            self.theQueue.put( element )
+        else :
+            self.process( element )
+
+
+    def close( self ) :
+        """
+        Process all elements submitted so far, then stop the workers.
+        """
+        for t in self.theWorkers :
+            self.theQueue.put( None )
+        for t in self.theWorkers :
+            t.join()
+        self.theWorkers = []
+
+
+    def work( self ) :
+        while True :
+            element = self.theQueue.get()
+            if element is None :
+                return
+            try :
+                self.process( element )
+            except Exception as e :
+                ubos.logging.error( 'Processing element', nsToString( element.ts ), 'failed:', e )
+
+
+    def process( self, element ) :
+        for stage in self.theStages :
+            element = stage( element )
+            if element is None :
+                return
+
+
+class StoreStage :
+    """
+    Pipeline stage that writes each element into a file in a directory,
+    named after its timestamp.
+    """
+    def __init__( self, receivedDir ) :
+        self.theReceivedDir = receivedDir
+
+
+    def __call__( self, element ) :
+        with open( f"{ self.theReceivedDir }/{ nsToString( element.ts ) }.dat", 'wb' ) as writeTo :
+            writeTo.write( element.content )
+        return element
+
+
 class SubscriberWebServer( HTTPServer ) :
     """
     The default HTTPServer instantiates request handlers entirely without
@@ -209,14 +346,14 @@ class SubscriberWebServer( HTTPServer ) :
         self.theSubscriber = subscriber
 
 
-    def putRequestReceived( self, handler ) :
-        return self.theSubscriber.putRequestReceived( handler )
+    def requestReceived( self, method, handler ) :
+        return self.theSubscriber.requestReceived( method, handler )
 
 
 class SubscriberPutRequestHandler( BaseHTTPRequestHandler ) :
 
     def do_PUT( self ):
-        self.complete( self.server.putRequestReceived( self ))
+        self.complete( self.server.requestReceived( 'PUT', self ))
 
 
     def complete( self, err ) :
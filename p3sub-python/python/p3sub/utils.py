@@ -2,81 +2,411 @@
 # Copyright (C) Johannes Ernst. All rights reserved. License: see package.
 #
 
-from datetime import datetime
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from os import stat
 from p3sub.defs import *
 import re
+import time
 import ubos.logging
-from urllib.parse import parse_qs, unquote, ParseResult
+from urllib.parse import unquote, unquote_plus, ParseResult
+
+MAX_FORM_LENGTH = 16384 # longer POSTed forms are rejected without reading them
+
+
+class LazyParameters :
+    """
+    URL query or form parameters that are only decoded when a handler asks
+    for them. Supports "in" and [], which return the last value if the
+    parameter was given more than once.
+    """
+    def __init__( self, raw, isForm=False ) :
+        """
+        raw: the undecoded query string or form body
+        isForm: if True, decode like application/x-www-form-urlencoded
+        """
+        self.theRaw     = raw
+        self.theIsForm  = isForm
+        self.thePairs   = None # ( raw name, raw value or None ), split on first use
+        self.theDecoded = {}   # name -> list of decoded values
+
+
+    def getAll( self, name ) :
+        """
+        Obtain all values given for a parameter.
+
+        name: name of the parameter
+        return: list of values, possibly empty
+        """
+        ret = self.theDecoded.get( name )
+        if ret is None :
+            if self.thePairs is None :
+                self.thePairs = []
+                if self.theRaw :
+                    for pair in self.theRaw.split( '&' ) :
+                        eq = pair.find( '=' )
+                        if eq < 0 :
+                            self.thePairs.append( ( pair, None ))
+                        else :
+                            self.thePairs.append( ( pair[0:eq], pair[eq+1:] ))
+
+            decode = unquote_plus if self.theIsForm else unquote
+            ret    = []
+            for ( rawName, rawValue ) in self.thePairs :
+                if rawName != name :
+                    if '%' not in rawName and not ( self.theIsForm and '+' in rawName ) :
+                        continue # nothing to decode, so it is a different name
+                    if decode( rawName ) != name :
+                        continue
+
+                if rawValue is None :
+                    if not self.theIsForm : # like parse_qs, forms ignore parameters without value
+                        ret.append( name )
+                elif rawValue or not self.theIsForm :
+                    ret.append( decode( rawValue ))
+
+            self.theDecoded[name] = ret
+        return ret
+
+
+    def get( self, name, default=None ) :
+        values = self.getAll( name )
+        return values[-1] if values else default
+
+
+    def __contains__( self, name ) :
+        return len( self.getAll( name )) > 0
+
+
+    def __getitem__( self, name ) :
+        values = self.getAll( name )
+        if not values :
+            raise KeyError( name )
+        return values[-1]
+
+
+class RouteTable :
+    """
+    Maps HTTP method and path to the function handling requests for it.
+    Shared by the publisher and subscriber web servers.
+    """
+    def __init__( self ) :
+        self.theRoutes = {} # ( method, path ) -> function( handler, query )
+
+
+    def add( self, method, path, f ) :
+        """
+        Add a route.
+
+        method: the HTTP method, e.g. GET
+        path: the path, without query
+        f: the function to invoke with the request handler and the LazyParameters of the query
+        """
+        self.theRoutes[ ( method, path ) ] = f
+
+
+    def dispatch( self, method, handler ) :
+        """
+        Dispatch an incoming request.
+
+        method: the HTTP method
+        handler: the request handler
+        return: what the function returned, or an error message if there is no route
+        """
+        ( path, query ) = decodeRequestPath( handler.path )
+        f = self.theRoutes.get( ( method, path ))
+        if f is None :
+            return f'No { method } at { path }'
+        return f( handler, query )
+
 
 def decodeRequestPath( pathWithQuery ) :
     splitPath = pathWithQuery.split( '?', 1 )
 
-    query = {}
     if len( splitPath ) > 1 :
-        queryString = splitPath[1]
-        for pair in queryString.split( '&' ) :
-            eq = pair.find( '=' )
-            if eq < 0 :
-                unpair = unquote( pair )
-                query[unpair] = unpair
-            else :
-                query[ unquote( pair[0:eq] ) ] = unquote( pair[eq+1:] )
+        query = LazyParameters( splitPath[1] )
+    else :
+        query = LazyParameters( None )
 
     return ( splitPath[0], query )
 
 
-def linkHeaderPars( header ) :
-    ret = {}
+# RFC 8288 Link header grammar: link-value = "<" URI-Reference ">" *( OWS ";" OWS link-param )
+# with link-param = token BWS [ "=" BWS ( token / quoted-string ) ]
+_LINK_TOKEN      = r'[!#$%&\'*+\-.^_`|~0-9A-Za-z]+'
+_LINK_QUOTED     = r'"([^"\\]*(?:\\.[^"\\]*)*)"'
+_LINK_PARAM      = re.compile( r';[ \t]*(' + _LINK_TOKEN + r')[ \t]*(?:=[ \t]*(?:' + _LINK_QUOTED + r'|(' + _LINK_TOKEN + r'))[ \t]*)?' )
+_LINK_PARAMS     = r'((?:;[ \t]*' + _LINK_TOKEN + r'[ \t]*(?:=[ \t]*(?:' + _LINK_QUOTED.replace( '(', '(?:', 1 ) + '|' + _LINK_TOKEN + r')[ \t]*)?)*)'
+_LINK_VALUE      = re.compile( r'<([^>]*)>[ \t]*' + _LINK_PARAMS )
+_LINK_TAIL       = re.compile( r'[ \t]*' + _LINK_PARAMS )
+_LINK_SKIP       = re.compile( r'[ \t,]*' )
+_LINK_UNESCAPE   = re.compile( r'\\(.)' )
+_LINK_CACHE_SIZE = 256
+
+
+class Link( namedtuple( 'Link', [ 'url', 'rels', 'params' ] )) :
+    """
+    One link-value from a Link header.
 
-    for k in header.keys() :
-        if k.lower() != 'link' :
+    url: the target URI reference, as given
+    rels: tuple of the (lower-cased) relation types
+    params: tuple of ( name, value ) pairs, names lower-cased, value None if absent
+    """
+    __slots__ = ()
+
+
+def parseLinkHeader( value ) :
+    """
+    Parse the value of one Link header, which may contain several
+    link-values. Malformed parts are skipped.
+
+    The URLs of pushed elements are all different, so caching whole header
+    values does not help. Instead, the header is split at commas, and the
+    part of each link-value after its URL, which tends to recur, is parsed
+    through a cache. If a comma turns out to have been inside a URL or a
+    quoted string, the header is parsed the slow way.
+
+    value: the header value
+    return: tuple of Link
+    """
+    links = []
+    for part in value.split( ',' ) :
+        part = part.strip( ' \t' )
+        if not part :
             continue
 
-        for v in header.get_all( k ) :
-            for v2 in v.split( ',' ) :
-                # can be multiple values on the same line
+        close = part.find( '>' )
+        if close < 0 or part[0] != '<' :
+            return parseLinkHeaderSlowly( value )
+
+        relsAndParams = parseLinkTail( part[ close+1 : ] )
+        if relsAndParams is None :
+            return parseLinkHeaderSlowly( value )
+
+        links.append( Link( part[ 1 : close ], relsAndParams[0], relsAndParams[1] ))
+
+    return tuple( links )
+
+
+def parseLinkHeaderSlowly( value ) :
+    """
+    Parse the value of one Link header with the full grammar, in a single
+    pass. Malformed parts are skipped.
 
-                semi = v2.find( ';' )
-                if semi < 0 :
-                    # Received link header with no parameter, skipping
-                    continue
+    value: the header value
+    return: tuple of Link
+    """
+    links = []
+    pos   = _LINK_SKIP.match( value ).end()
+    end   = len( value )
 
-                url = v2[0:semi].strip()
-                par = v2[semi+1:].strip()
+    while pos < end :
+        m = _LINK_VALUE.match( value, pos )
+        if m is None :
+            ubos.logging.warning( 'Could not parse Link header:', value )
+            break
 
-                if url.startswith( '<' ) :
-                    url = url[1:]
-                if url.endswith( '>' ) :
-                    url = url[0:-1]
+        ( url, paramString ) = m.groups()
+        ( rels, params )     = parseLinkParams( paramString )
+        links.append( Link( url, rels, params ))
 
-                m = re.fullmatch( 'rel="([^"]+)"', par )
-                if m :
-                    ret[m.group(1)] = url
-                else :
-                    print( f"WARNING: Could not parse Link rel: { v }" )
+        pos = m.end()
+        if pos < end and value[pos] != ',' :
+            ubos.logging.warning( 'Could not parse Link header:', value )
+            break
+        pos = _LINK_SKIP.match( value, pos ).end()
 
+    return tuple( links )
+
+
+@lru_cache( maxsize=_LINK_CACHE_SIZE )
+def parseLinkTail( tail ) :
+    """
+    Parse what follows the URL in a link-value, e.g. '; rel="prev"'.
+
+    tail: the text after the closing angle bracket
+    return: tuple of the relation types, and tuple of ( name, value ) pairs, or None if malformed
+    """
+    m = _LINK_TAIL.fullmatch( tail )
+    if m is None :
+        return None
+    return parseLinkParams( m.group( 1 ))
+
+
+@lru_cache( maxsize=_LINK_CACHE_SIZE )
+def parseLinkParams( paramString ) :
+    """
+    Parse the parameters of a link-value. Cached separately, as the same
+    parameters (e.g. rel="prev") recur with ever-changing URLs.
+
+    paramString: the link-params, each preceded by a semicolon
+    return: tuple of the relation types, and tuple of ( name, value ) pairs
+    """
+    rels   = None
+    params = []
+    for m in _LINK_PARAM.finditer( paramString ) :
+        ( name, value, tokenValue ) = m.groups()
+        name = name.lower()
+        if value is None :
+            value = tokenValue
+        elif '\\' in value :
+            value = _LINK_UNESCAPE.sub( r'\1', value )
+
+        if name == 'rel' and rels is None : # subsequent rel parameters are ignored
+            rels = tuple( value.lower().split() ) if value else ()
+        params.append( ( name, value ))
+
+    return ( rels or (), tuple( params ))
+
+
+def linkRelsFor( values ) :
+    """
+    Map relation types to URLs, given the values of all Link headers in a
+    message. If more than one link has the same relation type, the first
+    one wins.
+
+    values: the header values
+    return: dict of relation type to URL
+    """
+    ret = {}
+    for value in values :
+        for link in parseLinkHeader( value ) :
+            for rel in link.rels :
+                if rel not in ret :
+                    ret[rel] = link.url
     return ret
 
 
-def formFields( handler ) :
+def linkHeaderPars( header ) :
+    """
+    Find the URLs by relation type in all Link headers of a message.
+
+    header: the message headers
+    return: dict of relation type to URL
+    """
+    values = header.get_all( 'link' )
+    if not values :
+        return {}
+    return linkRelsFor( values )
+
+
+def formFields( handler, maxLength=MAX_FORM_LENGTH ) :
+    """
+    Obtain the fields of a POSTed form.
+
+    handler: the request handler
+    maxLength: the maximum acceptable length of the body
+    return: LazyParameters, or None if the body is too long or its length unknown
+    """
     if 'content-length' in handler.headers :
-        length = int( handler.headers.get('content-length') )
-        data   = handler.rfile.read( length )
-        ret    = parse_qs( str( data, 'utf-8' ))
+        try :
+            length = int( handler.headers.get('content-length') )
+        except ValueError :
+            return None
+        if length < 0 or length > maxLength :
+            return None
+
+        data = handler.rfile.read( length )
+        ret  = LazyParameters( str( data, 'utf-8' ), True )
     else :
-        ret = {}
+        ret = LazyParameters( None, True )
 
     return ret
 
 
+# Timestamps on the wire look like 2024-01-02T03:04:05.678901Z. Internally,
+# the feed index represents them as integer nanoseconds since the epoch,
+# always truncated to microseconds, so they compare and sort cheaply and
+# convert to the wire format without loss.
+
+_TS_PATTERN      = re.compile( r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\.(\d{6})Z', re.ASCII )
+_TS_EPOCH        = datetime( 1970, 1, 1, tzinfo=timezone.utc )
+_TS_EPOCH_NAIVE  = datetime( 1970, 1, 1 )
+_TS_EPOCH_DAYS   = date( 1970, 1, 1 ).toordinal()
+_TS_CACHE_SIZE   = 1024
+_ONE_MICRO       = timedelta( microseconds=1 )
+
+
+@lru_cache( maxsize=_TS_CACHE_SIZE )
+def stringToNs( s ) :
+    """
+    Parse a timestamp in wire format into nanoseconds since the epoch.
+    Also accepts anything the wire format was historically parsed with,
+    i.e. '%Y-%m-%dT%H:%M:%S.%f%z'.
+
+    s: the string
+    return: nanoseconds since the epoch
+    """
+    m = _TS_PATTERN.fullmatch( s )
+    if m is None :
+        return tsToNs( datetime.strptime( s, '%Y-%m-%dT%H:%M:%S.%f%z' ))
+
+    ( year, month, day, hour, minute, second, micro ) = map( int, m.groups() )
+    if hour > 23 or minute > 59 or second > 59 :
+        raise ValueError( f'Invalid timestamp: { s }' )
+
+    days = date( year, month, day ).toordinal() - _TS_EPOCH_DAYS # also validates the date
+    return ((( days * 24 + hour ) * 60 + minute ) * 60 + second ) * 1000000000 + micro * 1000
+
+
+@lru_cache( maxsize=_TS_CACHE_SIZE )
+def nsToString( ns ) :
+    """
+    Format nanoseconds since the epoch as a timestamp in wire format.
+
+    ns: nanoseconds since the epoch
+    return: the string
+    """
+    ( secs, micro )   = divmod( ns // 1000, 1000000 )
+    ( days, secs )    = divmod( secs, 86400 )
+    ( hour, secs )    = divmod( secs, 3600 )
+    ( minute, secs )  = divmod( secs, 60 )
+    d                 = date.fromordinal( _TS_EPOCH_DAYS + days )
+
+    return '%04d-%02d-%02dT%02d:%02d:%02d.%06dZ' % ( d.year, d.month, d.day, hour, minute, secs, micro )
+
+
+def tsToNs( ts ) :
+    """
+    Convert a datetime into nanoseconds since the epoch. Naive datetimes
+    are taken to be in UTC.
+    """
+    if ts.tzinfo is None :
+        return (( ts - _TS_EPOCH_NAIVE ) // _ONE_MICRO ) * 1000
+    return (( ts - _TS_EPOCH ) // _ONE_MICRO ) * 1000
+
+
+def nsToTs( ns ) :
+    """
+    Convert nanoseconds since the epoch into a datetime in UTC.
+    """
+    return _TS_EPOCH + timedelta( microseconds=ns // 1000 )
+
+
+def nowNs() :
+    """
+    The current time, in nanoseconds since the epoch, truncated to what the
+    wire format can represent.
+    """
+    return time.time_ns() // 1000 * 1000
+
+
+def mtimeNs( path ) :
+    """
+    The mtime of a file, in nanoseconds since the epoch, truncated to what
+    the wire format can represent.
+    """
+    return stat( path ).st_mtime_ns // 1000 * 1000
+
+
 def stringToTs( s ) :
-    ts = datetime.strptime( s, '%Y-%m-%dT%H:%M:%S.%f%z' )
+    ts = nsToTs( stringToNs( s ))
     return ts
 
 
 def tsToString( ts ) :
-    s = ts.strftime( '%Y-%m-%dT%H:%M:%S.%fZ' )
-    # I can't get python to emit the Z for the timezone
+    s = nsToString( tsToNs( ts ))
     return s
 
 
@@ -0,0 +1,401 @@
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from os.path import dirname
+from threading import Event, Thread
+import errno
+import os
+import select
+import struct
+import sys
+import time
+import ubos.logging
+
+
+WATCHERS = [ 'auto', 'inotify', 'poll', 'watchdog' ]
+
+# File systems on which inotify and watchdog do not see changes made by other hosts
+NETWORK_FILESYSTEMS = [ 'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'ceph', 'glusterfs', 'fuse.sshfs' ]
+
+POLL_MIN_INTERVAL = 0.05 # seconds between polls while elements are being published
+POLL_MAX_INTERVAL = 2.0  # seconds between polls while nothing is happening
+POLL_RACY_NS      = 2000000000 # changes this recent may be followed by more with the same mtime
+
+# from <sys/inotify.h>
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = os.O_CLOEXEC
+
+_INOTIFY_EVENT = struct.Struct( 'iIII' ) # wd, mask, cookie, len; followed by the name
+
+
+def createWatcher( kind, publisher ) :
+    """
+    Create a watcher that tells the publisher about changes to its feed directory.
+
+    kind: one of WATCHERS; 'auto' polls on network file systems, otherwise it
+          uses inotify if available, and watchdog if not
+    publisher: the Publisher
+    return: the watcher, which has methods start() and stop()
+    """
+    if kind == 'poll' or ( kind == 'auto' and isOnNetworkFilesystem( publisher.theFeedDirectory.getDirectory() )) :
+        return PollingWatcher( publisher )
+
+    if kind in ( 'auto', 'inotify' ) :
+        if InotifyWatcher.isAvailable() :
+            return InotifyWatcher( publisher )
+        if kind == 'inotify' :
+            raise Exception( 'inotify is not available on this system' )
+
+    return WatchdogWatcher( publisher )
+
+
+def isOnNetworkFilesystem( directory ) :
+    """
+    Determine whether a directory is on a network file system, according to
+    /proc/self/mounts.
+
+    directory: the directory
+    return: True or False; False if it cannot be determined
+    """
+    directory = os.path.realpath( directory )
+    best      = ( '', None ) # mount point, file system type
+    try :
+        with open( '/proc/self/mounts' ) as f :
+            for line in f :
+                fields = line.split()
+                if len( fields ) < 3 :
+                    continue
+                mountPoint = fields[1].replace( '\\040', ' ' )
+                if directory == mountPoint or directory.startswith( mountPoint.rstrip( '/' ) + '/' ) :
+                    if len( mountPoint ) >= len( best[0] ) :
+                        best = ( mountPoint, fields[2] )
+    except OSError :
+        return False
+
+    return best[1] in NETWORK_FILESYSTEMS
+
+
+def feedDirectoryChanged( publisher, added, removed, purge=False ) :
+    """
+    Apply a batch of changes to the publisher's feed index, and trigger
+    delivery.
+
+    publisher: the Publisher
+    added: full paths of the files that were added or rewritten
+    removed: full paths of the files that were removed
+    purge: if True, the index is out of sync and must be rebuilt
+    """
+    if purge :
+        publisher.theFeedDirectory.purgeElementsInSequence()
+    else :
+        publisher.theFeedDirectory.elementsChanged( added, removed )
+
+    publisher.theSender.triggerPotentialSend()
+
+
+class InotifyWatcher :
+    """
+    Watches the feed directory with Linux inotify directly. Reads as many
+    events as are available with each read, and passes them to the feed
+    index as one batch.
+    """
+    _libc = None
+
+    @staticmethod
+    def isAvailable() :
+        if not sys.platform.startswith( 'linux' ) :
+            return False
+        if InotifyWatcher._libc is None :
+            import ctypes.util # only when needed, as it takes a while to import
+            try :
+                libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno=True )
+                libc.inotify_init1
+                libc.inotify_add_watch
+                InotifyWatcher._libc = libc
+            except ( OSError, AttributeError ) :
+                return False
+        return True
+
+
+    def __init__( self, publisher ) :
+        import ctypes
+
+        self.thePublisher = publisher
+        self.theDirectory = publisher.theFeedDirectory.getDirectory()
+        self.theThread    = None
+
+        libc = InotifyWatcher._libc
+        self.theFd = libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+        if self.theFd < 0 :
+            err = ctypes.get_errno()
+            raise OSError( err, f'inotify_init1 failed: { os.strerror( err ) }' )
+
+        wd = libc.inotify_add_watch(
+                self.theFd,
+                os.fsencode( self.theDirectory ),
+                IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE )
+        if wd < 0 :
+            err = ctypes.get_errno()
+            os.close( self.theFd )
+            raise OSError( err, f'inotify_add_watch failed for { self.theDirectory }: { os.strerror( err ) }' )
+
+        ( self.theStopRead, self.theStopWrite ) = os.pipe()
+
+
+    def start( self ) :
+        self.theThread = Thread( target=self.run, name='p3sub-inotify', daemon=True )
+        self.theThread.start()
+
+
+    def stop( self ) :
+        os.write( self.theStopWrite, b'x' )
+        self.theThread.join()
+
+        os.close( self.theFd )
+        os.close( self.theStopRead )
+        os.close( self.theStopWrite )
+
+
+    def run( self ) :
+        poll = select.poll()
+        poll.register( self.theFd,       select.POLLIN )
+        poll.register( self.theStopRead, select.POLLIN )
+
+        while True :
+            ready = [ fd for ( fd, event ) in poll.poll() ]
+            if self.theStopRead in ready :
+                return
+
+            try :
+                ( added, removed, purge ) = self.readEvents()
+                if added or removed or purge :
+                    feedDirectoryChanged( self.thePublisher, added, removed, purge )
+
+            except Exception as e :
+                # Must not end the thread, or later changes go unnoticed. Events may have been lost, so start over
+                ubos.logging.error( 'Watching feed directory failed:', self.theDirectory, e )
+                feedDirectoryChanged( self.thePublisher, [], [], True )
+
+
+    def readEvents( self ) :
+        """
+        Read all pending events, and reduce them to the net changes.
+
+        return: tuple of the added, and the removed paths, and whether the index must be purged
+        """
+        changes = {} # path -> True if added, False if removed; later events override earlier ones
+        purge   = False
+        while True :
+            try :
+                buf = os.read( self.theFd, 65536 )
+            except BlockingIOError :
+                break
+            except OSError as e :
+                if e.errno == errno.EINTR :
+                    continue
+                raise
+
+            pos = 0
+            while pos < len( buf ) :
+                ( wd, mask, cookie, nameLen ) = _INOTIFY_EVENT.unpack_from( buf, pos )
+                pos += _INOTIFY_EVENT.size
+                name = buf[ pos : pos + nameLen ].rstrip( b'\0' )
+                pos += nameLen
+
+                if mask & IN_Q_OVERFLOW :
+                    purge = True
+                elif mask & ( IN_ISDIR | IN_IGNORED ) or not name :
+                    continue
+                elif mask & ( IN_MOVED_FROM | IN_DELETE ) :
+                    changes[ self.theDirectory + '/' + os.fsdecode( name ) ] = False
+                else :
+                    changes[ self.theDirectory + '/' + os.fsdecode( name ) ] = True
+
+        added   = [ path for ( path, isAdded ) in changes.items() if isAdded ]
+        removed = [ path for ( path, isAdded ) in changes.items() if not isAdded ]
+        return ( added, removed, purge )
+
+
+class WatchdogWatcher :
+    """
+    Watches the feed directory with the watchdog package, on systems where
+    inotify is not available.
+    """
+    def __init__( self, publisher ) :
+        from watchdog.observers import Observer # optional dependency
+
+        self.thePublisher = publisher
+        self.theDirectory = publisher.theFeedDirectory.getDirectory()
+        self.theObserver  = Observer()
+        self.theObserver.schedule( self, self.theDirectory, recursive=False )
+
+
+    def start( self ) :
+        self.theObserver.start()
+
+
+    def stop( self ) :
+        self.theObserver.stop()
+        self.theObserver.join()
+
+
+    def dispatch( self, event ) :
+        """
+        Invoked by watchdog for every event.
+        """
+        if event.is_directory or event.event_type in ( 'opened', 'closed_no_write' ) :
+            # Not a change to the feed; also happens when we read elements ourselves
+            return
+
+        if event.event_type in ( 'created', 'modified', 'closed' ) :
+            feedDirectoryChanged( self.thePublisher, [ event.src_path ], [] )
+        elif event.event_type == 'moved' and dirname( event.dest_path ) == self.theDirectory :
+            # Atomically renamed into place
+            feedDirectoryChanged( self.thePublisher, [ event.dest_path ], [ event.src_path ] )
+        elif event.event_type == 'deleted' :
+            feedDirectoryChanged( self.thePublisher, [], [ event.src_path ] )
+        else :
+            # We take the easy way out
+            feedDirectoryChanged( self.thePublisher, [], [], True )
+
+
+class PollingWatcher :
+    """
+    Watches the feed directory by polling it, for network file systems on
+    which inotify and watchdog do not see changes made by other hosts.
+
+    A poll only stats the directory itself; unless its mtime has moved past
+    the high-water mark, nothing else happens. If it has, the directory is
+    read with scandir, and only entries that are not known yet are stat'ed.
+    Files that were modified very recently are stat'ed again on later polls
+    until they have settled, so slow writers are not missed. The feed is
+    expected to be written by adding, renaming and removing files, as
+    rewriting an existing file in place does not change the directory's
+    mtime. On NFS, changes show up once the client's attribute cache for the
+    directory has expired (see acdirmin and acdirmax).
+
+    The interval between polls shrinks to POLL_MIN_INTERVAL when changes are
+    found, and grows towards POLL_MAX_INTERVAL while there are none.
+    """
+    def __init__( self, publisher ) :
+        self.thePublisher   = publisher
+        self.theDirectory   = publisher.theFeedDirectory.getDirectory()
+        self.theThread      = None
+        self.theStop        = Event()
+        self.theInterval    = POLL_MIN_INTERVAL
+        self.theDirMtimeNs  = None # high-water mark: the directory's mtime when last scanned; None: scan next time
+        self.theKnown       = {}   # path -> ( inode, mtime in ns ) of the files seen in the directory
+        self.thePending     = set() # paths of known files that were modified recently, and may still change
+
+
+    def start( self ) :
+        self.theThread = Thread( target=self.run, name='p3sub-poll', daemon=True )
+        self.theThread.start()
+
+
+    def stop( self ) :
+        self.theStop.set()
+        self.theThread.join()
+
+
+    def run( self ) :
+        # The index may have been built before the first scan, and missed what happened in between
+        self.poll()
+        feedDirectoryChanged( self.thePublisher, [], [], True )
+
+        while not self.theStop.wait( self.theInterval ) :
+            ( added, removed, purge ) = self.poll()
+            if added or removed or purge :
+                feedDirectoryChanged( self.thePublisher, added, removed, purge )
+                self.theInterval = POLL_MIN_INTERVAL
+            else :
+                self.theInterval = min( self.theInterval * 1.5, POLL_MAX_INTERVAL )
+
+
+    def poll( self ) :
+        """
+        Poll the directory once, and determine what has changed since the
+        previous poll.
+
+        return: tuple of the added, and the removed paths, and whether the index must be purged
+        """
+        nowNs = time.time_ns()
+        try :
+            dirMtimeNs = os.stat( self.theDirectory ).st_mtime_ns
+        except OSError :
+            # e.g. the NFS server is not reachable; try again next time
+            return ( [], [], False )
+
+        added = self.restatPending( nowNs )
+
+        if dirMtimeNs == self.theDirMtimeNs :
+            return ( added, [], False )
+
+        current = {}
+        try :
+            with os.scandir( self.theDirectory ) as entries :
+                for entry in entries :
+                    # No syscalls for type and inode, they come with the directory entry
+                    if not entry.is_file() :
+                        continue
+
+                    path  = self.theDirectory + '/' + entry.name
+                    known = self.theKnown.get( path )
+                    if known is not None and known[0] == entry.inode() :
+                        current[path] = known
+                        continue
+
+                    # new, or another file renamed over it
+                    try :
+                        current[path] = ( entry.inode(), entry.stat().st_mtime_ns )
+                    except FileNotFoundError :
+                        continue # removed while we were reading the directory
+
+                    added.append( path )
+                    if current[path][1] > nowNs - POLL_RACY_NS :
+                        self.thePending.add( path )
+
+        except OSError :
+            return ( added, [], True )
+
+        removed = [ path for path in self.theKnown if path not in current ]
+        self.thePending.difference_update( removed )
+        self.theKnown = current
+
+        # More changes may follow within the mtime granularity, so do not trust a recent mtime
+        self.theDirMtimeNs = dirMtimeNs if dirMtimeNs <= nowNs - POLL_RACY_NS else None
+
+        return ( added, removed, False )
+
+
+    def restatPending( self, nowNs ) :
+        """
+        Stat the recently modified files again.
+
+        nowNs: the current time
+        return: list of the paths whose mtime has changed
+        """
+        changed = []
+        for path in list( self.thePending ) :
+            try :
+                fileMtimeNs = os.stat( path ).st_mtime_ns
+            except FileNotFoundError :
+                self.thePending.discard( path ) # the directory has changed, too
+                continue
+
+            if fileMtimeNs != self.theKnown[path][1] :
+                self.theKnown[path] = ( self.theKnown[path][0], fileMtimeNs )
+                changed.append( path )
+            if fileMtimeNs <= nowNs - POLL_RACY_NS :
+                self.thePending.discard( path )
+
+        return changed
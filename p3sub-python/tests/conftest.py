@@ -0,0 +1,15 @@
+#
+# Run the tests against the source tree, including ubos-python-utils next to it.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from os.path import abspath, dirname, isdir
+import sys
+
+_here = dirname( abspath( __file__ ))
+
+for path in [ _here + '/../python', _here + '/../../ubos-python-utils/python' ] :
+    path = abspath( path )
+    if isdir( path ) and path not in sys.path :
+        sys.path.insert( 0, path )
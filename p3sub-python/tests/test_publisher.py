@@ -0,0 +1,172 @@
+#
+# Publishing adds elements to the feed, but never replaces or corrupts one.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from io import BytesIO
+from os import listdir
+from p3sub.defs import *
+from p3sub.publisher import Publisher, PublisherFeedDirectory
+from p3sub.watchers import InotifyWatcher
+from test_subscriber import freePort
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import urlopen, Request
+import pytest
+import time
+
+TOKEN = 'secret'
+
+
+@pytest.fixture
+def publisher( tmp_path ) :
+    """
+    A started and serving Publisher for a feed in tmp_path/feed.
+    """
+    feedDir = tmp_path / 'feed'
+    feedDir.mkdir()
+
+    ret = Publisher( urlparse( f'http://127.0.0.1:{ freePort() }/feed' ), str( feedDir ), TOKEN, 'poll', maxPublishLength=1000 )
+    ret.start()
+    t = Thread( target=ret.serve, daemon=True )
+    t.start()
+
+    yield ret
+
+    ret.stop()
+    t.join()
+
+
+def elementFiles( publisher ) :
+    return sorted( f for f in listdir( publisher.theFeedDirectory.getDirectory() ) if not f.startswith( '.' ))
+
+
+def test_publishBeforeStart( tmp_path ) :
+    publisher = Publisher( urlparse( f'http://127.0.0.1:{ freePort() }/feed' ), str( tmp_path ))
+
+    with pytest.raises( Exception, match='started' ) :
+        publisher.publish( b'content' )
+    assert listdir( tmp_path ) == []
+
+
+def test_existingNameRefused( publisher ) :
+    publisher.publish( b'first', name='a.dat' )
+    with pytest.raises( ValueError ) :
+        publisher.publish( b'second', name='a.dat' )
+
+    assert elementFiles( publisher ) == [ 'a.dat' ]
+    with open( publisher.theFeedDirectory.getDirectory() + '/a.dat', 'rb' ) as f :
+        assert f.read() == b'first'
+    assert len( publisher.theFeedDirectory.snapshot().elementsInSequence ) == 1
+
+
+def test_existingTimestampRefused( publisher ) :
+    publisher.publish( b'first', timestampNs=1700000000123456000 )
+    with pytest.raises( ValueError ) :
+        publisher.publish( b'second', timestampNs=1700000000123456789 ) # same microsecond
+
+    assert len( elementFiles( publisher )) == 1
+
+
+def test_negativeLengthRefused( publisher ) :
+    with pytest.raises( ValueError ) :
+        publisher.publishStream( BytesIO( b'abc' ), -5 )
+    with pytest.raises( ValueError ) :
+        publisher.publishStream( BytesIO( b'abc' ), 5 ) # ends prematurely
+
+    assert elementFiles( publisher ) == []
+
+
+def postElement( publisher, content, length ) :
+    """
+    return: the HTTP status
+    """
+    headers = { 'authorization' : f'Bearer { TOKEN }', 'content-length' : str( length ) }
+    url     = f'http://127.0.0.1:{ publisher.theWsPort }{ publisher.thePublishPath }'
+    try :
+        return urlopen( Request( url, headers=headers, data=content, method='POST' )).status
+    except HTTPError as e :
+        return e.code
+
+
+def test_publishEndpoint( publisher ) :
+    assert postElement( publisher, b'x' * 1000, 1000 ) == 200
+    assert postElement( publisher, b'x' * 1001, 1001 ) == 413
+    assert postElement( publisher, b'',         -5 )   == 400
+
+    assert len( elementFiles( publisher )) == 1
+
+
+def test_purgeWaitsForWriters( tmp_path ) :
+    feedDirectory = PublisherFeedDirectory( str( tmp_path ), '/feed', '/feed/sub', '/feed/unsub' )
+    updated       = feedDirectory.snapshot()
+
+    feedDirectory.theLock.acquire() # like elementsChanged while updating a copy of the index
+    try :
+        purger = Thread( target=feedDirectory.purgeElementsInSequence )
+        purger.start()
+        time.sleep( 0.1 )
+        assert purger.is_alive()
+
+        feedDirectory.theSnapshot = updated
+    finally :
+        feedDirectory.theLock.release()
+
+    purger.join()
+    assert feedDirectory.theSnapshot is None
+
+
+def test_elementRemovedWhileAdding( tmp_path, monkeypatch ) :
+    feedDirectory = PublisherFeedDirectory( str( tmp_path ), '/feed', '/feed/sub', '/feed/unsub' )
+    feedDirectory.snapshot()
+    ( tmp_path / 'a.dat' ).write_bytes( b'a' )
+
+    def removedAfterCheck( realF ) :
+        raise FileNotFoundError( realF )
+    monkeypatch.setattr( feedDirectory, 'createElement', removedAfterCheck )
+
+    feedDirectory.elementAdded( str( tmp_path / 'a.dat' ))
+    assert feedDirectory.theSnapshot is None # rebuilt when needed next
+
+
+def test_inotifyWatcherSurvivesErrors( tmp_path ) :
+    if not InotifyWatcher.isAvailable() :
+        pytest.skip( 'inotify is not available' )
+
+    feedDir   = tmp_path / 'feed'
+    feedDir.mkdir()
+    publisher = Publisher( urlparse( f'http://127.0.0.1:{ freePort() }/feed' ), str( feedDir ), watcher='inotify' )
+    publisher.start()
+    try :
+        feedDirectory = publisher.theFeedDirectory
+        feedDirectory.snapshot()
+
+        failures = []
+        def failOnce( added, removed ) :
+            failures.append( added )
+            raise RuntimeError( 'failing once' )
+        feedDirectory.elementsChanged = failOnce
+
+        ( feedDir / 'a.dat' ).write_bytes( b'a' )
+        waitFor( lambda : failures )
+        del feedDirectory.elementsChanged
+
+        ( feedDir / 'b.dat' ).write_bytes( b'b' )
+        waitFor( lambda : len( feedDirectory.snapshot().elementsInSequence ) == 2 )
+
+        assert publisher.theWatcher.theThread.is_alive()
+
+    finally :
+        publisher.theWatcher.stop()
+        publisher.theSender.stop()
+        publisher.theWebServer.server_close()
+        publisher.theSender.join()
+
+
+def waitFor( condition, timeout=5 ) :
+    deadline = time.monotonic() + timeout
+    while not condition() :
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep( 0.01 )
@@ -0,0 +1,78 @@
+#
+# A relay acknowledges an element to upstream only once it has republished it.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from p3sub.relay import Relay
+from p3sub.utils import nsToString
+from test_subscriber import SUBID, freePort, put
+from threading import Thread
+from urllib.parse import urlparse
+import time
+
+
+def relayPut( feedDirectory, elements, startPublisher ) :
+    """
+    Run the relay's subscriber endpoint, and PUT elements to it like upstream does.
+
+    elements: list of tuples of timestamp and content
+    startPublisher: if True, also run the relay's publisher
+    return: tuple of the Relay and the list of HTTP statuses
+    """
+    callback = f'http://127.0.0.1:{ freePort() }/cb'
+    relay    = Relay(
+            urlparse( f'http://127.0.0.1:{ freePort() }/feed' ),
+            urlparse( callback ),
+            feedDirectory,
+            urlparse( 'http://127.0.0.1:1/upstream' ), # not contacted
+            watcher='poll' )
+    relay.theSubscriber.theSubId = SUBID
+
+    threads = []
+    if startPublisher :
+        relay.thePublisher.start()
+        threads.append( Thread( target=relay.thePublisher.serve, daemon=True ))
+    threads.append( Thread( target=relay.theSubscriber.runListen, daemon=True ))
+    for t in threads :
+        t.start()
+    while relay.theSubscriber.theWebServer is None :
+        time.sleep( 0.01 )
+
+    try :
+        return ( relay, [ put( callback, ts, content ) for ( ts, content ) in elements ] )
+    finally :
+        relay.theSubscriber.stopListen()
+        if startPublisher :
+            relay.thePublisher.stop()
+        for t in threads :
+            t.join()
+
+
+def test_republishedBeforeAcknowledged( tmp_path ) :
+    ts = 1700000000123456000
+
+    ( relay, statuses ) = relayPut( str( tmp_path ), [ ( ts, b'content' ) ], True )
+
+    assert statuses == [ 200 ]
+    assert ( tmp_path / f'{ nsToString( ts ) }.dat' ).read_bytes() == b'content'
+    assert relay.thePublisher.theFeedDirectory.snapshot().lastMtimeNs() == ts
+
+
+def test_failedRepublishNotAcknowledged( tmp_path ) :
+    notADirectory = tmp_path / 'file'
+    notADirectory.write_bytes( b'' )
+
+    ( relay, statuses ) = relayPut( str( notADirectory ), [ ( 1700000000123456000, b'content' ) ], False )
+
+    assert statuses == [ 400 ]
+
+
+def test_redeliveryAcknowledged( tmp_path ) :
+    # e.g. upstream did not receive the first acknowledgement
+    ts = 1700000000123456000
+
+    ( relay, statuses ) = relayPut( str( tmp_path ), [ ( ts, b'content' ), ( ts, b'content' ) ], True )
+
+    assert statuses == [ 200, 200 ]
+    assert [ f for f in tmp_path.iterdir() if f.is_file() ] == [ tmp_path / f'{ nsToString( ts ) }.dat' ]
@@ -0,0 +1,19 @@
+#
+# Printing the help for any command must not import the modules that are
+# only needed once a command actually runs.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from p3sub.benchmark import measureStartup
+import p3sub
+import pytest
+
+
+@pytest.mark.parametrize( 'cmdName', [ None ] + list( p3sub.COMMANDS ))
+def test_noHeavyImportsAtStartup( cmdName ) :
+    ( returnCode, importMs, wallMs, heavy ) = measureStartup( cmdName )
+
+    assert returnCode == 0
+    assert importMs > 0, 'python -X importtime produced no output'
+    assert not heavy, f'imported at startup: { " ".join( sorted( heavy )) }'
@@ -0,0 +1,106 @@
+#
+# A subscriber acknowledges an element only once its pipeline has processed
+# it, unless the pipeline runs on worker threads.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from os import listdir
+from p3sub.defs import *
+from p3sub.subscriber import PassiveSubscriber, ReceivedElement, SubscriberPipeline, StoreStage
+from p3sub.utils import nsToString
+from socket import socket
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import urlopen, Request
+import pytest
+import time
+
+SUBID = 'x' * 32
+
+
+def freePort() :
+    with socket() as s :
+        s.bind( ( '127.0.0.1', 0 ))
+        return s.getsockname()[1]
+
+
+def put( url, ts, content ) :
+    """
+    PUT an element to a subscriber like a publisher does.
+
+    return: the HTTP status
+    """
+    headers = {
+        'content-type'   : 'application/octet-stream',
+        'content-length' : len( content ),
+        'link'           : f'</feed/unsub>; rel="{ P3SUB_REL_UNSUBSCRIBE }"'
+    }
+    try :
+        response = urlopen( Request( f'{ url }?{ P3SUB_PAR_TS }={ nsToString( ts ) }&{ P3SUB_PAR_SUBID }={ SUBID }', headers=headers, data=content, method='PUT' ))
+        return response.status
+    except HTTPError as e :
+        return e.code
+
+
+def putAll( pipeline, receivedDir, elements ) :
+    """
+    Run a subscriber endpoint, and PUT elements to it.
+
+    elements: list of tuples of timestamp and content
+    return: list of the HTTP statuses
+    """
+    url        = f'http://127.0.0.1:{ freePort() }/cb'
+    subscriber = PassiveSubscriber( urlparse( url ), receivedDir, SUBID, pipeline )
+    t          = Thread( target=subscriber.runListen, daemon=True )
+    t.start()
+    while subscriber.theWebServer is None :
+        time.sleep( 0.01 )
+
+    try :
+        return [ put( url, ts, content ) for ( ts, content ) in elements ]
+    finally :
+        subscriber.stopListen()
+        t.join() # also closes the pipeline
+
+
+def test_storedBeforeAcknowledged( tmp_path ) :
+    ts = 1700000000123456000
+
+    assert putAll( None, str( tmp_path ), [ ( ts, b'content' ) ] ) == [ 200 ]
+    assert ( tmp_path / f'{ nsToString( ts ) }.dat' ).read_bytes() == b'content'
+
+
+def test_failedStoreNotAcknowledged( tmp_path ) :
+    assert putAll( None, str( tmp_path / 'nonexistent' ), [ ( 1700000000123456000, b'content' ) ] ) == [ 400 ]
+
+
+def test_inlineExceptionsPropagate() :
+    def fail( element ) :
+        raise OSError( 'disk full' )
+
+    pipeline = SubscriberPipeline( [ fail ], workers=0 )
+    with pytest.raises( OSError ) :
+        pipeline.submit( ReceivedElement( 1700000000123456000, b'content', {}, SUBID ))
+
+
+def test_workerFailuresAreLogged( tmp_path ) :
+    processed = []
+    def failFirst( element ) :
+        if not processed :
+            processed.append( None )
+            raise OSError( 'disk full' )
+        return element
+
+    pipeline = SubscriberPipeline( [ failFirst, StoreStage( str( tmp_path )) ], workers=1 )
+    statuses = putAll( pipeline, str( tmp_path ), [ ( 1700000000000001000, b'a' ), ( 1700000000000002000, b'b' ) ] )
+
+    assert statuses == [ 200, 200 ] # acknowledged before processing
+
+    assert listdir( tmp_path ) == [ nsToString( 1700000000000002000 ) + '.dat' ]
+
+
+def test_orderedRequiresOneWorker() :
+    with pytest.raises( ValueError ) :
+        SubscriberPipeline( [], workers=2 )
@@ -0,0 +1,82 @@
+#
+# Timestamps in wire format must remain compatible with the format they
+# were historically written and parsed with, using strftime and strptime.
+#
+# Copyright (C) Johannes Ernst. All rights reserved. License: see package.
+#
+
+from datetime import datetime, timezone
+from p3sub.utils import nsToString, nsToTs, stringToNs, stringToTs, tsToNs, tsToString
+from random import Random
+import pytest
+
+HISTORIC_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+HISTORIC_PARSE  = '%Y-%m-%dT%H:%M:%S.%f%z'
+MAX_NS          = 253402300799999999000 # 9999-12-31T23:59:59.999999Z
+
+
+def randomNs( count ) :
+    rnd = Random( 0 )
+    return [ rnd.randrange( 0, MAX_NS // 1000 ) * 1000 for i in range( count ) ]
+
+
+@pytest.mark.parametrize( 'ns', [ 0, 1000, 999999000, 1000000000, 951782400000000000, 1700000000123456000, MAX_NS ] + randomNs( 2000 ))
+def test_roundTrip( ns ) :
+    s = nsToString( ns )
+
+    assert s == nsToTs( ns ).strftime( HISTORIC_FORMAT )
+    assert stringToNs( s ) == ns
+    assert datetime.strptime( s, HISTORIC_PARSE ) == nsToTs( ns )
+
+
+def test_subSecondPrecision() :
+    base = stringToNs( '2024-02-29T12:34:56.000000Z' )
+
+    assert nsToString( base + 1000 )      == '2024-02-29T12:34:56.000001Z'
+    assert nsToString( base + 123456000 ) == '2024-02-29T12:34:56.123456Z'
+    assert nsToString( base + 999999000 ) == '2024-02-29T12:34:56.999999Z'
+    assert stringToNs( '2024-02-29T12:34:56.000001Z' ) - base == 1000
+    assert stringToNs( '2024-02-29T12:34:56.999999Z' ) - base == 999999000
+
+
+def test_truncatesBelowMicroseconds() :
+    base = stringToNs( '2024-02-29T12:34:56.123456Z' )
+
+    assert nsToString( base + 999 ) == '2024-02-29T12:34:56.123456Z'
+    assert tsToNs( nsToTs( base + 999 )) == base
+
+
+def test_datetimeConversions() :
+    ts = datetime( 2001, 2, 3, 4, 5, 6, 789012, tzinfo=timezone.utc )
+
+    assert tsToString( ts ) == '2001-02-03T04:05:06.789012Z'
+    assert stringToTs( '2001-02-03T04:05:06.789012Z' ) == ts
+    assert tsToNs( ts.replace( tzinfo=None )) == tsToNs( ts ) # naive means UTC
+
+
+@pytest.mark.parametrize( 's', [
+        '2001-02-03T04:05:06.789012+0000',
+        '2001-02-03T04:05:06.789012+01:00',
+        '2001-02-03T04:05:06.789012-0530',
+        '2001-02-03T04:05:06.7Z',
+        '2001-02-03T04:05:06.789Z' ])
+def test_strptimeFallback( s ) :
+    # not in wire format, but accepted as before
+    assert stringToNs( s ) == tsToNs( datetime.strptime( s, HISTORIC_PARSE ))
+
+
+def test_fallbackHonorsOffset() :
+    assert stringToNs( '2001-02-03T05:05:06.789012+01:00' ) == stringToNs( '2001-02-03T04:05:06.789012Z' )
+
+
+@pytest.mark.parametrize( 's', [
+        '2001-02-30T04:05:06.789012Z',
+        '2001-02-03T24:05:06.789012Z',
+        '2001-02-03T04:60:06.789012Z',
+        '2001-02-03T04:05:60.789012Z',
+        '2001-02-03 04:05:06.789012Z',
+        '2001-02-03T04:05:06Z',
+        '' ])
+def test_invalid( s ) :
+    with pytest.raises( ValueError ) :
+        stringToNs( s )
@@ -5,41 +5,38 @@
 # Copyright (C) 2014 and later, Indie Computing Corp. All rights reserved. License: see package.
 #
 
-import json
+import atexit
+import functools
 import logging
-import logging.config
+import marshal
+import math
 import os.path
+import queue
 import sys
+import threading
+import time
 import traceback
-import ubos.utils
-
-
-# initialize with something in case there's an error before logging is initialized
-logging.config.dictConfig({
-    'version'                  : 1,
-    'disable_existing_loggers' : False,
-    'formatters'               : {
-        'standard' : {
-            'format' : '%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-            'datefmt' : '%Y%m%d-%H%M%S'
-        },
-    },
-    'handlers' : {
-        'default' : {
-            'level'     : 'DEBUG',
-            'formatter' : 'standard',
-            'class'     : 'logging.StreamHandler',
-            'stream'    : 'ext://sys.stderr'
-        }
-    },
-    'loggers' : {
-        '' : { # root logger
-            'handlers'  : [ 'default' ],
-            'level'     : 'WARNING',
-            'propagate' : True
-        }
-    }
-})
+import zlib
+
+
+# Emit something in case there's an error before logging is initialized. This is
+# only used while no other handlers have been configured, so initialize does not
+# need to undo it.
+_defaultHandler = logging.StreamHandler(sys.stderr)
+_defaultHandler.setLevel(logging.DEBUG)
+_defaultHandler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s', '%Y%m%d-%H%M%S'))
+logging.lastResort = _defaultHandler
+logging.root.setLevel(logging.WARNING)
+
+_spansActive    = False
+_spans          = {} # span name -> _SpanHistogram
+_spansLock      = threading.Lock()
+_spansDumpStop  = None # threading.Event to stop periodic dumping, if any
+_spansAtexit    = False
+
+_confCache      = {} # log configuration file name -> ( stat key, compiled configuration )
+_confCacheDir   = None # directory for compiled log configurations across processes; off unless configured
+_confCacheRacyNs = 2000000000 # files modified more recently than this are not cached
 
 DEBUG = False
 LOG   = logging.getLogger((sys.argv[0][ sys.argv[0].rfind('/')+1 : ] if sys.argv[0].rfind('/') >= 0 else sys.argv[0]) + "-uninitialized" )
@@ -50,7 +47,9 @@ def initialize(
         verbosity   = 0,
         logConfFile = None,
         debug       = False,
-        confFileDir = '/etc/ubos' ):
+        confFileDir = '/etc/ubos',
+        queueSize   = 0,
+        whenFull    = 'drop' ):
     """
     Invoked at the beginning of a script, this initializes logging.
 
@@ -60,6 +59,9 @@ def initialize(
     verbosity: integer capturing the level of verbosity (0 and higher)
     debug: yes or no: if yes, stop and wait for keyboard input in key locations
     confFileDir: name of the directory in which to log for log configuration files
+    queueSize: if larger than 0, emit log records asynchronously from a background
+        thread, through a queue that holds at most this many records
+    whenFull: if the queue is full: 'drop' the record, or 'block' until there is space
     """
     global LOG
     global DEBUG
@@ -79,7 +81,14 @@ def initialize(
     if not os.path.exists( logConfFile ):
         fatal( 'Logging configuration file not found:', logConfFile );
 
-    logging.config.fileConfig( logConfFile );
+    if whenFull not in ( 'drop', 'block' ):
+        fatal( 'Invalid log queue policy, must be drop or block:', whenFull )
+
+    _stopQueue()
+    _applyLogConfig( logConfFile )
+
+    if queueSize > 0:
+        _startQueue( queueSize, whenFull == 'block' )
 
     DEBUG = debug;
     LOG   = logging.getLogger( moduleName )
@@ -91,14 +100,37 @@ def initialize(
         LOG.setLevel('DEBUG')
 
 
+class Lazy:
+    """
+    A message component that is only computed if the message is actually
+    emitted, e.g. ubos.logging.trace( 'State:', ubos.logging.Lazy( json.dumps, state ))
+    """
+    __slots__ = ( 'theFunction', 'theArgs', 'theKwargs' )
+
+    def __init__(self, function, *args, **kwargs):
+        """
+        function: the function computing the message component
+        args, kwargs: the arguments to invoke the function with
+        """
+        self.theFunction = function
+        self.theArgs     = args
+        self.theKwargs   = kwargs
+
+
+    def __str__(self):
+        return str(self.theFunction(*self.theArgs, **self.theKwargs))
+
+
 def trace(*args):
     """
-    Emit a trace message.
+    Emit a trace message. While trace logging is off, this only costs the
+    logger's cached level check, and the message is not constructed.
 
     args: the message or message components
     """
     if LOG.isEnabledFor(logging.DEBUG):
-        LOG.debug(_constructMsg(True, False, args))
+        frame = sys._getframe(1)
+        LOG.debug(_Message((frame.f_code, frame.f_lineno), False, args))
 
 
 def isTraceActive() :
@@ -117,7 +149,7 @@ def info(*args):
     args: msg: the message or message components
     """
     if LOG.isEnabledFor(logging.INFO):
-        LOG.info(_constructMsg(False, False, args))
+        LOG.info(_Message(None, False, args))
 
 
 def isInfoActive():
@@ -137,7 +169,7 @@ def warning(*args):
     """
 
     if LOG.isEnabledFor(logging.WARNING):
-        LOG.warn(_constructMsg(False, LOG.isEnabledFor(logging.DEBUG), args))
+        LOG.warning(_Message(None, LOG.isEnabledFor(logging.DEBUG), args))
 
 
 def isWarningActive():
@@ -156,7 +188,7 @@ def error(*args):
     args: the message or message components
     """
     if LOG.isEnabledFor(logging.ERROR):
-        LOG.error(_constructMsg(False, LOG.isEnabledFor(logging.DEBUG), args))
+        LOG.error(_Message(None, LOG.isEnabledFor(logging.DEBUG), args))
 
 
 def isErrorActive():
@@ -176,8 +208,9 @@ def fatal(*args):
     """
     if args:
         if LOG.isEnabledFor(logging.CRITICAL):
-            LOG.critical(_constructMsg(False, LOG.isEnabledFor(logging.DEBUG), args))
+            LOG.critical(_Message(None, LOG.isEnabledFor(logging.DEBUG), args))
 
+    flush()
     raise SystemExit(255) # Don't call exit() because that will close stdin
 
 
@@ -190,6 +223,140 @@ def isFatalActive():
     return LOG.isEnabledFor(logging.CRITICAL)
 
 
+def flush():
+    """
+    If log records are emitted asynchronously, wait until all records queued
+    so far have been emitted.
+    """
+    handler = _queueHandler
+    if handler is not None:
+        handler.flush()
+
+
+def droppedCount():
+    """
+    Determine how many log records have been dropped because the log queue was full.
+
+    return: number of dropped records
+    """
+    return _queueHandler.theDropped if _queueHandler is not None else _droppedBefore
+
+
+def configureConfCache(cacheDir):
+    """
+    Configure where initialize keeps compiled log configurations, so they do
+    not have to be parsed again by the next process. Off by default. The
+    compiled configurations contain the handler arguments, which are evaluated
+    like logging.config.fileConfig does, so the directory must be as
+    trustworthy as the log configuration files themselves. Cached files are
+    only used if they and the directory are owned by the current user and not
+    writable by anybody else.
+
+    cacheDir: the directory, or None to not keep them across processes
+    """
+    global _confCacheDir
+
+    _confCacheDir = cacheDir
+
+
+def span(name):
+    """
+    Time how long the enclosed code takes, and aggregate it with all other
+    spans of the same name, e.g. with ubos.logging.span( 'deploy' ): ...
+    Does not do anything unless enableSpans has been invoked.
+
+    name: name of the span
+    return: the context manager
+    """
+    if _spansActive:
+        return _Span(name)
+    return _noSpan
+
+
+def timed(name):
+    """
+    Decorator that times each invocation of the decorated function as a span.
+    Does not do anything unless enableSpans has been invoked.
+
+    name: name of the span
+    return: the decorator
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _spansActive:
+                return f(*args, **kwargs)
+
+            start = time.perf_counter_ns()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _recordSpan(name, time.perf_counter_ns() - start)
+
+        return wrapper
+    return decorator
+
+
+def enableSpans(dumpInterval = None):
+    """
+    Start recording spans. The aggregates are emitted as info messages when the
+    process exits, and optionally also periodically.
+
+    dumpInterval: if given, also emit the aggregates every this many seconds
+    """
+    global _spansActive
+    global _spansDumpStop
+    global _spansAtexit
+
+    disableSpans()
+    _spansActive = True
+
+    if not _spansAtexit:
+        atexit.register(dumpSpans)
+        _spansAtexit = True
+
+    if dumpInterval:
+        stop = threading.Event()
+        def dumpPeriodically():
+            while not stop.wait(dumpInterval):
+                dumpSpans()
+
+        _spansDumpStop = stop
+        threading.Thread(target=dumpPeriodically, name='ubos-logging-spans', daemon=True).start()
+
+
+def disableSpans():
+    """
+    Stop recording spans. Aggregates recorded so far are kept.
+    """
+    global _spansActive
+    global _spansDumpStop
+
+    _spansActive = False
+    if _spansDumpStop is not None:
+        _spansDumpStop.set()
+        _spansDumpStop = None
+
+
+def spanStats():
+    """
+    Obtain the aggregates of the spans recorded so far.
+
+    return: dict of span name to dict with count, and sum, p50, p95, p99 and max in seconds
+    """
+    with _spansLock:
+        return { name: h.asDict() for name, h in _spans.items() }
+
+
+def dumpSpans():
+    """
+    Emit the aggregates of the spans recorded so far as info messages.
+    """
+    for name, stats in sorted(spanStats().items()):
+        info('Span %s: count=%d sum=%.1fus p50=%.1fus p95=%.1fus p99=%.1fus max=%.1fus' % (
+                name, stats['count'], stats['sum'] * 1e6, stats['p50'] * 1e6, stats['p95'] * 1e6, stats['p99'] * 1e6, stats['max'] * 1e6 ))
+
+
 def isDebugAndSuspendActive():
     """
     Is debug logging and suspending on?
@@ -208,7 +375,7 @@ def debugAndSuspend(*args):
     """
     if DEBUG:
         if args:
-            sys.stderr.write("DEBUG: " + _constructMsg(False, False, args) + "\n")
+            sys.stderr.write("DEBUG: " + _constructMsg(None, False, args) + "\n")
 
         sys.stderr.write("** Hit return to continue. ***\n")
         input();
@@ -216,24 +383,623 @@ def debugAndSuspend(*args):
     return DEBUG;
 
 
-def _constructMsg(withLoc, withTb, *args):
+class _QueueHandler(logging.Handler):
+    """
+    Puts log records into a bounded queue, from which a background thread
+    passes them on to the actual handlers. Drops records or blocks if the
+    queue is full.
+    """
+    def __init__(self, queueSize, block, handlers):
+        """
+        queueSize: maximum number of records in the queue
+        block: if True, block while the queue is full; otherwise drop the record
+        handlers: the handlers that emit the records
+        """
+        # Records that no handler is going to emit do not need to be queued
+        super().__init__(min(( h.level for h in handlers ), default=logging.NOTSET))
+
+        self.theQueue       = queue.Queue(queueSize)
+        self.theBlock       = block
+        self.theHandlers    = handlers
+        self.theDropped     = _droppedBefore
+        self.theDroppedLock = threading.Lock()
+        self.theThread      = threading.Thread(target=self._run, name='ubos-logging', daemon=True)
+
+
+    def emit(self, record):
+        # Construct the message right away, while its arguments are known not to change
+        msg = self.format(record)
+
+        record.message    = msg
+        record.msg        = msg
+        record.args       = None
+        record.exc_info   = None
+        record.exc_text   = None
+        record.stack_info = None
+
+        if self.theBlock:
+            self.theQueue.put(record)
+        else:
+            try:
+                self.theQueue.put_nowait(record)
+            except queue.Full:
+                with self.theDroppedLock:
+                    self.theDropped += 1
+
+
+    def start(self):
+        self.theThread.start()
+
+
+    def stop(self):
+        self.theQueue.put(None) # must not get lost even if the queue is full
+        self.theThread.join()
+
+
+    def flush(self):
+        if threading.current_thread() is not self.theThread:
+            self.theQueue.join()
+
+
+    def _run(self):
+        while True:
+            record = self.theQueue.get()
+            try:
+                if record is None:
+                    return
+                for h in self.theHandlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+            finally:
+                self.theQueue.task_done()
+
+
+_queueHandler   = None
+_droppedBefore  = 0 # carried over if initialize is invoked more than once
+_atexitDone     = False
+
+
+def _startQueue(queueSize, block):
+    """
+    Route all records of the root logger through a queue to its current
+    handlers, which then run on a background thread.
+
+    queueSize: maximum number of records in the queue
+    block: if True, block while the queue is full; otherwise drop records
+    """
+    global _queueHandler
+    global _atexitDone
+
+    root     = logging.getLogger()
+    handlers = list(root.handlers)
+
+    _queueHandler = _QueueHandler(queueSize, block, handlers)
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(_queueHandler)
+    _queueHandler.start()
+
+    if not _atexitDone:
+        atexit.register(_stopQueue)
+        _atexitDone = True
+
+
+def _stopQueue():
+    """
+    Emit all queued records, stop the background thread, and return to
+    emitting records synchronously.
+    """
+    global _queueHandler
+    global _droppedBefore
+
+    if _queueHandler is None:
+        return
+
+    _queueHandler.stop()
+
+    root = logging.getLogger()
+    root.removeHandler(_queueHandler)
+    for h in _queueHandler.theHandlers:
+        root.addHandler(h)
+
+    dropped = _queueHandler.theDropped - _droppedBefore
+    _droppedBefore = _queueHandler.theDropped
+    _queueHandler  = None
+
+    if dropped > 0:
+        warning('Dropped log records because the log queue was full:', dropped)
+
+
+def _applyLogConfig(logConfFile):
+    """
+    Configure logging from this file, like logging.config.fileConfig would.
+    Handlers whose classes have not been imported yet are only imported and
+    created once the first log record is routed to them.
+
+    logConfFile: the log configuration file
+    """
+    compiled = _compiledLogConfig(logConfFile)
+    if compiled is None:
+        # something we don't know how to compile: let Python deal with it
+        from logging.config import fileConfig
+        fileConfig(logConfFile)
+        return
+
+    formatters = {}
+    for name, ( fmt, datefmt, style, className ) in compiled['formatters'].items():
+        formatters[name] = _resolveLogClass(className or 'Formatter')(fmt, datefmt, style)
+
+    handlers = {}
+    for name, spec in compiled['handlers'].items():
+        formatter = formatters[spec[4]] if spec[4] else None
+        if _isLogClassImported(spec[0]):
+            handlers[name] = _createLogHandler(name, spec, formatter)
+        else:
+            _checkLogHandlerSpec(spec) # report configuration errors now, not on first use
+            handlers[name] = _DeferredHandler(name, spec, formatter)
+
+    ( level, handlerNames ) = compiled['root']
+    _installLogHandlers(logging.root, level, handlerNames, handlers)
+
+    existing     = sorted(logging.root.manager.loggerDict.keys())
+    childLoggers = []
+    for ( qualname, level, propagate, handlerNames ) in compiled['loggers']:
+        logger = logging.getLogger(qualname)
+        if qualname in existing:
+            childLoggers += [ e for e in existing if e.startswith(qualname + '.') ]
+            existing.remove(qualname)
+
+        _installLogHandlers(logger, level, handlerNames, handlers)
+        logger.propagate = propagate
+        logger.disabled  = False
+
+    # same as fileConfig: disable loggers not mentioned in the configuration, except children
+    for name in existing:
+        logger = logging.root.manager.loggerDict[name]
+        if name in childLoggers:
+            if not isinstance(logger, logging.PlaceHolder):
+                logger.setLevel(logging.NOTSET)
+                logger.handlers  = []
+                logger.propagate = True
+        else:
+            logger.disabled = True
+
+
+def _installLogHandlers(logger, level, handlerNames, handlers):
+    """
+    Replace the handlers of a logger, and set its level.
+
+    logger: the logger
+    level: the level, or None to leave it unchanged
+    handlerNames: names of the handlers that the logger shall have
+    handlers: all configured handlers, keyed by name
+    """
+    if level is not None:
+        logger.setLevel(level)
+
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.flush()
+        h.close()
+
+    for name in handlerNames:
+        logger.addHandler(handlers[name])
+
+
+def _compiledLogConfig(logConfFile):
+    """
+    Obtain the compiled form of a log configuration file: from memory, from
+    the cache directory, or by parsing it. The result is only reused as long
+    as the file's mtime and size remain the same.
+
+    logConfFile: the log configuration file
+    return: the compiled configuration, or None if it cannot be compiled
+    """
+    absFileName = os.path.abspath(logConfFile)
+    try:
+        st = os.stat(absFileName)
+    except OSError:
+        return None
+
+    statKey = ( st.st_mtime_ns, st.st_size, st.st_ino )
+    entry   = _confCache.get(absFileName)
+    if entry is not None and entry[0] == statKey:
+        return entry[1]
+
+    cacheFile = None
+    if _confCacheDir is not None:
+        cacheFile = os.path.join(_confCacheDir, '%08x.marshal' % zlib.crc32(absFileName.encode()))
+        try:
+            with open(cacheFile, 'rb') as fd:
+                if not _isTrustedCacheFile(fd.fileno()) or not _isTrustedCacheFile(_confCacheDir):
+                    raise ValueError('Untrusted cache file')
+                ( cachedFileName, cachedStatKey, ret ) = marshal.load(fd)
+            if cachedFileName == absFileName and tuple(cachedStatKey) == statKey:
+                _confCache[absFileName] = ( statKey, ret )
+                return ret
+
+        except ( OSError, EOFError, ValueError, TypeError ):
+            pass # not there, or unusable
+
+    ret = _compileLogConfig(absFileName)
+    if ret is None or time.time_ns() - st.st_mtime_ns < _confCacheRacyNs:
+        # could still change without changing mtime, so don't remember
+        return ret
+
+    _confCache[absFileName] = ( statKey, ret )
+    if cacheFile is not None:
+        tmpFile = '%s.%d.tmp' % ( cacheFile, os.getpid() )
+        try:
+            os.makedirs(_confCacheDir, mode=0o700, exist_ok=True)
+            with open(os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as fd:
+                marshal.dump(( absFileName, statKey, ret ), fd)
+            os.replace(tmpFile, cacheFile)
+
+        except ( OSError, ValueError ):
+            try:
+                os.unlink(tmpFile)
+            except OSError:
+                pass
+
+    return ret
+
+
+def _isTrustedCacheFile(fileOrFd):
+    """
+    Determine whether a cache file or directory may be trusted: it must be
+    owned by the effective user and not be writable by group or others.
+
+    fileOrFd: the path, or an open file descriptor
+    return: True or False
+    """
+    st = os.stat(fileOrFd)
+    return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+
+def _compileLogConfig(logConfFile):
+    """
+    Parse a log configuration file in the format of logging.config.fileConfig
+    into a structure that marshal can save, without creating anything yet.
+
+    logConfFile: the log configuration file
+    return: the compiled configuration, or None if it cannot be compiled
+    """
+    import configparser
+
+    def names(value):
+        return [ n.strip() for n in value.split(',') if n.strip() ]
+
+    try:
+        cp = configparser.ConfigParser()
+        if not cp.read(logConfFile):
+            return None
+
+        formatters = {}
+        for name in names(cp['formatters']['keys']):
+            section = 'formatter_' + name
+            formatters[name] = (
+                    cp.get(section, 'format',  raw=True, fallback=None),
+                    cp.get(section, 'datefmt', raw=True, fallback=None),
+                    cp.get(section, 'style',   raw=True, fallback='%'),
+                    cp[section].get('class'))
+
+        handlers = {}
+        for name in names(cp['handlers']['keys']):
+            section = cp['handler_' + name]
+            if 'target' in section:
+                return None # MemoryHandler and the like
+            handlers[name] = (
+                    section['class'],
+                    section.get('args', '()'),
+                    section.get('kwargs', '{}'),
+                    section.get('level'),
+                    section.get('formatter', ''))
+
+        section = cp['logger_root']
+        root    = ( section.get('level'), names(section['handlers']) )
+
+        loggers = []
+        for name in names(cp['loggers']['keys']):
+            if name == 'root':
+                continue
+            section = cp['logger_' + name]
+            loggers.append((
+                    section['qualname'],
+                    section.get('level'),
+                    section.getint('propagate', fallback=1),
+                    names(section['handlers'])))
+
+    except ( configparser.Error, KeyError, ValueError ):
+        return None # let fileConfig report the problem
+
+    return {
+        'formatters' : formatters,
+        'handlers'   : handlers,
+        'root'       : root,
+        'loggers'    : loggers
+    }
+
+
+def _createLogHandler(name, spec, formatter):
+    """
+    Create a handler according to its compiled configuration.
+
+    name: name of the handler
+    spec: tuple of class name, args and kwargs expressions, level and formatter name
+    formatter: the formatter, or None
+    return: the handler
+    """
+    ( className, args, kwargs, level, _ ) = spec
+
+    ret = _resolveLogClass(className)(*eval(args, vars(logging)), **eval(kwargs, vars(logging)))
+    ret.name = name
+    if level is not None:
+        ret.setLevel(level)
+    if formatter is not None:
+        ret.setFormatter(formatter)
+    return ret
+
+
+def _checkLogHandlerSpec(spec):
+    """
+    Check, as far as possible without importing it, that a handler can be
+    created according to its compiled configuration: its module can be found,
+    and its args and kwargs can be evaluated. Raises the same kind of
+    exception as logging.config.fileConfig would otherwise.
+
+    spec: tuple of class name, args and kwargs expressions, level and formatter name
+    """
+    import importlib.util
+
+    ( className, args, kwargs, _, _ ) = spec
+
+    moduleName = className[ : className.rfind('.') ]
+    if importlib.util.find_spec(moduleName) is None: # raises ModuleNotFoundError if a parent package is missing
+        raise ModuleNotFoundError('No module named %r' % moduleName, name=moduleName)
+
+    eval(args, vars(logging))
+    eval(kwargs, vars(logging))
+
+
+def _isLogClassImported(className):
+    """
+    Determine whether the module defining this class has been imported already.
+
+    className: name of the class, relative to the logging module or fully qualified
+    return: True or False
+    """
+    if '.' not in className:
+        return True # in the logging module
+    return className[ : className.rfind('.') ] in sys.modules
+
+
+def _resolveLogClass(className):
+    """
+    Find a class by name, importing its module if needed, the same way
+    logging.config.fileConfig does.
+
+    className: name of the class, relative to the logging module or fully qualified
+    return: the class
+    """
+    try:
+        return eval(className, vars(logging))
+    except ( AttributeError, NameError ):
+        pass
+
+    parts = className.split('.')
+    used  = parts.pop(0)
+    ret   = __import__(used)
+    for part in parts:
+        used += '.' + part
+        try:
+            ret = getattr(ret, part)
+        except AttributeError:
+            __import__(used)
+            ret = getattr(ret, part)
+    return ret
+
+
+class _DeferredHandler(logging.Handler):
+    """
+    Stands in for a configured handler whose class has not been imported yet.
+    Imports and creates it when the first log record is routed to it. If that
+    fails after all, the error is reported, and records go to stderr instead.
+    """
+    def __init__(self, name, spec, formatter):
+        """
+        name: name of the handler
+        spec: tuple of class name, args and kwargs expressions, level and formatter name
+        formatter: the formatter, or None
+        """
+        super().__init__(spec[3] if spec[3] is not None else logging.NOTSET)
+
+        self.name         = name
+        self.theSpec      = spec
+        self.theFormatter = formatter
+        self.theHandler   = None
+
+
+    def emit(self, record):
+        if self.theHandler is None:
+            try:
+                self.theHandler = _createLogHandler(self.name, self.theSpec, self.theFormatter)
+            except Exception:
+                self.handleError(record)
+                self.theHandler = _defaultHandler
+
+        self.theHandler.handle(record)
+
+
+    def flush(self):
+        if self.theHandler is not None:
+            self.theHandler.flush()
+
+
+    def close(self):
+        if self.theHandler is not None and self.theHandler is not _defaultHandler:
+            self.theHandler.close()
+        super().close()
+
+
+class _Span:
+    """
+    Times one span, when spans are enabled.
+    """
+    __slots__ = ( 'theName', 'theStart' )
+
+    def __init__(self, name):
+        self.theName  = name
+        self.theStart = 0
+
+
+    def __enter__(self):
+        self.theStart = time.perf_counter_ns()
+        return self
+
+
+    def __exit__(self, excType, excValue, tb):
+        _recordSpan(self.theName, time.perf_counter_ns() - self.theStart)
+        return False
+
+
+class _NoSpan:
+    """
+    Stands in for a span, when spans are disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+
+_noSpan = _NoSpan()
+
+
+class _SpanHistogram:
+    """
+    The aggregated durations of all spans with the same name. Durations are
+    counted in buckets about 5% wide, so percentiles are accurate to about 5%
+    no matter how many spans were recorded.
+    """
+    __slots__ = ( 'theCount', 'theSum', 'theMax', 'theBuckets' )
+
+    BUCKET_WIDTH = math.log(1.05)
+
+    def __init__(self):
+        self.theCount   = 0
+        self.theSum     = 0
+        self.theMax     = 0
+        self.theBuckets = {} # bucket index -> count
+
+
+    def add(self, ns):
+        """
+        Add the duration of one span.
+
+        ns: the duration, in nanoseconds
+        """
+        self.theCount += 1
+        self.theSum   += ns
+        if ns > self.theMax:
+            self.theMax = ns
+
+        bucket = int(math.log(ns) / _SpanHistogram.BUCKET_WIDTH) if ns > 1 else 0
+        self.theBuckets[bucket] = self.theBuckets.get(bucket, 0) + 1
+
+
+    def percentile(self, p):
+        """
+        Estimate a percentile of the durations.
+
+        p: the percentile, 0..100
+        return: the duration, in nanoseconds
+        """
+        rank  = max(1, math.ceil(p * self.theCount / 100.0))
+        count = 0
+        for bucket in sorted(self.theBuckets):
+            count += self.theBuckets[bucket]
+            if count >= rank:
+                return min(math.exp(( bucket + 0.5 ) * _SpanHistogram.BUCKET_WIDTH), self.theMax)
+        return self.theMax
+
+
+    def asDict(self):
+        return {
+            'count' : self.theCount,
+            'sum'   : self.theSum / 1e9,
+            'p50'   : self.percentile(50) / 1e9,
+            'p95'   : self.percentile(95) / 1e9,
+            'p99'   : self.percentile(99) / 1e9,
+            'max'   : self.theMax / 1e9
+        }
+
+
+def _recordSpan(name, ns):
+    """
+    Record the duration of one span.
+
+    name: name of the span
+    ns: the duration, in nanoseconds
+    """
+    with _spansLock:
+        h = _spans.get(name)
+        if h is None:
+            h = _SpanHistogram()
+            _spans[name] = h
+        h.add(ns)
+
+
+_locations = {} # ( code, line number ) -> location string
+
+
+class _Message:
+    """
+    A log message that is only constructed when the first log handler
+    actually emits it, and only once.
+    """
+    __slots__ = ( 'theLoc', 'theWithTb', 'theArgs', 'theStr' )
+
+    def __init__(self, loc, withTb, args):
+        """
+        loc: tuple of code and line number of the call site, or None
+        withTb: construct message with traceback if an exception is the last argument
+        args: the message or message components
+        """
+        self.theLoc    = loc
+        self.theWithTb = withTb
+        self.theArgs   = args
+        self.theStr    = None
+
+
+    def __str__(self):
+        if self.theStr is None:
+            self.theStr = _constructMsg(self.theLoc, self.theWithTb, self.theArgs)
+        return self.theStr
+
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+def _constructMsg(loc, withTb, args):
     """
     Construct a message from these arguments.
 
-    withLoc: construct message with location info
+    loc: tuple of code and line number of the call site, or None for no location info
     withTb: construct message with traceback if an exception is the last argument
     args: the message or message components
     return: string message
     """
-    if withLoc:
-        frame  = sys._getframe(2)
-        loc    = frame.f_code.co_filename
-        loc   += '#'
-        loc   += str(frame.f_lineno)
-        loc   += ' '
-        loc   += frame.f_code.co_name
-        loc   += ':'
-        ret = loc
+    if loc:
+        ret = _locations.get(loc)
+        if ret is None:
+            ( code, line ) = loc
+            ret = '%s#%d %s:' % ( code.co_filename, line, code.co_name )
+            _locations[loc] = ret
     else:
         ret = ''
 
@@ -253,11 +1019,11 @@ def _constructMsg(withLoc, withTb, *args):
             return type(a).__name__ + ' ' + str(a)
         return a
 
-    args2 = map(m, *args)
+    args2 = map(m, args)
     ret += ' '.join(map(lambda o: str(o), args2))
 
-    if withTb and len(*args) > 0:
-        *_, last = iter(*args)
+    if withTb and len(args) > 0:
+        last = args[-1]
         if isinstance(last, BaseException):
             ret += ''.join(traceback.format_exception(type(last), last, last.__traceback__))
 
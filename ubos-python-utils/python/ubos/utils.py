@@ -6,19 +6,48 @@
 #
 
 import calendar
+import copy
+import grp
+from collections import namedtuple, OrderedDict
+import hashlib
+import io
 import json
+import marshal
+import mmap
 import os
 from pathlib import Path
 import pkgutil
 import pwd
 import re
+import selectors
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import ubos.logging
 
+_msgspec = False # optional fast JSON engine: False if not imported yet, None if not available
+
 _now = int( time.time() )
 
+# a JSON string, or a # comment that extends to the end of the line
+_jsonStringOrComment = re.compile( rb'"[^"\\]*(?:\\.[^"\\]*)*"|#[^\n]*' )
+
+# cache for readJsonFromFile( ..., cached=True )
+_jsonCache           = OrderedDict() # ( absolute path, asType ) -> ( stat key, parsed JSON ), least recently used first
+_jsonCacheMaxEntries = 256
+_jsonCacheDir        = None
+_jsonCacheLock       = threading.Lock()
+_jsonCacheRacyNs     = 2000000000 # files modified more recently than this are not cached
+
+# process-wide caches of resolved users and groups, in both directions
+_uidByName  = {}
+_unameByUid = {}
+_gidByName  = {}
+_gnameByGid = {}
+
 def now() :
     """
     Obtain the UNIX system time when the script(s) started running
@@ -28,22 +57,29 @@ def now() :
     return _now
 
 
-def readJsonFromFile( fileName, msg = None ):
+def readJsonFromFile( fileName, msg = None, asType = None, cached = False ):
     """
     Read and parse JSON from a file. In addition, accept # for comments.
 
     fileName: the JSON file to read
     msg: if an error occurs, use this error message
+    asType: if given, decode into this type, e.g. a msgspec.Struct; requires msgspec
+    cached: if True, return a copy of the result of an earlier parse of the same,
+            unchanged file, if available. The caller may modify it.
     return: the parsed JSON
     """
     ubos.logging.trace( fileName )
+    _checkCanDecodeAs( asType )
 
     try :
-        with open(fileName, 'r') as fd:
+        if cached:
+            return _readJsonFromFileCached( fileName, asType )
+
+        with open(fileName, 'rb') as fd:
             jsonContent = fd.read()
 
-        jsonContent = re.sub(r'(?<!\\)#.*', '', jsonContent)
-        ret         = json.loads(jsonContent)
+        jsonContent = stripJsonComments( jsonContent )
+        ret         = _decodeJson( jsonContent, asType )
         return ret
 
     except:
@@ -55,17 +91,172 @@ def readJsonFromFile( fileName, msg = None ):
         return None
 
 
-def readJsonFromString( s, msg = None ) :
+def configureJsonCache( maxEntries = 256, cacheDir = None ) :
+    """
+    Configure the cache used by readJsonFromFile( ..., cached=True ).
+
+    maxEntries: the maximum number of parsed files to keep in memory
+    cacheDir: if given, also keep serialized parse results in this directory,
+              so that other processes can skip parsing as well. It must be
+              owned by the effective user, and not be writable by anybody
+              else; otherwise it is not used
+    """
+    global _jsonCacheMaxEntries
+    global _jsonCacheDir
+
+    with _jsonCacheLock:
+        _jsonCacheMaxEntries = maxEntries
+        _jsonCacheDir        = cacheDir
+        while len( _jsonCache ) > _jsonCacheMaxEntries:
+            _jsonCache.popitem( last=False )
+
+    if cacheDir is not None and not os.path.isdir( cacheDir ):
+        os.makedirs( cacheDir, 0o700, exist_ok=True )
+
+
+def invalidateJsonCache( fileName = None ) :
+    """
+    Remove a file, or all files, from the cache used by readJsonFromFile( ..., cached=True ),
+    in memory and on disk.
+
+    fileName: the JSON file; if None, invalidate everything
+    """
+    with _jsonCacheLock:
+        if fileName is None:
+            _jsonCache.clear()
+        else:
+            absFileName = os.path.abspath( fileName )
+            for key in [ k for k in _jsonCache if k[0] == absFileName ]:
+                del _jsonCache[key]
+
+    if _jsonCacheDir is not None:
+        if fileName is None:
+            toDelete = [ os.path.join( _jsonCacheDir, f ) for f in os.listdir( _jsonCacheDir ) if f.endswith( '.marshal' ) ]
+        else:
+            toDelete = [ _jsonDiskCacheFile( os.path.abspath( fileName )) ]
+
+        for f in toDelete:
+            try :
+                os.unlink( f )
+            except FileNotFoundError:
+                pass
+
+
+def _readJsonFromFileCached( fileName, asType ) :
+    """
+    Implementation of readJsonFromFile( ..., cached=True ). A cached result is
+    only used if the file's mtime, size and inode have not changed since.
+    Plain JSON is cached in serialized form, as unserializing it with marshal
+    is much faster than parsing it again, and every caller gets its own copy.
+
+    fileName: the JSON file to read
+    asType: if given, decode into this type; requires msgspec
+    return: the parsed JSON
+    """
+    absFileName = os.path.abspath( fileName )
+    st          = os.stat( absFileName )
+    statKey     = ( st.st_mtime_ns, st.st_size, st.st_ino, st.st_dev )
+    cacheKey    = ( absFileName, asType )
+
+    with _jsonCacheLock:
+        entry = _jsonCache.get( cacheKey )
+        if entry is not None and entry[0] == statKey:
+            _jsonCache.move_to_end( cacheKey )
+            return marshal.loads( entry[1] ) if asType is None else copy.deepcopy( entry[1] )
+
+    cached = None
+    if _jsonCacheDir is not None and asType is None: # typed results cannot be serialized
+        cached = _readJsonDiskCache( absFileName, statKey )
+
+    if cached is None:
+        with open(absFileName, 'rb') as fd:
+            jsonContent = fd.read()
+
+        ret = _decodeJson( stripJsonComments( jsonContent ), asType )
+
+        if time.time_ns() - st.st_mtime_ns < _jsonCacheRacyNs:
+            # could still change without changing mtime, so don't remember
+            return ret
+
+        cached = marshal.dumps( ret ) if asType is None else copy.deepcopy( ret )
+        if _jsonCacheDir is not None and asType is None:
+            _writeJsonDiskCache( absFileName, statKey, cached )
+
+    else:
+        ret = marshal.loads( cached )
+
+    with _jsonCacheLock:
+        _jsonCache[cacheKey] = ( statKey, cached )
+        _jsonCache.move_to_end( cacheKey )
+        while len( _jsonCache ) > _jsonCacheMaxEntries:
+            _jsonCache.popitem( last=False )
+
+    return ret
+
+
+def _jsonDiskCacheFile( absFileName ) :
+    return os.path.join( _jsonCacheDir, hashlib.sha256( absFileName.encode() ).hexdigest() + '.marshal' )
+
+
+def _readJsonDiskCache( absFileName, statKey ) :
+    """
+    Look for a serialized parse result of this file in the cache directory.
+    Only files and directories that nobody else can write are trusted.
+
+    return: the parsed JSON, serialized with marshal, or None
+    """
+    try :
+        with open( _jsonDiskCacheFile( absFileName ), 'rb' ) as fd:
+            if not ubos.logging._isTrustedCacheFile( fd.fileno() ) or not ubos.logging._isTrustedCacheFile( _jsonCacheDir ):
+                raise ValueError( 'Untrusted cache file' )
+            ( cachedFileName, cachedStatKey, ret ) = marshal.load( fd )
+
+        if cachedFileName == absFileName and tuple( cachedStatKey ) == statKey and isinstance( ret, bytes ):
+            return ret
+
+    except ( OSError, EOFError, ValueError, TypeError ) as e:
+        ubos.logging.trace( 'Cannot use JSON cache file for', absFileName, e ) # not there, or unusable
+
+    return None
+
+
+def _writeJsonDiskCache( absFileName, statKey, parsed ) :
+    """
+    Save a serialized parse result of this file in the cache directory.
+    Failure to do so is not an error.
+
+    parsed: the parsed JSON, serialized with marshal
+    """
+    cacheFile = _jsonDiskCacheFile( absFileName )
+    tmpFile   = '%s.%d.%d.tmp' % ( cacheFile, os.getpid(), threading.get_ident() )
+    try :
+        if not ubos.logging._isTrustedCacheFile( _jsonCacheDir ):
+            raise ValueError( 'Untrusted cache directory' )
+        with open( os.open( tmpFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 ), 'wb' ) as fd:
+            marshal.dump( ( absFileName, statKey, parsed ), fd )
+        os.replace( tmpFile, cacheFile )
+
+    except ( OSError, ValueError ) as e:
+        ubos.logging.trace( 'Cannot write JSON cache file', cacheFile, e )
+        try :
+            os.unlink( tmpFile )
+        except OSError:
+            pass
+
+
+def readJsonFromString( s, msg = None, asType = None ) :
     """
     Read and parse JSON from String
 
-    string: the JSON string
+    string: the JSON string, or bytes
     msg: if an error occurs, use this error message
+    asType: if given, decode into this type, e.g. a msgspec.Struct; requires msgspec
     return: JSON object
     """
+    _checkCanDecodeAs( asType )
 
     try:
-        ret = json.loads(s)
+        ret = _decodeJson( s, asType )
         return ret
 
     except:
@@ -77,38 +268,115 @@ def readJsonFromString( s, msg = None ) :
     return None
 
 
-def writeJsonToFile(fileName, j, mode=None ) :
+def writeJsonToFile(fileName, j, mode=None, compact=False, uid=-1, gid=-1, atomic=False, batch=None ) :
     """
     Write JSON to a file.
 
     fileName: name of the file to write
     j: the JSON object to write
     mode: the file permissions to set; default is: umask
+    compact: if True, do not pretty-print
+    uid: owner of the file
+    gid: group of the file
+    atomic: if True, readers see either the old or the new content, never a partial file
+    batch: if given, write atomically as part of this AtomicFileBatch
     """
-    with open(fileName, 'w') as fd:
-        json.dump(j, fd, indent=4, sort_keys=True)
+    _writeFile( fileName, writeJsonToString(j, compact).encode(), mode, uid, gid, atomic, batch )
 
-    if mode != None:
-        os.chmod( fileName, mode )
 
-
-def writeJsonToStdout(j) :
+def writeJsonToStdout(j, compact=False) :
     """
     Write JSON to stdout.
 
     j: the JSON object to write
+    compact: if True, do not pretty-print
     """
-    print(json.dumps(j, indent=4, sort_keys=True))
+    print(writeJsonToString(j, compact))
 
 
-def writeJsonToString(j) :
+def writeJsonToString(j, compact=False) :
     """
     Write JSON to a string
 
     j: the JSON object to write
+    compact: if True, do not pretty-print
     return: the string
     """
-    return json.dumps(j, indent=4, sort_keys=True)
+    # Always json, not msgspec: it formats floats and non-ASCII characters
+    # differently, and the output must not depend on what is installed
+    if not compact:
+        return json.dumps(j, indent=4, sort_keys=True)
+
+    return json.dumps(j, separators=(',', ':'), sort_keys=True)
+
+
+def stripJsonComments( jsonContent ) :
+    """
+    Remove # comments from JSON. Unlike a # inside a JSON string, a # outside
+    starts a comment that extends to the end of the line.
+
+    jsonContent: the JSON, as bytes
+    return: the JSON without comments, as bytes
+    """
+    if b'#' not in jsonContent:
+        return jsonContent
+
+    return _jsonStringOrComment.sub( lambda m: m.group(0) if m.group(0).startswith( b'"' ) else b'', jsonContent )
+
+
+def _msgspecIfAvailable() :
+    """
+    Import msgspec on first use only, as importing it takes a while.
+
+    return: the msgspec module, or None if it is not installed
+    """
+    global _msgspec
+
+    if _msgspec is False:
+        try :
+            import msgspec.json
+            _msgspec = msgspec
+        except ImportError :
+            _msgspec = None
+    return _msgspec
+
+
+def _checkCanDecodeAs( asType ) :
+    """
+    Decoding into a type needs msgspec. Rather than silently returning plain
+    dicts and lists without it, raise an error that is not taken for a JSON
+    parsing error.
+
+    asType: the type to decode into, or None
+    """
+    if asType is not None and _msgspecIfAvailable() is None:
+        raise ImportError( 'Decoding JSON into %s requires msgspec, which is not installed' % asType )
+
+
+def _decodeJson( jsonContent, asType ) :
+    """
+    Decode JSON with the fastest available engine.
+
+    jsonContent: the JSON, as bytes or string
+    asType: if given, decode into this type; requires msgspec
+    return: the decoded JSON
+    """
+    msgspec = _msgspecIfAvailable()
+    if msgspec is not None:
+        try :
+            if asType is None:
+                return msgspec.json.decode(jsonContent)
+            else:
+                return msgspec.json.decode(jsonContent, type=asType)
+
+        except msgspec.ValidationError:
+            raise
+        except msgspec.DecodeError:
+            if asType is not None:
+                raise
+            # json also accepts NaN, Infinity and the like
+
+    return json.loads(jsonContent)
 
 
 def myexec(cmd,stdin=None, captureStdout=False, captureStderr=False):
@@ -151,6 +419,291 @@ def myexec(cmd,stdin=None, captureStdout=False, captureStderr=False):
         return ret.returncode
 
 
+def myexecStream(cmd, stdout, stdin=None, stderr=None, lines=False, chunkSize=65536, timeout=None):
+    """
+    Like myexec, but pass on the command's output while it is being produced,
+    instead of collecting all of it in memory first.
+
+    cmd: the command to be executed by the shell, or a list of arguments to run without shell
+    stdout: where the command's stdout goes: a file name, a binary file, or a function
+            that is invoked with each chunk (or line) of output
+    stdin: content to be piped into the command, if any
+    stderr: where the command's stderr goes, like stdout; default: not captured
+    lines: if true, invoke functions with complete lines instead of arbitrary chunks
+    chunkSize: the maximum size of the chunks read
+    timeout: if given, kill the command, and all processes it started, once it
+             has run for this many seconds
+    return: return code; negative if the command was killed
+    """
+    if stdin :
+        try :
+            # make sure we have a bytes-like object
+            stdin = stdin.encode()
+        except:
+            pass
+
+    if stdin is None:
+        ubos.logging.debugAndSuspend('myexecStream:', cmd)
+    else:
+        ubos.logging.debugAndSuspend('myexecStream:', cmd, 'with stdin:', stdin)
+
+    ubos.logging.trace(cmd, 'None' if stdin==None else ( "with stdin of length %d " % len(stdin)))
+
+    toClose  = []
+    handlers = {} # pipe -> ( function to invoke with chunks, function to invoke at the end )
+
+    def destination( d ):
+        """
+        Determine what to give to Popen for this destination.
+        """
+        if d is None:
+            return None
+        if isinstance( d, str ):
+            f = open( d, 'wb' )
+            toClose.append( f )
+            return f # the command writes straight into the file
+        if hasattr( d, 'fileno' ):
+            try :
+                d.fileno()
+                d.flush()
+                return d
+            except (OSError, ValueError, io.UnsupportedOperation):
+                pass # e.g. BytesIO
+        return subprocess.PIPE
+
+    def handler( d ):
+        f = d.write if hasattr( d, 'write' ) else d
+        if lines:
+            return _lineSplitter( f, 16 * chunkSize )
+        return ( f, None )
+
+    sys.stdout.flush() # to emit things in order
+    try :
+        proc = subprocess.Popen(
+                cmd,
+                shell  = isinstance( cmd, str ),
+                stdin  = subprocess.PIPE if stdin is not None else None,
+                stdout = destination( stdout ),
+                stderr = destination( stderr ),
+                start_new_session = True) # so it can be killed with all the processes it started, e.g. a shell pipeline
+    finally:
+        for f in toClose:
+            f.close() # the child has its own copy
+
+    if proc.stdout is not None:
+        handlers[proc.stdout] = handler( stdout )
+    if proc.stderr is not None:
+        handlers[proc.stderr] = handler( stderr )
+
+    if stdin is not None:
+        def feed():
+            try :
+                proc.stdin.write( stdin )
+            except BrokenPipeError:
+                pass
+            finally:
+                try :
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+        feeder = threading.Thread( target=feed, daemon=True )
+        feeder.start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    timedOut = False
+
+    try :
+        with selectors.DefaultSelector() as sel:
+            for pipe in handlers:
+                sel.register( pipe, selectors.EVENT_READ )
+
+            while sel.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    timedOut = True
+                    break
+
+                for ( key, _ ) in sel.select( remaining ):
+                    chunk = os.read( key.fd, chunkSize )
+                    if chunk:
+                        handlers[key.fileobj][0]( chunk )
+                    else:
+                        sel.unregister( key.fileobj )
+
+        if not timedOut:
+            try :
+                proc.wait( None if deadline is None else max( 0, deadline - time.monotonic() ))
+            except subprocess.TimeoutExpired:
+                timedOut = True
+
+        if timedOut:
+            ubos.logging.error( 'Command timed out after', timeout, 'seconds, killing:', cmd )
+
+        for ( f, atEnd ) in handlers.values():
+            if atEnd is not None:
+                atEnd()
+
+    finally:
+        # also if interrupted, or if a function passed in raised an exception
+        if timedOut or proc.returncode is None:
+            try :
+                os.killpg( proc.pid, signal.SIGKILL )
+            except ProcessLookupError:
+                pass # all gone already
+            proc.wait()
+
+        for pipe in handlers:
+            pipe.close()
+
+    return proc.returncode
+
+
+def _lineSplitter( f, maxLength ) :
+    """
+    Wrap a function so it gets invoked with complete lines, even if it is
+    fed arbitrary chunks. Overly long lines are passed on in pieces.
+
+    f: the function to wrap
+    maxLength: the maximum length of data to hold back
+    return: tuple of function to feed chunks into, and function to invoke at the end
+    """
+    held = [ b'' ]
+
+    def feed( chunk ):
+        buf   = held[0] + chunk
+        start = 0
+        while True:
+            nl = buf.find( b'\n', start )
+            if nl < 0:
+                break
+            f( buf[start:nl+1] )
+            start = nl+1
+
+        held[0] = buf[start:]
+        if len( held[0] ) > maxLength:
+            f( held[0] )
+            held[0] = b''
+
+    def atEnd():
+        if held[0]:
+            f( held[0] )
+            held[0] = b''
+
+    return ( feed, atEnd )
+
+
+class ExecResult( namedtuple( 'ExecResult', [ 'cmd', 'returncode', 'duration', 'stdout', 'stderr' ] )) :
+    """
+    Outcome of a command run by ParallelExec.
+
+    cmd: the command
+    returncode: its exit code; like the shell, 127 if the command could not
+            be found, and 126 if it could not be run for another reason
+    duration: how long it ran, in seconds
+    stdout: the captured stdout, or None
+    stderr: the captured stderr, or None
+    """
+    __slots__ = ()
+
+
+class ParallelExec :
+    """
+    Runs a batch of independent commands concurrently, with a limit on how
+    many run at the same time. Commands given as a string are run by the
+    shell, like myexec does; commands given as a list of arguments are run
+    directly, without a shell.
+    """
+    def __init__( self, maxParallel = 8 ) :
+        """
+        maxParallel: the maximum number of commands to run at the same time
+        """
+        self.theMaxParallel = maxParallel
+        self.theCommands    = [] # ( cmd, stdin, captureStdout, captureStderr )
+
+
+    def submit( self, cmd, stdin=None, captureStdout=False, captureStderr=False ) :
+        """
+        Add a command to the batch.
+
+        cmd: the command, as string for the shell, or as list of arguments
+        stdin: content to be piped into the command, if any
+        captureStdout: if true, capture the command's stdout
+        captureStderr: if true, capture the command's stderr
+        return: index of the command's ExecResult in what run() returns
+        """
+        if stdin :
+            try :
+                # make sure we have a bytes-like object
+                stdin = stdin.encode()
+            except:
+                pass
+
+        self.theCommands.append( ( cmd, stdin, captureStdout, captureStderr ))
+        return len( self.theCommands ) - 1
+
+
+    def run( self ) :
+        """
+        Run all submitted commands, and wait until all of them are done.
+
+        return: list of ExecResult, in the sequence the commands were submitted
+        """
+        commands         = self.theCommands
+        self.theCommands = []
+
+        if not commands :
+            return []
+
+        ubos.logging.debugAndSuspend( 'myexec in parallel:', *[ c[0] for c in commands ] )
+
+        import concurrent.futures # only when needed, as it takes a while to import
+
+        sys.stdout.flush() # to emit things in order
+        with concurrent.futures.ThreadPoolExecutor( max_workers=min( self.theMaxParallel, len( commands ))) as executor:
+            return list( executor.map( lambda c : self._runOne( *c ), commands ))
+
+
+    def _runOne( self, cmd, stdin, captureStdout, captureStderr ) :
+        ubos.logging.trace( cmd, 'None' if stdin==None else ( "with stdin of length %d " % len(stdin)))
+
+        start = time.monotonic()
+        try :
+            ret = subprocess.run(
+                    cmd,
+                    shell  = isinstance( cmd, str ),
+                    input  = stdin,
+                    stdout = subprocess.PIPE if captureStdout else None,
+                    stderr = subprocess.PIPE if captureStderr else None)
+
+        except OSError as e:
+            # e.g. no such executable: report it like the shell would, without losing the other commands' results
+            ubos.logging.error( 'Cannot run command:', cmd, e )
+            return ExecResult(
+                    cmd,
+                    127 if isinstance( e, FileNotFoundError ) else 126,
+                    time.monotonic() - start,
+                    b'' if captureStdout else None,
+                    ( str( e ) + '\n' ).encode() if captureStderr else None )
+
+        return ExecResult( cmd, ret.returncode, time.monotonic() - start, ret.stdout, ret.stderr )
+
+
+def myexecParallel( cmds, maxParallel = 8, captureStdout=False, captureStderr=False ) :
+    """
+    Run independent commands concurrently, and wait until all are done.
+
+    cmds: the commands; each a string to be run by the shell, or a list of arguments
+    maxParallel: the maximum number of commands to run at the same time
+    captureStdout: if true, capture the commands' stdout
+    captureStderr: if true, capture the commands' stderr
+    return: list of ExecResult, in the sequence of cmds
+    """
+    pe = ParallelExec( maxParallel )
+    for cmd in cmds :
+        pe.submit( cmd, captureStdout=captureStdout, captureStderr=captureStderr )
+    return pe.run()
+
+
 def slurpFile( fileName ) :
     """
     Slurp the content of a file as a binary, without attempting any
@@ -172,19 +725,248 @@ def slurpFile( fileName ) :
         return None
 
 
-def saveFile(fileName, content, mode=None) :
+def slurpFileMapped( fileName ) :
+    """
+    Like slurpFile, but map the file into memory instead of reading it. No
+    copy is made, and pages are only read when accessed. The file must not
+    be truncated while the result is in use.
+
+    fileName: the name of the file to read
+    return: read-only memoryview of the content of the file
+    """
+    ubos.logging.trace( 'slurpFileMapped', fileName )
+
+    try :
+        with open(fileName, 'rb') as fd:
+            if os.fstat( fd.fileno() ).st_size == 0:
+                return memoryview( b'' ) # cannot map empty files
+
+            # the mapping remains valid after the file has been closed
+            ret = memoryview( mmap.mmap( fd.fileno(), 0, access=mmap.ACCESS_READ ))
+
+        return ret
+
+    except :
+        ubos.logging.error( 'Cannot read file', fileName );
+        return None
+
+
+def slurpFileChunks( fileName, blockSize = 1048576, readahead = True ) :
+    """
+    Like slurpFile, but return the content of the file in chunks, so it does
+    not need to be held in memory all at once.
+
+    fileName: the name of the file to read
+    blockSize: the maximum size of the chunks
+    readahead: if True, tell the kernel the file will be read sequentially, and soon
+    return: iterator over the chunks of the content of the file
+    """
+    ubos.logging.trace( 'slurpFileChunks', fileName )
+
+    try :
+        fd = open(fileName, 'rb', buffering=0)
+
+    except :
+        ubos.logging.error( 'Cannot read file', fileName );
+        return None
+
+    if readahead:
+        try :
+            os.posix_fadvise( fd.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL )
+            os.posix_fadvise( fd.fileno(), 0, 0, os.POSIX_FADV_WILLNEED )
+        except (AttributeError, OSError):
+            pass # merely a hint
+
+    def chunks():
+        with fd:
+            while True:
+                chunk = fd.read( blockSize )
+                if not chunk:
+                    break
+                yield chunk
+
+    return chunks()
+
+
+def saveFile(fileName, content, mode=None, uid=-1, gid=-1, atomic=False, batch=None) :
     """
     Save binary content to a file.
 
     fileName: name of the file to write
     content: the content to write
     mode: the file permissions to set; default is: umask
+    uid: owner of the file
+    gid: group of the file
+    atomic: if True, readers see either the old or the new content, never a partial file
+    batch: if given, write atomically as part of this AtomicFileBatch
+    """
+    _writeFile( fileName, content, mode, uid, gid, atomic, batch )
+
+
+class AtomicFileBatch :
+    """
+    Groups atomic writes of many files by saveFile and writeJsonToFile. The
+    files only appear, all at once, when the batch is committed, and each
+    affected directory is synced only once. Use as context manager: the
+    batch is committed at the end of the with block, or aborted if there
+    was an exception.
+    """
+    def __init__( self, fsync=True ) :
+        """
+        fsync: if False, do not wait for the content to be on disk
+        """
+        self.theFsync   = fsync
+        self.thePending = [] # ( temporary file, final file )
+
+
+    def add( self, tmpFile, fileName ) :
+        """
+        Remember a written temporary file that is to be renamed upon commit.
+
+        tmpFile: the temporary file
+        fileName: the final name
+        """
+        self.thePending.append( ( tmpFile, fileName ))
+
+
+    def commit( self ) :
+        """
+        Move all files written so far into place.
+        """
+        dirs = set()
+        while self.thePending :
+            ( tmpFile, fileName ) = self.thePending[0]
+            try :
+                os.replace( tmpFile, fileName )
+            except :
+                self.abort() # do not leave the files behind that have not been moved yet
+                raise
+            del self.thePending[0]
+            dirs.add( os.path.dirname( fileName ) or '.' )
+
+        if self.theFsync :
+            for d in dirs :
+                _fsyncDir( d )
+
+
+    def abort( self ) :
+        """
+        Discard all files written so far.
+        """
+        for ( tmpFile, fileName ) in self.thePending :
+            try :
+                os.unlink( tmpFile )
+            except OSError as e:
+                ubos.logging.error( 'Cannot delete file:', e )
+        self.thePending = []
+
+
+    def __enter__( self ) :
+        return self
+
+
+    def __exit__( self, excType, excValue, tb ) :
+        if excType is None :
+            self.commit()
+        else :
+            self.abort()
+        return False
+
+
+def _writeFile( fileName, content, mode, uid, gid, atomic, batch ) :
+    """
+    Implementation of saveFile and writeJsonToFile. Permissions and
+    ownership are set on the open file descriptor.
     """
-    with open(fileName, 'wb') as fd:
-        fd.write(content)
+    uid = getUid( uid )
+    gid = getGid( gid )
 
-    if mode != None:
-        os.chmod( fileName, mode )
+    if not atomic and batch is None :
+        with open(fileName, 'wb') as fd:
+            fd.write(content)
+
+            if mode != None:
+                os.fchmod( fd.fileno(), mode )
+            if uid >= 0 or gid >= 0 :
+                os.fchown( fd.fileno(), uid, gid )
+        return
+
+    # Like writing in place, keep mode and owner of what was there before, unless told otherwise
+    try :
+        existing = os.stat( fileName )
+    except FileNotFoundError :
+        existing = None
+
+    if mode is None :
+        if existing is None :
+            mode = 0o666 & ~_umask( os.path.dirname( fileName ) or '.' )
+        else :
+            mode = existing.st_mode & 0o7777
+
+    dirName  = os.path.dirname( fileName ) or '.'
+    ( tmpFd, tmpFile ) = tempfile.mkstemp( prefix='.' + os.path.basename( fileName ) + '.', suffix='.tmp', dir=dirName )
+    try :
+        with os.fdopen( tmpFd, 'wb' ) as fd:
+            fd.write(content)
+            fd.flush()
+
+            os.fchmod( fd.fileno(), mode )
+            if uid >= 0 or gid >= 0 :
+                os.fchown( fd.fileno(), uid, gid )
+            elif existing is not None and ( existing.st_uid != os.geteuid() or existing.st_gid != os.getegid() ) :
+                try :
+                    os.fchown( fd.fileno(), existing.st_uid, existing.st_gid )
+                except PermissionError :
+                    pass
+
+            if batch is None or batch.theFsync :
+                os.fsync( fd.fileno() )
+
+    except :
+        os.unlink( tmpFile )
+        raise
+
+    if batch is None :
+        os.replace( tmpFile, fileName )
+        _fsyncDir( dirName )
+    else :
+        batch.add( tmpFile, fileName )
+
+
+def _fsyncDir( dirName ) :
+    """
+    Make sure changes to the entries of a directory are on disk.
+    """
+    dirFd = os.open( dirName, os.O_RDONLY | os.O_DIRECTORY )
+    try :
+        os.fsync( dirFd )
+    finally :
+        os.close( dirFd )
+
+
+def _umask( dirName ) :
+    """
+    Determine the current umask, without changing it, as other threads may
+    be creating files at the same time.
+
+    dirName: a writable directory, in case a file needs to be created to find out
+    """
+    try :
+        with open( '/proc/self/status' ) as f :
+            for line in f :
+                if line.startswith( 'Umask:' ) :
+                    return int( line.split()[1], 8 )
+    except ( OSError, ValueError, IndexError ) :
+        pass
+
+    # Create a file with all permissions; what it does not get is the umask
+    probe = os.path.join( dirName, '.umask-%d-%d.tmp' % ( os.getpid(), threading.get_ident() ))
+    fd    = os.open( probe, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o777 )
+    try :
+        return 0o777 & ~os.fstat( fd ).st_mode
+    finally :
+        os.close( fd )
+        os.unlink( probe )
 
 
 def deleteFile( *files ) :
@@ -339,6 +1121,319 @@ def symlink( oldfile, newfile, uid = -1, gid = -1 ) :
     return ret
 
 
+def provisionTree( root, entries, parallel = 1 ) :
+    """
+    Create many directories, symlinks and files below a root directory at
+    once. Parent directories shared by several entries are created and
+    opened only once, and everything is done relative to open directory
+    file descriptors, without resolving full paths over and over again.
+    Symbolic links are not followed below the root. Existing directories
+    are reused, and existing files are overwritten.
+
+    root: the root directory; will be created if it does not exist
+    entries: list of dicts, each with keys:
+        path: path relative to root
+        type: 'directory' (default), 'symlink' or 'file'
+        mode: permissions; default: 0o755 for directories, 0o644 for files
+        uid: owner, name or numerical; default: unchanged
+        gid: group, name or numerical; default: unchanged
+        target: for symlinks, the destination of the symlink
+        content: for files, the content, as string or bytes
+    parallel: if larger than 1, provision the subtrees of the root's subdirectories
+        with this many threads
+    return: True if successful. If any entry is invalid, nothing is provisioned
+    """
+    ubos.logging.trace( 'provisionTree', root, len( entries ))
+
+    tree = _provisionNode()
+    for entry in entries :
+        parts = _relativePathParts( entry.get( 'path', '' ))
+        if not parts :
+            ubos.logging.error( 'Invalid path for provisionTree:', entry.get( 'path' ))
+            return False
+
+        error = _provisionEntryError( entry )
+        if error :
+            ubos.logging.error( 'Invalid entry for provisionTree:', entry['path'], error )
+            return False
+
+        node = tree
+        for part in parts :
+            if node['entry'] and node['entry'].get( 'type', 'directory' ) != 'directory' :
+                ubos.logging.error( 'Invalid entry for provisionTree:', entry['path'], 'is below', node['entry']['path'], 'which is not a directory' )
+                return False
+            node = node['children'].setdefault( part, _provisionNode() )
+
+        if node['children'] and entry.get( 'type', 'directory' ) != 'directory' :
+            ubos.logging.error( 'Invalid entry for provisionTree:', entry['path'], 'is not a directory, but has content' )
+            return False
+        node['entry'] = entry
+
+    if not os.path.isdir( root ) :
+        os.makedirs( root )
+
+    errors = []
+    rootFd = os.open( root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC )
+    try :
+        if parallel > 1 :
+            import concurrent.futures # only when needed, as it takes a while to import
+            with concurrent.futures.ThreadPoolExecutor( max_workers=parallel ) as executor:
+                futures = []
+                for ( name, child ) in tree['children'].items() :
+                    if child['children'] :
+                        futures.append( executor.submit( _provisionOne, rootFd, name, child, name, errors ))
+                    else :
+                        _provisionOne( rootFd, name, child, name, errors )
+
+            for future in futures :
+                future.result() # raises what the thread raised, like when not parallel
+        else :
+            for ( name, child ) in tree['children'].items() :
+                _provisionOne( rootFd, name, child, name, errors )
+
+    finally :
+        os.close( rootFd )
+
+    for error in errors :
+        ubos.logging.error( 'Failed to provision', root, error )
+
+    return not errors
+
+
+def deleteTree( root, paths, parallel = 1 ) :
+    """
+    Delete many files, symlinks and directories, including their content,
+    below a root directory at once. Paths below other paths to be deleted are
+    skipped, and all work is done relative to open directory file
+    descriptors. Symbolic links are deleted, not followed.
+
+    root: the root directory
+    paths: list of paths relative to root
+    parallel: if larger than 1, delete with this many threads
+    return: True if successful
+    """
+    ubos.logging.trace( 'deleteTree', root, len( paths ))
+
+    toDelete = []
+    for path in paths :
+        parts = _relativePathParts( path )
+        if not parts :
+            ubos.logging.error( 'Invalid path for deleteTree:', path )
+            return False
+        toDelete.append( parts )
+
+    toDelete.sort()
+    errors  = []
+    dirFds  = {} # tuple of path components -> open file descriptor
+    tasks   = [] # ( parent directory fd, name, path for error messages )
+    previous = None
+
+    dirFds[()] = os.open( root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC )
+    try :
+        for parts in toDelete :
+            if previous is not None and parts[0:len( previous )] == previous :
+                continue # already deleted as part of its parent
+            previous = parts
+
+            try :
+                parentFd = _openDirFd( dirFds, parts[0:-1] )
+                tasks.append( ( parentFd, parts[-1], '/'.join( parts )))
+            except OSError as e :
+                errors.append( '%s: %s' % ( '/'.join( parts ), e ))
+
+        if parallel > 1 and len( tasks ) > 1 :
+            import concurrent.futures # only when needed, as it takes a while to import
+            with concurrent.futures.ThreadPoolExecutor( max_workers=parallel ) as executor:
+                futures = [ executor.submit( _deleteOne, *task, errors ) for task in tasks ]
+
+            for future in futures :
+                future.result() # raises what the thread raised, like when not parallel
+        else :
+            for task in tasks :
+                _deleteOne( *task, errors )
+
+    finally :
+        for fd in dirFds.values() :
+            os.close( fd )
+
+    for error in errors :
+        ubos.logging.error( 'Failed to delete below', root, error )
+
+    return not errors
+
+
+def _provisionNode() :
+    return { 'entry' : None, 'children' : {} }
+
+
+def _provisionEntryError( entry ) :
+    """
+    Check an entry passed to provisionTree before anything is provisioned.
+
+    entry: the entry
+    return: error message, or None if the entry is valid
+    """
+    objType = entry.get( 'type', 'directory' )
+    if objType not in ( 'directory', 'symlink', 'file' ) :
+        return 'unknown type %s' % objType
+
+    if objType == 'symlink' and not isinstance( entry.get( 'target' ), str ) :
+        return 'no target for symlink'
+
+    if objType == 'file' and not isinstance( entry.get( 'content', b'' ), ( str, bytes )) :
+        return 'content must be string or bytes'
+
+    if not isinstance( entry.get( 'mode', 0 ), int ) :
+        return 'mode must be numerical'
+
+    uid = entry.get( 'uid', -1 )
+    if isinstance( uid, str ) and uid not in _uidByName :
+        try :
+            pwd.getpwnam( uid )
+        except KeyError :
+            return 'cannot find user %s' % uid
+
+    gid = entry.get( 'gid', -1 )
+    if isinstance( gid, str ) and gid not in _gidByName :
+        try :
+            grp.getgrnam( gid )
+        except KeyError :
+            return 'cannot find group %s' % gid
+
+    return None
+
+
+def _relativePathParts( path ) :
+    """
+    Split a relative path into its components.
+
+    return: tuple of components, or None if the path is empty or leads upward
+    """
+    parts = tuple( p for p in path.split( '/' ) if p and p != '.' )
+    if not parts or '..' in parts :
+        return None
+    return parts
+
+
+def _provisionOne( dirFd, name, node, relPath, errors ) :
+    """
+    Provision one node of the tree built by provisionTree, and its children.
+
+    dirFd: file descriptor of the directory that contains it
+    name: its name in that directory
+    node: the node
+    relPath: its path relative to the root, for error messages
+    errors: append error messages here
+    """
+    entry   = node['entry'] or {}
+    objType = entry.get( 'type', 'directory' )
+    mode    = entry.get( 'mode' )
+    uid     = getUid( entry.get( 'uid', -1 ))
+    gid     = getGid( entry.get( 'gid', -1 ))
+
+    try :
+        if objType == 'directory' :
+            try :
+                os.mkdir( name, 0o755 if mode is None else mode, dir_fd=dirFd )
+            except FileExistsError :
+                pass # if it is not a directory, opening it fails next
+
+            fd = os.open( name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dirFd )
+            try :
+                if mode is not None :
+                    os.fchmod( fd, mode ) # not subject to umask, unlike mkdir
+                if uid >= 0 or gid >= 0 :
+                    os.fchown( fd, uid, gid )
+
+                for ( childName, child ) in node['children'].items() :
+                    _provisionOne( fd, childName, child, relPath + '/' + childName, errors )
+            finally :
+                os.close( fd )
+
+        elif objType == 'symlink' :
+            try :
+                os.symlink( entry['target'], name, dir_fd=dirFd )
+            except FileExistsError :
+                if os.readlink( name, dir_fd=dirFd ) != entry['target'] :
+                    raise
+
+            if uid >= 0 or gid >= 0 :
+                os.chown( name, uid, gid, dir_fd=dirFd, follow_symlinks=False )
+
+        elif objType == 'file' :
+            content = entry.get( 'content', b'' )
+            if isinstance( content, str ) :
+                content = content.encode()
+
+            fd = os.open( name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o644 if mode is None else mode, dir_fd=dirFd )
+            try :
+                view = memoryview( content )
+                while view :
+                    view = view[os.write( fd, view ):]
+
+                if mode is not None :
+                    os.fchmod( fd, mode )
+                if uid >= 0 or gid >= 0 :
+                    os.fchown( fd, uid, gid )
+            finally :
+                os.close( fd )
+
+    except OSError as e :
+        errors.append( '%s: %s' % ( relPath, e ))
+
+
+def _openDirFd( dirFds, parts ) :
+    """
+    Open the directory with these path components relative to the root,
+    reusing and remembering already-opened directories.
+
+    dirFds: tuple of path components -> open file descriptor; contains the root as ()
+    parts: tuple of path components
+    return: the file descriptor
+    """
+    ret = dirFds.get( parts )
+    if ret is None :
+        parentFd      = _openDirFd( dirFds, parts[0:-1] )
+        ret           = os.open( parts[-1], os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=parentFd )
+        dirFds[parts] = ret
+    return ret
+
+
+def _deleteOne( dirFd, name, relPath, errors ) :
+    """
+    Delete one file, symlink, or directory with its content.
+
+    dirFd: file descriptor of the directory that contains it
+    name: its name in that directory
+    relPath: its path relative to the root, for error messages
+    errors: append error messages here
+    """
+    try :
+        try :
+            os.unlink( name, dir_fd=dirFd )
+            return
+        except IsADirectoryError :
+            pass
+
+        fd = os.open( name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC, dir_fd=dirFd )
+        try :
+            with os.scandir( fd ) as it :
+                entries = [ ( e.name, e.is_dir( follow_symlinks=False )) for e in it ]
+
+            for ( childName, isDir ) in entries :
+                if isDir :
+                    _deleteOne( fd, childName, relPath + '/' + childName, errors )
+                else :
+                    os.unlink( childName, dir_fd=fd )
+        finally :
+            os.close( fd )
+
+        os.rmdir( name, dir_fd=dirFd )
+
+    except OSError as e :
+        errors.append( '%s: %s' % ( relPath, e ))
+
+
 def absReadLink( path ) :
     """
     Resolve the target of a symbolic link to an absolute path.
@@ -383,13 +1478,17 @@ def getUid( uname ) :
         uid = uname;
 
     else :
-        try :
-            uinfo = pwd.getpwnam( uname )
-        except :
-            ubos.logging.error( 'Cannot find user. Using \'nobody\' instead:', uname )
-            uinfo = pwd.getpwnam( 'nobody' );
-
-        uid = uinfo[2]
+        uid = _uidByName.get( uname )
+        if uid is None :
+            try :
+                uinfo = pwd.getpwnam( uname )
+            except KeyError :
+                ubos.logging.error( 'Cannot find user. Using \'nobody\' instead:', uname )
+                uinfo = pwd.getpwnam( 'nobody' );
+
+            uid = uinfo.pw_uid
+            _uidByName[uinfo.pw_name] = uid
+            _unameByUid[uid]          = uinfo.pw_name
 
     return uid
 
@@ -412,13 +1511,17 @@ def getGid( gname ) :
         gid = gname;
 
     else :
-        try :
-            ginfo = pwd.getgrnam( gname )
-        except :
-            ubos.logging.error( 'Cannot find group. Using \'nobody\' instead:', gname )
-            ginfo = pwd.getgrnam( 'nobody' );
-
-        gid = ginfo[2]
+        gid = _gidByName.get( gname )
+        if gid is None :
+            try :
+                ginfo = grp.getgrnam( gname )
+            except KeyError :
+                ubos.logging.error( 'Cannot find group. Using \'nobody\' instead:', gname )
+                ginfo = grp.getgrnam( 'nobody' );
+
+            gid = ginfo.gr_gid
+            _gidByName[ginfo.gr_name] = gid
+            _gnameByGid[gid]          = ginfo.gr_name
 
     return gid
 
@@ -432,13 +1535,19 @@ def getUname( uid ) :
     """
 
     if uid is None:
-        uid = os.getUid() # default is current user
+        uid = os.getuid() # default is current user
 
     if isinstance( uid, int ) :
-        uname = os.getpwuid( uid )
+        uname = _unameByUid.get( uid )
         if uname is None :
-            ubos.logging.error( 'Cannot find user. Using \'nobody\' instead:', uid )
-            uname = 'nobody'
+            try :
+                uname = pwd.getpwuid( uid ).pw_name
+                _unameByUid[uid]  = uname
+                _uidByName[uname] = uid
+
+            except KeyError :
+                ubos.logging.error( 'Cannot find user. Using \'nobody\' instead:', uid )
+                uname = 'nobody'
 
     else :
         uname = uid;
@@ -458,10 +1567,16 @@ def getGname( gid ) :
         gid = os.getgid() # default is current group
 
     if isinstance( gid, int ) :
-        gname = os.getgrgid( gid )
+        gname = _gnameByGid.get( gid )
         if gname is None :
-            ubos.logging.error( 'Cannot find group. Using \'nogroup\' instead:', gid )
-            gname = 'nogroup'
+            try :
+                gname = grp.getgrgid( gid ).gr_name
+                _gnameByGid[gid]  = gname
+                _gidByName[gname] = gid
+
+            except KeyError :
+                ubos.logging.error( 'Cannot find group. Using \'nogroup\' instead:', gid )
+                gname = 'nogroup'
 
     else :
         gname = gid;
@@ -469,6 +1584,32 @@ def getGname( gid ) :
     return gname
 
 
+def preloadUsersAndGroups() :
+    """
+    Resolve all users and groups known to the system at once, so that
+    getUid, getGid, getUname and getGname do not need to look up names
+    one at a time. Useful before changing the ownership of many files.
+    """
+    for uinfo in pwd.getpwall() :
+        _uidByName.setdefault( uinfo.pw_name, uinfo.pw_uid )
+        _unameByUid.setdefault( uinfo.pw_uid, uinfo.pw_name )
+
+    for ginfo in grp.getgrall() :
+        _gidByName.setdefault( ginfo.gr_name, ginfo.gr_gid )
+        _gnameByGid.setdefault( ginfo.gr_gid, ginfo.gr_name )
+
+
+def invalidateUsersAndGroups() :
+    """
+    Forget all resolved users and groups, e.g. after users or groups have
+    been added or removed.
+    """
+    _uidByName.clear()
+    _unameByUid.clear()
+    _gidByName.clear()
+    _gnameByGid.clear()
+
+
 def time2string(t):
     """
     Format time consistently